@@ -0,0 +1,198 @@
+"""Throughput and latency benchmarks for the update pipeline
+(UpdateManager -> process -> Event -> parse_command -> handler -> API).
+
+    python -m benchmarks.pipeline --updates 20000 --output bench.json
+    python -m benchmarks.pipeline --replay recorded.jsonl
+
+Prints (and optionally writes) the results as JSON, so runs can be diffed
+against each other to track regressions.
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+from dotmap import DotMap
+
+from natsuko import NatsukoClient
+from models.types import Event
+from utilities.fakeapi import FakeBotAPI, synthetic_update, load_updates
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def make_updates(count, chats):
+    return [synthetic_update(i, chat_id=i % chats + 1, text=f"/ping {i}") for i in range(1, count + 1)]
+
+
+def command_names(updates):
+    """Returns the bot commands used in the updates, so a replayed recording
+    gets a handler for each of them.
+    """
+
+    names = set()
+    for update in updates:
+        message = update.get("message") or {}
+        for entity in message.get("entities", []):
+            if entity["type"] == "bot_command":
+                offset = entity["offset"]
+                names.add(message["text"][offset + 1: offset + entity["length"]])
+
+    return names
+
+
+def register(client, names, handler):
+    for name in names:
+        client.command(name)(handler)
+
+
+def bench_dispatch(updates):
+    """Runs the in-process part of the pipeline (no network): DotMap, Event,
+    parse_command and a no-op handler.
+    """
+
+    client = NatsukoClient("BENCH")
+
+    async def noop(event):
+        pass
+
+    register(client, command_names(updates), noop)
+
+    async def run():
+        client.manager.command_queue.extend(updates)
+        start = time.perf_counter()
+        await client.process()
+        await asyncio.sleep(0)
+        return time.perf_counter() - start
+
+    try:
+        elapsed = client.loop.run_until_complete(run())
+    finally:
+        client.loop.run_until_complete(client.session.close())
+
+    return {"updates": len(updates), "seconds": elapsed, "updates_per_sec": len(updates) / elapsed}
+
+
+def bench_memory(updates):
+    """Bytes held per update while it is in flight, ie. its DotMap and parsed Event."""
+
+    client = NatsukoClient("BENCH")
+
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        events = [Event(client, DotMap(update)) for update in updates]
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        client.loop.run_until_complete(client.session.close())
+
+    held = current - before
+    del events
+
+    return {"updates": len(updates), "bytes_held": held, "peak_bytes": peak - before,
+            "bytes_per_update": held / len(updates)}
+
+
+def bench_end_to_end(updates, batch_size, timeout):
+    """Feeds the updates through a fake Bot API and times each one from the moment
+    getUpdates served it to the moment the handler's reply reached the server.
+    """
+
+    fake = FakeBotAPI()
+    client = None
+
+    names = command_names(updates)
+    expected = sum(1 for u in updates if "message" in u and any(
+        e["type"] == "bot_command" for e in u["message"].get("entities", [])))
+
+    async def run():
+        nonlocal client
+        await fake.start()
+
+        client = NatsukoClient("BENCH", api_url=fake.url, poll_timeout=1)
+
+        async def reply(event):
+            await event.chat.send_message(str(event.update_id))
+
+        register(client, names, reply)
+
+        for i in range(0, len(updates), batch_size):
+            fake.push(updates[i:i + batch_size])
+
+        start = time.perf_counter()
+        poller = asyncio.ensure_future(client.manager.update_loop())
+
+        deadline = time.monotonic() + timeout
+        while len(fake.calls) < expected and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+
+        elapsed = time.perf_counter() - start
+        poller.cancel()
+        await asyncio.gather(poller, return_exceptions=True)
+        await client.session.close()
+        await fake.stop()
+
+        return elapsed
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        elapsed = loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+    latencies = []
+    for method, params, received in fake.calls:
+        served = fake.served_at.get(int(params["text"]))
+        if served is not None:
+            latencies.append(received - served)
+
+    return {"updates": len(updates), "expected_replies": expected, "replies": len(fake.calls), "seconds": elapsed,
+            "updates_per_sec": len(fake.calls) / elapsed,
+            "latency_p50": percentile(latencies, 50), "latency_p99": percentile(latencies, 99),
+            "latency_mean": statistics.mean(latencies) if latencies else None}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=10000, help="number of synthetic updates")
+    parser.add_argument("--chats", type=int, default=100, help="distinct chats the updates come from")
+    parser.add_argument("--batch", type=int, default=100, help="updates per getUpdates batch")
+    parser.add_argument("--replay", help="JSONL file of recorded updates to use instead")
+    parser.add_argument("--timeout", type=float, default=120, help="end to end run time limit")
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    args = parser.parse_args(argv)
+
+    if args.replay:
+        updates = load_updates(args.replay)
+    else:
+        updates = make_updates(args.updates, args.chats)
+
+    results = {"python": platform.python_version(), "timestamp": time.time(),
+               "dispatch": bench_dispatch(updates),
+               "memory": bench_memory(updates),
+               "end_to_end": bench_end_to_end(updates, args.batch, args.timeout)}
+
+    output = json.dumps(results, indent=2)
+    print(output)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
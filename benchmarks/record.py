@@ -0,0 +1,54 @@
+"""Records live updates for replaying through the fake Bot API.
+
+    python -m benchmarks.record <token> updates.jsonl --batches 50
+
+Every getUpdates batch is appended to the file as one JSON line. Note that
+recording confirms the updates, a bot running on the same token won't see them.
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+
+import aiohttp
+
+from natsuko import API_URL
+
+
+async def record(token, path, batches, timeout):
+    url = f"{API_URL}/bot{token}/getUpdates"
+    offset = None
+
+    async with aiohttp.ClientSession() as session:
+        with open(path, "a") as f:
+            for _ in range(batches):
+                params = {"timeout": timeout}
+                if offset:
+                    params["offset"] = offset
+
+                async with session.get(url, params=params) as resp:
+                    result = (await resp.json())["result"]
+
+                if not result:
+                    continue
+
+                f.write(json.dumps(result) + "\n")
+                f.flush()
+                offset = max(u["update_id"] for u in result) + 1
+                print(f"Recorded {len(result)} updates")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("token")
+    parser.add_argument("path")
+    parser.add_argument("--batches", type=int, default=10, help="number of polls to record")
+    parser.add_argument("--timeout", type=int, default=30, help="long poll timeout")
+    args = parser.parse_args(argv)
+
+    asyncio.run(record(args.token, args.path, args.batches, args.timeout))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
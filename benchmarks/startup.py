@@ -0,0 +1,116 @@
+"""Cold start benchmarks: how long `import natsuko` takes, how long a fresh
+process takes to send its first getUpdates, and its RSS once idle.
+
+    python -m benchmarks.startup --runs 10 --output startup.json
+
+Every run is a new interpreter, polling a fake Bot API served from this
+process. Prints (and optionally writes) the results as JSON, so runs can be
+diffed against each other to track regressions.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+
+# what each child process runs, timed from before its first import
+CHILD = """
+import time
+start = time.perf_counter()
+
+import asyncio, json, sys
+import natsuko
+
+imported = time.perf_counter()
+print(json.dumps({"start": start, "import": imported - start}), flush=True)
+
+client = natsuko.NatsukoClient("BENCH", api_url=sys.argv[1], poll_timeout=1)
+
+async def idle():
+    await asyncio.sleep(float(sys.argv[2]))
+    with open("/proc/self/status") as f:
+        rss = next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS"))
+    print(json.dumps({"rss": rss}), flush=True)
+    client.stop()
+
+client.loop.create_task(idle())
+client.run()
+"""
+
+
+def rss_supported():
+    return os.path.exists("/proc/self/status")
+
+
+async def one_run(fake, idle):
+    first_poll = len(fake.polls)
+
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, "-c", CHILD, fake.url, str(idle), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    lines = [json.loads(line) for line in (await proc.communicate())[0].decode().splitlines() if line.startswith("{")]
+    result = {key: value for line in lines for key, value in line.items()}
+
+    polls = fake.polls[first_poll:]
+
+    # perf_counter is the system-wide monotonic clock, comparable across processes
+    return {"import": result.get("import"),
+            "first_poll": polls[0] - result["start"] if polls and "start" in result else None,
+            "rss": result.get("rss")}
+
+
+def summarize(values):
+    values = [v for v in values if v is not None]
+    if not values:
+        return None
+
+    return {"min": min(values), "median": statistics.median(values), "max": max(values)}
+
+
+def bench_startup(runs, idle):
+    from utilities.fakeapi import FakeBotAPI
+
+    fake = FakeBotAPI()
+
+    async def run():
+        await fake.start()
+        try:
+            return [await one_run(fake, idle) for _ in range(runs)]
+        finally:
+            await fake.stop()
+
+    results = asyncio.run(run())
+
+    return {"runs": runs,
+            "import_seconds": summarize([r["import"] for r in results]),
+            "first_poll_seconds": summarize([r["first_poll"] for r in results]),
+            "idle_rss_bytes": summarize([r["rss"] for r in results]) if rss_supported() else None}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="fresh processes to start")
+    parser.add_argument("--idle", type=float, default=1.0, help="seconds to idle before measuring RSS")
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    args = parser.parse_args(argv)
+
+    results = {"python": platform.python_version(), "timestamp": time.time(),
+               "startup": bench_startup(args.runs, args.idle)}
+
+    output = json.dumps(results, indent=2)
+    print(output)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
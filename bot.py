@@ -1,7 +1,10 @@
 from natsuko import NatsukoClient
+from utilities.log import setup_logging
 import settings
 import yaml
 
+setup_logging(sample_rate=0.1)
+
 client = NatsukoClient(settings.TOKEN)
 
 @client.command("hello")
@@ -10,9 +13,7 @@ async def hello_command(event):
 
 @client.command("image")
 async def image_command(event):
-    with open('testimage.jpg', 'rb') as f:
-        photo = f.read()
-
+    photo = client.static_file('testimage.jpg')
     await client.send_photo(event.message.chat.id, photo, caption="it's a test photo")
 
 @client.command("info")
@@ -21,7 +22,7 @@ async def chat_info(event):
     channel = event.message.text[6:]
     x = await client.get_chat(channel)
 
-    await client.send_message(event.message.chat.id, yaml.dump(x))
+    await client.send_message(event.message.chat.id, yaml.dump(x.data))
 
 
 client.run()
@@ -0,0 +1,262 @@
+import json
+
+from models.errors import RequestError
+from models.types import MasterType, Message, Chat, ChatMember, File, UserProfilePhotos
+
+
+# parameters sent as JSON-serialized objects
+JSON_PARAMS = frozenset(['reply_markup', 'entities', 'caption_entities', 'permissions',
+                         'link_preview_options', 'media', 'results', 'reply_parameters', 'button'])
+
+# short names accepted for some parameters
+ALIASES = {'reply': 'reply_to_message_id'}
+
+# options every send* method takes
+SEND_OPTIONS = ('disable_notification', 'protect_content', 'reply_to_message_id',
+                'allow_sending_without_reply', 'reply_parameters', 'reply_markup',
+                'message_thread_id', 'business_connection_id')
+
+CAPTION_OPTIONS = ('caption', 'parse_mode', 'caption_entities', 'show_caption_above_media')
+
+# an album is 2 to 10 items
+MEDIA_GROUP_SIZE = (2, 10)
+
+# method name -> Endpoint
+ENDPOINTS = {}
+
+
+def attach(media):
+    """Points the uploads in a list of InputMedia dicts at multipart fields
+    ("attach://file0", ...). Returns (media, files), leaving the dicts passed
+    in untouched.
+    """
+
+    items, files = [], {}
+
+    for i, item in enumerate(media):
+        item = dict(item)
+
+        # file_ids and URLs are sent as they are
+        if not isinstance(item.get("media"), str):
+            files[f"file{i}"] = item["media"]
+            item["media"] = f"attach://file{i}"
+
+        items.append(item)
+
+    return items, files
+
+
+def serialize(name, value):
+    """Turns a parameter into what goes on the wire."""
+
+    # booleans first, they're ints too
+    if value is True:
+        return "true"
+    if value is False:
+        return "false"
+
+    if name in JSON_PARAMS and not isinstance(value, str):
+        if isinstance(value, MasterType):
+            value = value.data
+
+        # eg. a frozen keyboard that keeps its JSON around
+        to_json = getattr(value, "to_json", None)
+        if to_json:
+            return to_json()
+
+        return json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+
+    if isinstance(value, (str, int, float)):
+        return value
+
+    return str(value)
+
+
+class Endpoint():
+    """A Bot API method: its required and optional parameters, which parameter
+    (if any) can be an upload, and the type its result is parsed into.
+    Endpoints are declared once, at import time, and every call made through
+    them is checked locally before anything is sent.
+    """
+
+    __slots__ = ['method', 'required', 'params', 'file', 'result_type']
+
+    def __init__(self, method, required=(), optional=(), file=None, result_type=None):
+        self.method = method
+        self.required = tuple(required)
+        self.params = frozenset(required) | frozenset(optional)
+        self.file = file
+        self.result_type = result_type
+
+    def prepare(self, args):
+        """Validates a call's arguments and returns (params, files), files being
+        None unless the call uploads something.
+        """
+
+        for alias, name in ALIASES.items():
+            if alias in args:
+                args[name] = args.pop(alias)
+
+        unknown = args.keys() - self.params
+        if unknown:
+            raise RequestError(f"{self.method}: unknown parameter(s) {', '.join(sorted(unknown))}")
+
+        missing = [name for name in self.required if args.get(name) is None]
+        if missing:
+            raise RequestError(f"{self.method}: missing required parameter(s) {', '.join(missing)}")
+
+        params = {}
+        files = None
+
+        for name, value in args.items():
+            if value is None:
+                continue
+
+            # a list of InputMedia, eg. an album, uploads each item that isn't a file_id or URL
+            if name == self.file and isinstance(value, (list, tuple)):
+                value, uploads = attach(value)
+                files = {**(files or {}), **uploads} or None
+
+            # file_ids and URLs are plain parameters, anything else is uploaded
+            elif name == self.file and not isinstance(value, str):
+                files = {**(files or {}), name: value}
+                continue
+
+            params[name] = serialize(name, value)
+
+        return params, files
+
+    def __repr__(self):
+        return f"<Endpoint {self.method}>"
+
+
+def endpoint(method, required=(), optional=(), file=None, result_type=None):
+    ENDPOINTS[method] = Endpoint(method, required, optional, file, result_type)
+    return ENDPOINTS[method]
+
+
+# Sending
+
+SEND_MESSAGE = endpoint('sendMessage', ('chat_id', 'text'),
+                        ('parse_mode', 'entities', 'disable_web_page_preview', 'link_preview_options',
+                         *SEND_OPTIONS), result_type=Message)
+
+FORWARD_MESSAGE = endpoint('forwardMessage', ('chat_id', 'from_chat_id', 'message_id'),
+                           ('disable_notification', 'protect_content', 'message_thread_id'),
+                           result_type=Message)
+
+SEND_PHOTO = endpoint('sendPhoto', ('chat_id', 'photo'),
+                      (*CAPTION_OPTIONS, 'has_spoiler', *SEND_OPTIONS),
+                      file='photo', result_type=Message)
+
+SEND_AUDIO = endpoint('sendAudio', ('chat_id', 'audio'),
+                      (*CAPTION_OPTIONS, 'duration', 'performer', 'title', 'thumbnail', *SEND_OPTIONS),
+                      file='audio', result_type=Message)
+
+SEND_DOCUMENT = endpoint('sendDocument', ('chat_id', 'document'),
+                         (*CAPTION_OPTIONS, 'thumbnail', 'disable_content_type_detection', *SEND_OPTIONS),
+                         file='document', result_type=Message)
+
+SEND_VIDEO = endpoint('sendVideo', ('chat_id', 'video'),
+                      (*CAPTION_OPTIONS, 'duration', 'width', 'height', 'thumbnail',
+                       'supports_streaming', 'has_spoiler', *SEND_OPTIONS),
+                      file='video', result_type=Message)
+
+SEND_VOICE = endpoint('sendVoice', ('chat_id', 'voice'),
+                      (*CAPTION_OPTIONS, 'duration', *SEND_OPTIONS),
+                      file='voice', result_type=Message)
+
+SEND_VIDEO_NOTE = endpoint('sendVideoNote', ('chat_id', 'video_note'),
+                           ('duration', 'length', 'thumbnail', *SEND_OPTIONS),
+                           file='video_note', result_type=Message)
+
+SEND_MEDIA_GROUP = endpoint('sendMediaGroup', ('chat_id', 'media'),
+                            ('disable_notification', 'protect_content', 'reply_to_message_id',
+                             'allow_sending_without_reply', 'reply_parameters', 'message_thread_id',
+                             'business_connection_id'),
+                            file='media', result_type=Message)
+
+SEND_LOCATION = endpoint('sendLocation', ('chat_id', 'latitude', 'longitude'),
+                         ('horizontal_accuracy', 'live_period', 'heading', 'proximity_alert_radius',
+                          *SEND_OPTIONS), result_type=Message)
+
+SEND_VENUE = endpoint('sendVenue', ('chat_id', 'latitude', 'longitude', 'title', 'address'),
+                      ('foursquare_id', 'foursquare_type', 'google_place_id', 'google_place_type',
+                       *SEND_OPTIONS), result_type=Message)
+
+SEND_CONTACT = endpoint('sendContact', ('chat_id', 'phone_number', 'first_name'),
+                        ('last_name', 'vcard', *SEND_OPTIONS), result_type=Message)
+
+SEND_CHAT_ACTION = endpoint('sendChatAction', ('chat_id', 'action'),
+                            ('message_thread_id', 'business_connection_id'))
+
+# Users and files
+
+GET_USER_PROFILE_PHOTOS = endpoint('getUserProfilePhotos', ('user_id',), ('offset', 'limit'),
+                                   result_type=UserProfilePhotos)
+
+GET_FILE = endpoint('getFile', ('file_id',), result_type=File)
+
+# Chat administration
+
+BAN_CHAT_MEMBER = endpoint('kickChatMember', ('chat_id', 'user_id'), ('until_date', 'revoke_messages'))
+
+UNBAN_CHAT_MEMBER = endpoint('unbanChatMember', ('chat_id', 'user_id'), ('only_if_banned',))
+
+RESTRICT_CHAT_MEMBER = endpoint('restrictChatMember', ('chat_id', 'user_id'),
+                                ('permissions', 'until_date', 'use_independent_chat_permissions',
+                                 'can_send_messages', 'can_send_media_messages',
+                                 'can_send_other_messages', 'can_add_web_page_previews'))
+
+PROMOTE_CHAT_MEMBER = endpoint('promoteChatMember', ('chat_id', 'user_id'),
+                               ('is_anonymous', 'can_manage_chat', 'can_change_info', 'can_post_messages',
+                                'can_edit_messages', 'can_delete_messages', 'can_invite_users',
+                                'can_restrict_members', 'can_pin_messages', 'can_promote_members',
+                                'can_manage_video_chats', 'can_manage_topics'))
+
+EXPORT_INVITE_LINK = endpoint('exportChatInviteLink', ('chat_id',))
+
+SET_CHAT_PHOTO = endpoint('setChatPhoto', ('chat_id', 'photo'), file='photo')
+
+DELETE_CHAT_PHOTO = endpoint('deleteChatPhoto', ('chat_id',))
+
+SET_CHAT_TITLE = endpoint('setChatTitle', ('chat_id', 'title'))
+
+SET_CHAT_DESCRIPTION = endpoint('setChatDescription', ('chat_id',), ('description',))
+
+PIN_CHAT_MESSAGE = endpoint('pinChatMessage', ('chat_id', 'message_id'),
+                            ('disable_notification', 'business_connection_id'))
+
+UNPIN_CHAT_MESSAGE = endpoint('unpinChatMessage', ('chat_id',), ('message_id', 'business_connection_id'))
+
+GET_CHAT = endpoint('getChat', ('chat_id',), result_type=Chat)
+
+GET_CHAT_ADMINISTRATORS = endpoint('getChatAdministrators', ('chat_id',), result_type=ChatMember)
+
+GET_CHAT_MEMBER_COUNT = endpoint('getChatMembersCount', ('chat_id',))
+
+GET_CHAT_MEMBER = endpoint('getChatMember', ('chat_id', 'user_id'), result_type=ChatMember)
+
+# Inline mode
+
+ANSWER_INLINE_QUERY = endpoint('answerInlineQuery', ('inline_query_id', 'results'),
+                               ('cache_time', 'is_personal', 'next_offset', 'button',
+                                'switch_pm_text', 'switch_pm_parameter'))
+
+ANSWER_CALLBACK_QUERY = endpoint('answerCallbackQuery', ('callback_query_id',),
+                                 ('text', 'show_alert', 'url', 'cache_time'))
+
+# Updating messages, chat_id and message_id or an inline_message_id
+
+EDIT_OPTIONS = ('chat_id', 'message_id', 'inline_message_id', 'reply_markup', 'business_connection_id')
+
+EDIT_MESSAGE_TEXT = endpoint('editMessageText', ('text',),
+                             ('parse_mode', 'entities', 'disable_web_page_preview', 'link_preview_options',
+                              *EDIT_OPTIONS), result_type=Message)
+
+EDIT_MESSAGE_CAPTION = endpoint('editMessageCaption', (), (*CAPTION_OPTIONS, *EDIT_OPTIONS),
+                                result_type=Message)
+
+EDIT_MESSAGE_REPLY_MARKUP = endpoint('editMessageReplyMarkup', (), EDIT_OPTIONS, result_type=Message)
+
+DELETE_MESSAGE = endpoint('deleteMessage', ('chat_id', 'message_id'))
@@ -1,8 +1,10 @@
-import pprint
-
 class APIError(Exception):
 
     def __init__(self, ex, message=None):
+        super().__init__(ex)
         self.expression = ex
         self.message = message
-        print("Error: {}".format(ex))
+
+
+class RequestError(APIError):
+    """A call rejected locally, before it was sent, eg. for a missing parameter."""
@@ -92,8 +92,9 @@ class Event():
         return await self.client.send_message(self.chat.id, message)
 
 
-    async def reply_photo(self, photo):
-        return await self.client.send_photo(self.chat.id, photo)
+    async def reply_photo(self, photo, **kwargs):
+        # photo can be a file_id, url, bytes, a path or an AsyncFile
+        return await self.client.send_photo(self.chat.id, photo, **kwargs)
 
 
     async def forward(self, chat_id):
@@ -0,0 +1,166 @@
+import json
+
+
+# Telegram's limit for a button's callback_data
+MAX_CALLBACK_DATA = 64
+
+# separates a callback's route from its arguments, see callback_data()
+SEPARATOR = ":"
+
+
+def callback_data(route, *args):
+    """Packs a route and its arguments into a button's callback_data, eg.
+    callback_data("page", 3) -> "page:3". client.callback(route) handlers get
+    the arguments back as strings in `event.args`.
+    """
+
+    data = SEPARATOR.join([route, *(str(arg) for arg in args)])
+
+    if len(data.encode()) > MAX_CALLBACK_DATA:
+        raise ValueError(f"callback_data is limited to {MAX_CALLBACK_DATA} bytes: {data!r}")
+
+    return data
+
+
+class Markup():
+    """A frozen reply_markup. It's serialized once, when it's built, and the
+    same JSON is sent with every message it's attached to.
+    """
+
+    __slots__ = ['json']
+
+    def __init__(self, data):
+        self.json = json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+
+    def to_json(self):
+        return self.json
+
+    @property
+    def data(self):
+        # a fresh copy, the frozen markup can't be changed through it
+        return json.loads(self.json)
+
+    def __eq__(self, other):
+        return isinstance(other, Markup) and other.json == self.json
+
+    def __hash__(self):
+        return hash(self.json)
+
+    def __repr__(self):
+        return f"<Markup {self.json}>"
+
+
+class InlineKeyboard():
+    """Builds an inline keyboard.
+
+        menu = (InlineKeyboard()
+                .row(("Settings", callback_data("settings")), ("Help", "help"))
+                .row(InlineKeyboard.url("Website", "https://example.com"))
+                .freeze())
+
+        await client.send_message(chat_id, "Menu", reply_markup=menu)
+
+    Buttons are (text, callback_data) pairs or button dicts. Build menus once,
+    eg. at import time, and reuse the frozen Markup.
+    """
+
+    def __init__(self):
+        self.rows = []
+
+    @staticmethod
+    def button(text, data=None, **fields):
+        button = {"text": text, **fields}
+        if data is not None:
+            button["callback_data"] = data
+
+        return button
+
+    @staticmethod
+    def url(text, url):
+        return {"text": text, "url": url}
+
+    def _button(self, button):
+        if isinstance(button, dict):
+            return dict(button)
+
+        text, data = button
+        return self.button(text, data)
+
+    def row(self, *buttons):
+        self.rows.append([self._button(b) for b in buttons])
+        return self
+
+    def add(self, button):
+        """Adds a button to the last row."""
+        if not self.rows:
+            self.rows.append([])
+
+        self.rows[-1].append(self._button(button))
+        return self
+
+    def freeze(self):
+        for row in self.rows:
+            for button in row:
+                data = button.get("callback_data")
+                if data is not None and len(data.encode()) > MAX_CALLBACK_DATA:
+                    raise ValueError(f"callback_data is limited to {MAX_CALLBACK_DATA} bytes: {data!r}")
+
+        return Markup({"inline_keyboard": self.rows})
+
+
+class ReplyKeyboard():
+    """Builds a custom reply keyboard, buttons being texts or button dicts.
+
+        yes_no = ReplyKeyboard(one_time=True).row("Yes", "No").freeze()
+    """
+
+    def __init__(self, resize=True, one_time=False, selective=False, placeholder=None, persistent=False):
+        self.rows = []
+        self.options = {"resize_keyboard": resize, "one_time_keyboard": one_time, "selective": selective,
+                        "is_persistent": persistent}
+
+        if placeholder:
+            self.options["input_field_placeholder"] = placeholder
+
+    @staticmethod
+    def contact(text):
+        return {"text": text, "request_contact": True}
+
+    @staticmethod
+    def location(text):
+        return {"text": text, "request_location": True}
+
+    def _button(self, button):
+        return dict(button) if isinstance(button, dict) else {"text": str(button)}
+
+    def row(self, *buttons):
+        self.rows.append([self._button(b) for b in buttons])
+        return self
+
+    def add(self, button):
+        if not self.rows:
+            self.rows.append([])
+
+        self.rows[-1].append(self._button(button))
+        return self
+
+    def freeze(self):
+        options = {key: value for key, value in self.options.items() if value}
+        return Markup({"keyboard": self.rows, **options})
+
+
+def remove_keyboard(selective=False):
+    return Markup({"remove_keyboard": True, "selective": selective})
+
+
+def force_reply(selective=False, placeholder=None):
+    data = {"force_reply": True, "selective": selective}
+    if placeholder:
+        data["input_field_placeholder"] = placeholder
+
+    return Markup(data)
+
+
+# the most common ones, ready to use
+REMOVE_KEYBOARD = remove_keyboard()
+FORCE_REPLY = force_reply()
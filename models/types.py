@@ -1,87 +1,90 @@
+from models.keyboards import Markup
 
 
 class MasterType():
+    """Base of the Telegram types. Fields are parsed lazily: the raw data is kept
+    and a field is only turned into its type (see TYPE_MAP at the bottom of this
+    module) the first time it is accessed. Missing fields are None.
+    """
 
-    def __init__(self, client, data):
-
-        self.TYPE_MAP = {
-            'message':              ('message', Message),
-            'from':                 ('author', User),
-            'chat':                 ('chat', Chat),
-            'forward_from':         ('forward_from', User),
-            'forward_from_chat':    ('forward_from_chat', Chat),
-            'reply_to_message':     ('reply_to', Message),
-            'audio':                ('audio', Audio),
-            'document':             ('document', Document),
-            'game':                 ('game', Game),
-            'photo':                ('photo', PhotoSize),
-            'sticker':              None,
-            'video':                ('video', Video),
-            'voice':                ('voice', Voice),
-            'video_note':           ('video_note', VideoNote),
-            'new_chat_members':     None,
-            'contact':              ('contact', Contact),
-            'location':             ('location', Location),
-            'venue':                ('venue', Venue),
-            'new_chat_member':      ('new_chat_member', User),
-            'left_chat_member':     ('left_chat_member', User),
-            'new_chat_photo':       ('new_chat_photo', PhotoSize),
-            'pinned_message':       ('pinned_message', Message),
-            'invoice':              None,
-            'successful_payment':   None
-        }
+    # raw field -> (attribute, type), None keeps the raw value
+    TYPE_MAP = {}
 
+    # attribute -> raw field, for the fields TYPE_MAP renames
+    FIELD_MAP = {}
 
+    def __init__(self, client, data):
         self.client = client
         self.data = data
 
-        for attr in data:
-            self._add_attribute(attr)
-
 
     def __getattr__(self, attr):
-        if attr in self.__dict__:
-            return self.__dict__[attr]
-        else:
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+
+        data = self.__dict__.get('data')
+        if data is None:
+            return None
+
+        field = self.FIELD_MAP.get(attr, attr)
+        if field not in data:
             return None
 
-    def _add_attribute(self, attr):
+        value = self._parse(field, data[field])
 
-        if attr not in self.TYPE_MAP:
-            self.__dict__[attr] = self.data.get(attr)
+        # cache it, in the slot when the type declares one
+        object.__setattr__(self, attr, value)
+        return value
 
-        else:
-            _attr = self.TYPE_MAP[attr]
-            if isinstance(_attr, tuple):
-                _type = self.TYPE_MAP[attr][0]
-                _value = self.TYPE_MAP[attr][1]
-            else:
-                _type = attr
-                _value = self.TYPE_MAP[attr]
+    def _parse(self, field, value):
+        mapping = self.TYPE_MAP.get(field)
+        if mapping is None or value is None:
+            return value
 
-            if isinstance(_value, type):
-                _data = self.data.get(attr)
-                _value = _value(self.client, _data)
+        return self._build(mapping[1], value)
 
-            self.__dict__[_type] = _value
+    def _build(self, _type, value):
+        if isinstance(value, list):
+            return [self._build(_type, x) for x in value]
+
+        return _type(self.client, value)
 
 
     def __str__(self):
-        d = ", ".join([f"{x}={self.__dict__[x]}" for x in self.__slots__ if x in self.__dict__])
+        d = ", ".join([f"{x}={getattr(self, x)}" for x in self.__slots__
+                       if self.FIELD_MAP.get(x, x) in self.data])
         t = str(type(self))[8:-2]
         return f'<{t}>: ({d})'
 
 
 class Event(MasterType):
 
-    __slots__ = ['message', 'update_id', 'chat', 'raw_event']
+    __slots__ = ['message', 'update_id', 'chat', 'author', 'raw_event', 'inline_query',
+                 'callback_query', 'query', 'args', 'album']
 
     def __init__(self, client, event):
         super().__init__(client, event)
 
-        self.chat = self.message.chat
+        # who the update is from and the chat it's about, whatever its kind
+        if self.message:
+            self.chat = self.message.chat
+            self.author = self.message.author
+
+        elif self.callback_query:
+            message = self.callback_query.message
+            self.chat = message.chat if message else None
+            self.author = self.callback_query.author
+
+        else:
+            self.chat = None
+            self.author = self.inline_query.author if self.inline_query else None
+
         self.raw_event = event
 
+    def snapshot(self):
+        """Returns the update as a plain, picklable dict."""
+        return self.raw_event.toDict()
+
 
 class Message(MasterType):
 
@@ -92,16 +95,22 @@ class Message(MasterType):
                  'venue', 'new_chat_member', 'left_chat_member', 'new_chat_title', 'new_chat_photo',
                  'delete_chat_photo', 'group_chat_created', 'supergroup_chat_created',
                  'channel_chat_created', 'migrate_to_chat_id', 'migrate_from_chat_id',
-                 'pinned_message', 'invoice', 'successful_payment']
+                 'pinned_message', 'invoice', 'successful_payment', 'reply_markup', 'media_group_id']
 
 
     def __init__(self, client, data):
         super().__init__(client, data)
 
-        self.entities = [MessageEntity(client, self.text, e) for e in self.data.entities]
+        self.entities = [MessageEntity(client, self.text or self.caption or "", e)
+                         for e in self.data.get('entities') or self.data.get('caption_entities') or []]
         self.id = self.message_id
 
 
+    @property
+    def largest_photo(self):
+        # photos come as a list of sizes, smallest first
+        return self.photo[-1] if self.photo else None
+
     # could this be a generator?
     def get_entities(self, t):
         return [x.text for x in self.entities if x.type == t]
@@ -140,11 +149,12 @@ class Chat(MasterType):
         # reply and reply_photo could probably be a single
         # method, with an if type()...I think
 
-        return await self.client.send_message(self.id, message)
+        return await self.client.send_message(self.id, message, **kwargs)
 
 
-    async def reply_photo(self, photo):
-        return await self.client.send_photo(self.id, photo)
+    async def reply_photo(self, photo, **kwargs):
+        # photo can be a file_id, url, bytes, a path or an AsyncFile
+        return await self.client.send_photo(self.id, photo, **kwargs)
 
 
 
@@ -158,10 +168,11 @@ class User(MasterType):
 
 class PhotoSize(MasterType):
 
-    __slots__ = ['id', 'width', 'height', 'file_size']
+    __slots__ = ['id', 'file_id', 'file_unique_id', 'width', 'height', 'file_size']
 
     def __init__(self, client, data):
         super().__init__(client, data)
+        self.id = self.file_id
 
 
 class Audio(MasterType):
@@ -263,6 +274,9 @@ class ReplyKeyboardMarkup(MasterType):
     def __init__(self, client, data):
         super().__init__(client, data)
 
+    def freeze(self):
+        return Markup(self.data)
+
 
 
 class KeyboardButton(MasterType):
@@ -289,6 +303,10 @@ class InlineKeyboardMarkup(MasterType):
     def __init__(self, client, data):
         super().__init__(client, data)
 
+    def freeze(self):
+        """Returns the keyboard as a Markup, eg. to send a received keyboard again."""
+        return Markup(self.data)
+
 
 class InlineKeyboardButton(MasterType):
 
@@ -301,12 +319,17 @@ class InlineKeyboardButton(MasterType):
 
 class CallbackQuery(MasterType):
 
-    __slots__ = ['id', 'from', 'message', 'inline_message_id', 'chat_instance',
-                 'data', 'game_short_name']
+    # the button's callback_data is `payload`, `data` being the raw query
+    __slots__ = ['id', 'author', 'message', 'inline_message_id', 'chat_instance',
+                 'payload', 'game_short_name', 'answered']
 
     def __init__(self, client, data):
         super().__init__(client, data)
 
+    async def answer(self, text=None, **kwargs):
+        self.answered = True
+        return await self.client.answer_callback_query(self.id, text=text, **kwargs)
+
 
 class ForcedReply(MasterType):
 
@@ -316,6 +339,17 @@ class ForcedReply(MasterType):
         super().__init__(client, data)
 
 
+class InlineQuery(MasterType):
+
+    __slots__ = ['id', 'author', 'query', 'offset', 'chat_type', 'location']
+
+    def __init__(self, client, data):
+        super().__init__(client, data)
+
+    async def answer(self, results, **kwargs):
+        return await self.client.answer_inline_query(self.id, results, **kwargs)
+
+
 class ChatPhoto(MasterType):
 
     __slots__ = ['small_file_id', 'big_file_id']
@@ -352,3 +386,50 @@ class InputFile(MasterType):
         super().__init__(client, data)
 
 
+def _type_map(**overrides):
+    type_map = {
+        'message':              ('message', Message),
+        'inline_query':         ('inline_query', InlineQuery),
+        'callback_query':       ('callback_query', CallbackQuery),
+        'reply_markup':         ('reply_markup', InlineKeyboardMarkup),
+        'inline_keyboard':      ('inline_keyboard', InlineKeyboardButton),
+        'keyboard':             ('keyboard', KeyboardButton),
+        'from':                 ('author', User),
+        'user':                 ('user', User),
+        'chat':                 ('chat', Chat),
+        'forward_from':         ('forward_from', User),
+        'forward_from_chat':    ('forward_from_chat', Chat),
+        'reply_to_message':     ('reply_to', Message),
+        'audio':                ('audio', Audio),
+        'document':             ('document', Document),
+        'game':                 ('game', Game),
+        'photo':                ('photo', PhotoSize),
+        'photos':               ('photos', PhotoSize),
+        'thumb':                ('thumb', PhotoSize),
+        'sticker':              None,
+        'video':                ('video', Video),
+        'voice':                ('voice', Voice),
+        'video_note':           ('video_note', VideoNote),
+        'new_chat_members':     ('new_chat_members', User),
+        'contact':              ('contact', Contact),
+        'location':             ('location', Location),
+        'venue':                ('venue', Venue),
+        'new_chat_member':      ('new_chat_member', User),
+        'left_chat_member':     ('left_chat_member', User),
+        'new_chat_photo':       ('new_chat_photo', PhotoSize),
+        'pinned_message':       ('pinned_message', Message),
+        'invoice':              None,
+        'successful_payment':   None
+    }
+
+    type_map.update(overrides)
+    return type_map
+
+
+MasterType.TYPE_MAP = _type_map()
+MasterType.FIELD_MAP = {v[0]: k for k, v in MasterType.TYPE_MAP.items() if v and v[0] != k}
+
+# a chat's photo is a ChatPhoto, not a list of sizes
+Chat.TYPE_MAP = _type_map(photo=('photo', ChatPhoto))
+
+CallbackQuery.FIELD_MAP = {**MasterType.FIELD_MAP, 'payload': 'data'}
@@ -1,16 +1,30 @@
-import threading
-import requests
-import json
 import time
-import urllib.parse
+import signal
+import os
+import importlib
+import inspect
+import concurrent.futures
+from collections import Counter
 from dotmap import DotMap
 
 from models.types import Event, Message
-from models.errors import APIError
+from models import endpoints as api
+from models.keyboards import SEPARATOR
+from models.errors import APIError, RequestError
+from utilities.log import get_logger
+from utilities import metrics
+from utilities.files import AsyncFile, StaticFileCache
+from utilities.polling import PollController, PollStalled, MAX_SLOT_TIMEOUT
 import asyncio
 import aiohttp
-import traceback
-from pprint import pprint
+
+# optional features (profiling, durable offsets, downloads, coalescing, inline
+# queries) import their modules when they're first used, to keep startup fast
+
+
+log = get_logger()
+
+API_URL = "https://api.telegram.org"
 
 
 class UpdateManager():
@@ -18,41 +32,160 @@ class UpdateManager():
     def __init__(self, **kwargs):
         self.loop = asyncio.get_event_loop()
 
-        self.session = kwargs.get("session")
+        # polls use `session`, or the one get_session() returns once polling starts
+        self._session = kwargs.get("session")
+        self.get_session = kwargs.get("get_session")
         self.token = kwargs.get("token")
         self.callback = kwargs.get("callback")
+        self.tracker = kwargs.get("tracker")
+
+        # a semaphore shared by bots that take turns polling, see utilities/host.py
+        self.poll_slots = kwargs.get("poll_slots")
+
+        # how long polls wait and what happens when they fail, see utilities/polling.py
+        self.poll_timeout = kwargs.get("poll_timeout", 100)
+        self.controller = kwargs.get("poll_controller") or PollController(max_timeout=self.poll_timeout)
 
-        self.poll_timeout = 100
+        if self.poll_slots and self.controller.max_timeout > MAX_SLOT_TIMEOUT:
+            # a quiet bot would keep its slot, and the bots queued behind it, for the whole poll
+            log.warning("Poll timeout lowered to %ss, the most a bot sharing poll slots may wait",
+                        MAX_SLOT_TIMEOUT)
+            self.poll_timeout = MAX_SLOT_TIMEOUT
+            self.controller.max_timeout = MAX_SLOT_TIMEOUT
+            self.controller.min_timeout = min(self.controller.min_timeout, MAX_SLOT_TIMEOUT)
+            self.controller.timeout = min(self.controller.timeout, MAX_SLOT_TIMEOUT)
 
-        self.URL = f"https://api.telegram.org/bot{self.token}/"
+        self.URL = f"{kwargs.get('api_url', API_URL)}/bot{self.token}/"
 
         self.last_update = None
         self.command_queue = []
 
+        # a session of our own, opened after a poll stalled
+        self._fresh_session = None
+
+
+    @property
+    def session(self):
+        return self._fresh_session or self._session or self.get_session()
+
 
     async def update_loop(self):
-        print("Starting Poll Update Loop")
+        log.info("Starting poll update loop")
+
+        if self.tracker:
+            self.last_update, pending = self.tracker.load()
+            self.tracker.start()
+
+            if pending:
+                self.command_queue.extend(pending)
+
+                try:
+                    await self.callback()
+                except Exception:
+                    # a replayed update that can't be dispatched mustn't stop polling
+                    log.exception("Dispatching replayed updates failed")
 
         while True:
-            await self.poll_updates(self.last_update)
+            if self.tracker:
+                # accepted updates must be journaled before the next poll confirms them
+                try:
+                    await self.tracker.flush()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    # eg. a locked database, the poll waits until the journal is written
+                    delay = self.controller.failed(e)
+                    log.warning("Committing offsets failed (%r), retrying in %.1fs", e, delay)
+
+                    await asyncio.sleep(delay)
+                    self.controller.trial()
+                    continue
+
+            try:
+                await self.poll_updates(self.last_update)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                metrics.POLL_ERRORS.inc()
+                delay = self.controller.failed(e)
+                log.warning("Poll failed (%r), retrying in %.1fs", e, delay)
+
+                if isinstance(e, PollStalled):
+                    await self.reconnect()
+
+                await asyncio.sleep(delay)
+                self.controller.trial()
 
 
     async def poll_updates(self, offset=None):
-
-        url = f"{self.URL}getUpdates?timeout={self.poll_timeout}"
+        controller = self.controller
+        url = f"{self.URL}getUpdates?timeout={controller.timeout}&limit={controller.limit}"
 
         if offset:
             url += f"&offset={offset}"
 
-        async with self.session.get(url) as resp:
-            data = await resp.json()
-            result = data['result']
+        start = time.monotonic()
+
+        if self.poll_slots:
+            async with self.poll_slots:
+                data = await self._get_updates(url, controller.deadline)
+        else:
+            data = await self._get_updates(url, controller.deadline)
+
+        metrics.POLL_DURATION.observe(time.monotonic() - start)
+
+        if not data.get("ok"):
+            raise APIError(data)
+
+        result = data['result']
+        metrics.POLL_BATCH_SIZE.observe(len(result))
+        controller.succeeded(len(result))
+
+        if result:
+            self.last_update = max(x["update_id"] for x in result) + 1
+
+            if self.tracker:
+                result = self.tracker.accept(result, self.last_update)
 
-            if result:
-                self.command_queue.extend(result)
-                self.last_update = max(x["update_id"] for x in result) + 1
-                print(f"Poll Successful: {self.last_update}")
+            self.command_queue.extend(result)
+            metrics.QUEUE_DEPTH.set(len(self.command_queue))
+            log.debug("Poll successful, %d updates, next offset %s", len(result),
+                      self.last_update, extra={"sampled": True})
+
+            try:
                 await self.callback()
+            except Exception:
+                # a dispatch bug shouldn't stop polling
+                log.exception("Dispatching updates failed")
+
+
+    async def _get_updates(self, url, deadline):
+        # cancelling the request on the deadline drops its connection rather than reusing it
+        try:
+            return await asyncio.wait_for(self._request(url), deadline)
+        except asyncio.TimeoutError:
+            raise PollStalled(f"no answer in {deadline}s")
+
+    async def _request(self, url):
+        async with self.session.get(url) as resp:
+            return await resp.json()
+
+
+    async def reconnect(self):
+        """Moves polling to a new session, so no connection of the one that
+        stalled is reused. Sessions passed in are left to their owner.
+        """
+
+        old, self._fresh_session = self._fresh_session, aiohttp.ClientSession(loop=self.loop)
+
+        if old:
+            await old.close()
+
+
+    async def close(self):
+        if self._fresh_session:
+            await self._fresh_session.close()
+            self._fresh_session = None
 
 
 
@@ -60,50 +193,485 @@ class NatsukoClient():
 
     def __init__(self, token, **kwargs):
         self.token = token
-        self.API_URL = f"https://api.telegram.org/bot{self.token}/"
+        self.name = kwargs.get("name") or token.split(":")[0]
+        self.BASE_URL = kwargs.get("api_url", API_URL)
+        self.API_URL = f"{self.BASE_URL}/bot{self.token}/"
+
+        # method -> url, built once for every endpoint in models/endpoints.py
+        self.endpoint_urls = {method: self.API_URL + method for method in api.ENDPOINTS}
 
         self.commands = {}
+        self.step_handlers = {}
+        self.inline_handlers = {}
+        self.callback_handlers = {}
         self.usercache = {}
 
+        # optional local /metrics endpoint, eg. NatsukoClient(token, metrics_port=9464)
+        self.metrics_server = None
+        if kwargs.get("metrics_port"):
+            self.metrics_server = metrics.MetricsServer(host=kwargs.get("metrics_host", "127.0.0.1"),
+                                                        port=kwargs["metrics_port"])
+
+        # pools for handlers registered with executor="thread"/"process",
+        # created on first use and shut down when run() returns
+        self.thread_workers = kwargs.get("thread_workers")
+        self.process_workers = kwargs.get("process_workers")
+        self.mp_context = kwargs.get("mp_context")
+        self._thread_pool = None
+        self._process_pool = None
+
+        # pools owned by someone else (eg. a BotHost), used instead of our own and never shut down here
+        self._shared_pools = {"thread": kwargs.get("thread_pool"), "process": kwargs.get("process_pool")}
+
+        # outgoing API calls per second, None for no limit
+        self.rate_limit = kwargs.get("rate_limit")
+        self._next_call = 0
+
+        # what this bot used so far, see resource_usage()
+        self.usage = Counter()
+
+        # opt-in handler profiling, see utilities/profiler.py
+        self.profiler = None
+        if kwargs.get("profile"):
+            from utilities.profiler import HandlerProfiler
+            self.profiler = HandlerProfiler(sample_rate=kwargs.get("profile_sample_rate", 0.01),
+                                            block_threshold=kwargs.get("block_threshold", 0.1))
+
+        # durable offsets, eg. NatsukoClient(token, offset_store=SQLiteOffsetStore("natsuko.db"))
+        self.tracker = None
+        if kwargs.get("offset_store"):
+            from utilities.offsets import OffsetTracker
+            self.tracker = OffsetTracker(kwargs["offset_store"],
+                                         commit_interval=kwargs.get("commit_interval", 1.0))
+
+        # file downloads, media_cache is an optional utilities.downloads.MediaCache
+        self.media_cache = kwargs.get("media_cache")
+        self.download_concurrency = kwargs.get("download_concurrency", 4)
+        self._downloader = None
+
+        # lifecycle: running handler tasks, coroutines to run on shutdown and
+        # the modules loaded with load_module()
+        self.shutdown_timeout = kwargs.get("shutdown_timeout", 30)
+        self.modules = {}
+        self._tasks = set()
+        self._shutdown_hooks = []
+        self._stopping = None
+        self._poll_task = None
+        self._started = False
+
+        # opt-in merging of consecutive sends and debouncing of edits, see utilities/coalesce.py;
+        # with it, send_message and edit_message_text return a Pending handle to await for the result
+        self.coalescer = None
+        if kwargs.get("coalesce"):
+            from utilities.coalesce import OutboundCoalescer
+            self.coalescer = OutboundCoalescer(self, send_window=kwargs.get("coalesce_window", 0.05),
+                                               edit_window=kwargs.get("edit_debounce", 0.5))
+            self.on_shutdown(self.coalescer.flush)
+
+        # contents of static files sent by path, see static_file()
+        self.static_files = StaticFileCache(max_bytes=kwargs.get("static_cache_size", 64 * 1024 ** 2))
+
+        # per-chat conversation state (utilities.state.StateStore), exposed as event.state
+        self.state_store = kwargs.get("state_store")
+        if self.state_store:
+            self.on_shutdown(self.state_store.close)
+
+        # per-user/chat throttling and load shedding of incoming updates,
+        # see utilities/admission.py
+        self.admission = kwargs.get("admission")
+        if self.admission:
+            self.on_shutdown(self.admission.close)
+
+        # delayed and recurring API calls, see utilities/scheduler.py and the scheduler property
+        self.job_store = kwargs.get("job_store")
+        self._scheduler = None
+
+        # albums dispatched as one event, see utilities/albums.py
+        self.albums = None
+        if kwargs.get("media_groups"):
+            from utilities.albums import MediaGroupCollector
+            self.albums = MediaGroupCollector(self._dispatch_album, window=kwargs.get("media_group_window", 0.5))
+
+        # every received message, written in batches to SQLite (utilities.archive.MessageArchive)
+        self.archive = kwargs.get("archive")
+        if self.archive:
+            self.on_shutdown(self.archive.close)
+
+        # inline queries: a user's query is only answered if they haven't typed
+        # another one within `inline_debounce` seconds
+        self.inline_debounce = kwargs.get("inline_debounce", 0.3)
+        self._latest_inline = {}
+
         self.loop = asyncio.get_event_loop()
-        self.session = aiohttp.ClientSession(loop=self.loop)
-        self.manager = UpdateManager(token=self.token, session=self.session, callback=self.process)
+
+        # the session is opened when the client starts (or is first used), not here;
+        # a session passed in is shared with other bots and left open on shutdown
+        self._own_session = kwargs.get("session") is None
+        self._session = kwargs.get("session")
+        self.manager = UpdateManager(token=self.token, session=kwargs.get("poll_session"),
+                                     get_session=lambda: self.session,
+                                     callback=self.process, tracker=self.tracker, api_url=self.BASE_URL,
+                                     poll_timeout=kwargs.get("poll_timeout", 100),
+                                     poll_controller=kwargs.get("poll_controller"),
+                                     poll_slots=kwargs.get("poll_slots"))
+
+
+    def _open_session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(loop=self.loop)
+
+        return self._session
+
+
+    @property
+    def session(self):
+        return self._open_session()
+
+
+    @property
+    def scheduler(self):
+        """The JobScheduler of this client, created on first use. Persistent
+        when the client was given a job_store (eg. SQLiteJobStore("jobs.db")).
+        """
+
+        if self._scheduler is None:
+            from utilities.scheduler import JobScheduler
+            self._scheduler = JobScheduler(self, store=self.job_store)
+            self.on_shutdown(self._scheduler.close)
+
+            if self._started:
+                self._scheduler.start()
+
+        return self._scheduler
 
 
     def run(self):
 
-        self.loop.run_until_complete(self._run())
+        # SIGINT/SIGTERM shut down gracefully, SIGHUP reloads the handler modules
+        for sig, callback in ((signal.SIGINT, self.stop), (signal.SIGTERM, self.stop),
+                              (getattr(signal, "SIGHUP", None), self.reload_modules)):
+            try:
+                self.loop.add_signal_handler(sig, callback)
+            except (NotImplementedError, AttributeError, TypeError, RuntimeError):
+                pass
+
+        try:
+            self.loop.run_until_complete(self._run())
+        finally:
+            self.loop.run_until_complete(self.shutdown())
+
+
+    def stop(self):
+        """Asks a running client to shut down, see shutdown()."""
+
+        log.info("Stopping")
+        if self._stopping:
+            self._stopping.set()
+
+
+    def on_shutdown(self, coro_func):
+        """Registers a coroutine function to await during shutdown, after the
+        handlers finished and before the session is closed.
+        """
+
+        self._shutdown_hooks.append(coro_func)
+        return coro_func
+
+
+    async def shutdown(self, timeout=None):
+        """Stops polling, dispatches what was already received, waits up to
+        `timeout` seconds for running handlers, then runs the shutdown hooks,
+        commits the offsets and closes the session.
+        """
+
+        timeout = self.shutdown_timeout if timeout is None else timeout
+
+        if self._poll_task:
+            self._poll_task.cancel()
+            await asyncio.gather(self._poll_task, return_exceptions=True)
+            self._poll_task = None
+
+        if self.manager.command_queue:
+            await self.process()
+
+        if self.albums:
+            self.albums.release_all()
+
+        if self._tasks:
+            log.info("Waiting for %d running handlers", len(self._tasks))
+            done, pending = await asyncio.wait(list(self._tasks), timeout=timeout)
+
+            for task in pending:
+                task.cancel()
+
+            if pending:
+                log.warning("Cancelled %d handlers still running after %ss", len(pending), timeout)
+                await asyncio.gather(*pending, return_exceptions=True)
+
+        for hook in self._shutdown_hooks:
+            try:
+                await hook()
+            except Exception:
+                log.exception("Shutdown hook %s failed", hook)
+
+        if self.tracker:
+            await self.tracker.close()
+
+        await self.manager.close()
+
+        if self.profiler:
+            self.profiler.stop()
+
+        if self.metrics_server:
+            await self.metrics_server.stop()
+
+        self.shutdown_executors()
+
+        if self._own_session and self._session and not self._session.closed:
+            await self._session.close()
+
+        log.info("Shut down")
+
 
     async def _run(self):
+        self._stopping = asyncio.Event()
+        self._open_session()
 
-        task = asyncio.ensure_future(self.manager.update_loop())
-        await task
+        if self.metrics_server:
+            await self.metrics_server.start()
+            log.info("Serving metrics on %s:%s", self.metrics_server.host, self.metrics_server.port)
 
+        self._start_services()
 
-    async def process(self):
-        print(f"Callback Called: {self}")
+        self._poll_task = asyncio.ensure_future(self.manager.update_loop())
+        stopping = asyncio.ensure_future(self._stopping.wait())
+
+        # returns on stop(), or re-raises if the poller died
+        await asyncio.wait([self._poll_task, stopping], return_when=asyncio.FIRST_COMPLETED)
+        stopping.cancel()
+
+        if self._poll_task.done() and not self._poll_task.cancelled():
+            self._poll_task.result()
+
+
+    def _start_services(self):
+        """Starts what runs alongside dispatch (state, archive, admission, jobs,
+        profiler), in any process that dispatches, eg. a cluster worker.
+        """
+
+        self._started = True
+
+        if self.state_store:
+            self.state_store.start()
+
+        if self.archive:
+            self.archive.start()
 
+        if self.admission:
+            self.admission.start()
+
+        # saved jobs resume as soon as the client starts
+        if self.job_store or self._scheduler:
+            self.scheduler.start()
+
+        if self.profiler:
+            self.profiler.start(self.loop)
+
+            # `kill -USR1 <pid>` dumps the top offenders
+            try:
+                self.loop.add_signal_handler(signal.SIGUSR1, self.dump_profile)
+            except (NotImplementedError, AttributeError):
+                pass
+
+
+    def _handler_tables(self):
+        return [self.commands, self.step_handlers, self.inline_handlers, self.callback_handlers]
+
+
+    def load_module(self, name):
+        """Imports a handler module and calls its `setup(client)` function, which
+        registers its handlers. Modules loaded this way can be reloaded in place.
+        """
+
+        module = importlib.import_module(name)
+        module.setup(self)
+        self.modules[name] = module
+
+        return module
+
+
+    def _remove_module_handlers(self, module_name):
+        removed = []
+
+        for table in self._handler_tables():
+            for key, entry in list(table.items()):
+                if getattr(entry["function"], "__module__", None) == module_name:
+                    removed.append((table, key, table.pop(key)))
+
+        return removed
+
+
+    def reload_module(self, name):
+        """Re-imports a module loaded with load_module() and swaps its handlers
+        for the new ones. Handlers already running finish with the old code, and
+        if the new code fails to load the old handlers stay in place.
+        """
+
+        module = self.modules[name]
+        old = self._remove_module_handlers(module.__name__)
+
+        try:
+            module = importlib.reload(module)
+            module.setup(self)
+
+        except Exception:
+            log.exception("Reloading %s failed, keeping the old handlers", name)
+            self._remove_module_handlers(module.__name__)
+            for table, key, entry in old:
+                table[key] = entry
+            raise
+
+        self.modules[name] = module
+        log.info("Reloaded %s", name)
+
+        return module
+
+
+    def reload_modules(self):
+        for name in list(self.modules):
+            try:
+                self.reload_module(name)
+            except Exception:
+                pass
+
+
+    async def process(self):
         while self.manager.command_queue:
-            _cmd = DotMap(self.manager.command_queue.pop(0))
-            command = Event(self, _cmd)
-            self.parse_command(command)
+            update = self.manager.command_queue.pop(0)
+            if self.archive:
+                self.archive.add(update)
+
+            metrics.QUEUE_DEPTH.set(len(self.manager.command_queue))
+
+            backlog = len(self.manager.command_queue) + len(self._tasks)
+            if self.admission and not self.admission.admit(update, backlog):
+                self.usage["updates_shed"] += 1
+                if self.tracker:
+                    self.tracker.done(update["update_id"])
+
+                callback_query = update.get("callback_query")
+                if callback_query:
+                    # or the button keeps spinning until the client gives up
+                    self._spawn(self._answer_shed(callback_query["id"]))
+                continue
+
+            metrics.UPDATES.inc()
+            self.usage["updates"] += 1
+
+            if self.albums:
+                key = self.albums.group_of(update)
+                if key:
+                    # dispatched with the rest of the album, see _dispatch_album()
+                    self.albums.add(key, update)
+                    continue
+
+            try:
+                command = Event(self, DotMap(update))
+
+                log.debug("Processing update", extra={"sampled": True, "update_id": command.update_id,
+                                                      "chat_id": command.chat.id if command.chat else None})
+                tasks = self.parse_command(command)
+            except Exception:
+                # a poison update is dropped, replaying it would only fail again
+                log.exception("Dropping update %s, it couldn't be dispatched", update.get("update_id"))
+                self.usage["updates_dropped"] += 1
+                if self.tracker:
+                    self.tracker.done(update.get("update_id"))
+                continue
+
+            if self.tracker:
+                self._track(command.update_id, tasks)
+
+
+    def _dispatch_album(self, updates):
+        # one event for the whole album: its message is the captioned item (where
+        # a command would be), event.album has every item's Message in order
+        main = next((i for i, update in enumerate(updates) if update["message"].get("caption")), 0)
+
+        try:
+            command = Event(self, DotMap(updates[main]))
+            command.album = [command.message if i == main else Message(self, DotMap(update["message"]))
+                             for i, update in enumerate(updates)]
+
+            log.debug("Processing album", extra={"sampled": True, "update_id": command.update_id,
+                                                 "chat_id": command.chat.id, "items": len(updates)})
+            tasks = self.parse_command(command)
+        except Exception:
+            # like a poison update in process(), the whole album is dropped
+            log.exception("Dropping album of updates %s, it couldn't be dispatched",
+                          [update.get("update_id") for update in updates])
+            self.usage["updates_dropped"] += len(updates)
+            tasks = []
+
+        if self.tracker:
+            for update in updates:
+                self._track(update["update_id"], tasks)
+
+
+    def _track(self, update_id, tasks):
+        # the update is done once every handler it started has finished
+        if not tasks:
+            self.tracker.done(update_id)
+            return
+
+        def finished(_):
+            # handlers cancelled by a shutdown didn't finish, replay them next time
+            if not any(task.cancelled() for task in tasks):
+                self.tracker.done(update_id)
+
+        asyncio.gather(*tasks, return_exceptions=True).add_done_callback(finished)
 
 
     def parse_command(self, event):
+        tasks = []
+
+        if event.inline_query:
+            if self.inline_handlers:
+                tasks.append(self._spawn(self._run_inline_handler(event)))
+            return tasks
+
+        if event.callback_query:
+            # callback_data is "route:arg:arg", see models/keyboards.py
+            route, *event.args = (event.callback_query.payload or "").split(SEPARATOR)
+            command = self.callback_handlers.get(route)
+
+            if command:
+                tasks.append(self._spawn(self._run_callback_handler(route, command, event)))
+            return tasks
+
+        if not event.message:
+            return tasks
 
         for entity in event.message.entities:
             if entity.is_command:
                 command = entity.text[1:]
-                print(f"Identified as Bot Command: {entity}")
+                log.debug("Identified bot command %s", command,
+                          extra={"sampled": True, "update_id": event.update_id,
+                                 "chat_id": event.chat.id})
 
                 if command in self.commands:
-                    func = self.commands[command]["function"]
-                    asyncio.ensure_future(func(event))
+                    tasks.append(self._spawn(self._run_handler(command, self.commands[command], event)))
+
+        if not tasks and self.step_handlers and self.state_store:
+            # plain messages go to the handler of the conversation step the chat is in
+            tasks.append(self._spawn(self._run_step_handler(event)))
 
         user = event.message.author
         if not user.username in self.usercache:
             self.usercache[user.username] = user
 
+        return tasks
+
         #
         # not sure that any of this shit is necessary
         #
@@ -121,31 +689,426 @@ class NatsukoClient():
 
 
 
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+        return task
+
+
+    async def _run_step_handler(self, event):
+        if self.state_store.key(event) is None:
+            return
+
+        async with self.state_store.session(event) as state:
+            command = self.step_handlers.get(state.step)
+
+            if command:
+                event.state = state
+                await self._run_handler(f"step:{state.step}", command, event, locked=True)
+
+
+    async def _run_handler(self, name, command, event, locked=False):
+        if self.state_store and not locked:
+            if self.state_store.key(event) is None:
+                # nothing to key a state on, the handler runs without one
+                event.state = None
+            else:
+                # holding the chat's lock keeps its handlers in arrival order
+                async with self.state_store.session(event) as state:
+                    event.state = state
+                    return await self._run_handler(name, command, event, locked=True)
+
+        start = time.monotonic()
+        metrics.HANDLERS_RUNNING.inc()
+
+        try:
+            coro = self._call_handler(command, event)
+            if self.profiler:
+                coro = self.profiler.wrap(name, coro)
+
+            await coro
+        except Exception:
+            metrics.HANDLER_ERRORS.labels(name).inc()
+            self.usage["handler_errors"] += 1
+            if not command["no_error"]:
+                log.exception("Handler for %s failed", name,
+                              extra={"update_id": event.update_id,
+                                     "chat_id": event.chat.id if event.chat else None})
+        finally:
+            metrics.HANDLERS_RUNNING.dec()
+            metrics.HANDLER_DURATION.labels(name).observe(time.monotonic() - start)
+            self.usage["handlers"] += 1
+            self.usage["handler_seconds"] += time.monotonic() - start
+
+
+    async def _run_callback_handler(self, route, command, event):
+        await self._run_handler(f"callback:{route}", command, event)
+
+        # stop the button's loading spinner if the handler didn't answer
+        if command["auto_answer"] and not event.callback_query.answered:
+            try:
+                await event.callback_query.answer()
+            except APIError:
+                log.debug("Answering callback query failed", exc_info=True)
+
+
+    async def _answer_shed(self, callback_query_id):
+        try:
+            await self.answer_callback_query(callback_query_id)
+        except APIError:
+            log.debug("Answering shed callback query failed", exc_info=True)
+
+
+    async def _run_inline_handler(self, event):
+        from utilities.inline import normalize_query
+
+        query = event.inline_query
+        user_id = query.author.id if query.author else None
+        self._latest_inline[user_id] = query.id
+
+        try:
+            if self.inline_debounce:
+                await asyncio.sleep(self.inline_debounce)
+
+            if self._latest_inline.get(user_id) != query.id:
+                # the user kept typing, only their latest query gets an answer
+                self.usage["inline_superseded"] += 1
+                return
+
+            # the longest matching prefix wins, "" catches everything
+            text = normalize_query(query.query)
+            for prefix in sorted(self.inline_handlers, key=len, reverse=True):
+                if text == prefix or text.startswith(prefix + " ") or not prefix:
+                    event.query = text[len(prefix):].strip()
+                    await self._run_handler(f"inline:{prefix}", self.inline_handlers[prefix], event, locked=True)
+                    return
+        finally:
+            if self._latest_inline.get(user_id) == query.id:
+                del self._latest_inline[user_id]
+
+
+    async def _answer_inline(self, command, event):
+        from utilities.inline import parse_offset
+
+        query = event.inline_query
+        key = (event.query, query.author.id if command["personal"] and query.author else None)
+        offset = parse_offset(query.offset)
+
+        results, next_offset = await command["cache"].page(
+            key, lambda: self._inline_results(command, event), offset, command["page_size"])
+
+        if self._latest_inline.get(query.author.id if query.author else None) != query.id:
+            # superseded while the results were being built
+            self.usage["inline_superseded"] += 1
+            return
+
+        return await self.answer_inline_query(query.id, results, next_offset=next_offset,
+                                              cache_time=command["cache_time"],
+                                              is_personal=command["personal"] or None)
+
+
+    def _inline_results(self, command, event):
+        func = command["function"]
+
+        # generators (sync or async) are advanced page by page by the cache
+        if inspect.isgeneratorfunction(func) or inspect.isasyncgenfunction(func):
+            return func(event)
+
+        if asyncio.iscoroutinefunction(func):
+            return func(event)
+
+        return self.loop.run_in_executor(self.get_executor("thread"), func, event)
+
+
+    async def _call_handler(self, command, event):
+        func = command["function"]
+        executor = command["executor"]
+
+        if executor == "inline":
+            return await self._answer_inline(command, event)
+
+        if executor == "process":
+            # the client can't cross the process boundary, so process handlers get
+            # the raw update dict and hand their (picklable) result to the callback
+            result = await self.loop.run_in_executor(self.get_executor("process"), func, event.snapshot())
+
+        elif executor == "thread":
+            result = await self.loop.run_in_executor(self.get_executor("thread"), func, event)
+
+        else:
+            return await func(event)
+
+        if command["callback"]:
+            await command["callback"](event, result)
+
+        return result
+
+
+    def get_executor(self, kind):
+        """Returns the client's "thread" or "process" pool, creating it if needed."""
+
+        if self._shared_pools.get(kind):
+            return self._shared_pools[kind]
+
+        if kind == "thread":
+            if self._thread_pool is None:
+                self._thread_pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.thread_workers, thread_name_prefix="natsuko-handler")
+            return self._thread_pool
+
+        if kind == "process":
+            if self._process_pool is None:
+                self._process_pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.process_workers, mp_context=self.mp_context)
+            return self._process_pool
+
+        raise ValueError(f"Unknown executor: {kind}")
+
+
+    def shutdown_executors(self, wait=True):
+        for pool in (self._thread_pool, self._process_pool):
+            if pool is not None:
+                pool.shutdown(wait=wait)
+
+        self._thread_pool = None
+        self._process_pool = None
+
+
+    def resource_usage(self):
+        """Returns what the bot used since it started: updates, handler runs,
+        errors and seconds, API calls, plus what it's holding right now.
+        """
+
+        return {**self.usage,
+                "running_handlers": len(self._tasks),
+                "queued_updates": len(self.manager.command_queue),
+                "offset": self.manager.last_update,
+                "static_cache_bytes": self.static_files.size}
+
+
+    def dump_profile(self, limit=10):
+        if not self.profiler:
+            return None
+
+        report = self.profiler.report(limit)
+        log.warning("Profile report:\n%s", report)
+        return report
+
+
+    def _make_handler(self, f, options):
+        """Builds the handler entry shared by the decorators.
+
+        Options         Description
+        no_error        Don't log exceptions raised by the handler
+        executor        None to run on the event loop, "thread" to run a sync handler in
+                        the client's ThreadPoolExecutor or "process" to run it in the
+                        ProcessPoolExecutor (it then receives `event.snapshot()`)
+        callback        Coroutine called with (event, result) after an executor handler
+        """
+
+        executor = options.get("executor")
+
+        if executor is None and not asyncio.iscoroutinefunction(f):
+            # plain functions would block the loop, so they always go to a thread
+            executor = "thread"
+
+        if executor not in (None, "thread", "process"):
+            raise ValueError(f"Unknown executor for {f.__name__}: {executor}")
+
+        if executor and asyncio.iscoroutinefunction(f):
+            raise ValueError(f"{f.__name__} is a coroutine function, executor handlers must be sync")
+
+        return {"function": f,
+                "no_error": options.get("no_error", False),
+                "executor": executor,
+                "callback": options.get("callback")}
+
+
     # Command Decorator
     def command(self, name, **options):
 
         def deco(f):
-            command = {"function": f}
-            command["no_error"] = False if "no_error" not in options else options["no_error"]
+            command = self._make_handler(f, options)
 
             self.commands[name] = command
-            print(f'\tLOAD_OK: {f.__name__}: on_command @ {name}')
+            log.info("LOAD_OK: %s: on_command @ %s", f.__name__, name)
+
+            return f
+
+        return deco
+
+
+    def on_step(self, step, **options):
+        """Registers a handler for messages from chats whose `event.state.step`
+        is `step`, to build multi-step conversations. Needs a state_store.
+        Takes the same options as command().
+        """
+
+        def deco(f):
+            self.step_handlers[step] = self._make_handler(f, options)
+            log.info("LOAD_OK: %s: on_step @ %s", f.__name__, step)
 
             return f
 
         return deco
 
 
-    async def _api_send(self, url, apiq):
-        print(f"APISEND: {apiq}")
+    def callback(self, route, **options):
+        """Registers a handler for inline keyboard buttons whose callback_data
+        is `route`, or starts with "route:" (see models.keyboards.callback_data).
+        The rest of the payload is split into `event.args`. The query is
+        answered after the handler unless it did so itself, or auto_answer=False.
+        Takes the same options as command().
+        """
+
+        def deco(f):
+            command = self._make_handler(f, options)
+            command["auto_answer"] = options.get("auto_answer", True)
+
+            self.callback_handlers[route] = command
+            log.info("LOAD_OK: %s: on_callback @ %s", f.__name__, route)
+
+            return f
+
+        return deco
+
+
+    def inline(self, prefix="", **options):
+        """Registers a handler for inline queries starting with `prefix` (every
+        query by default). The handler gets the event, with the normalized query
+        text minus the prefix in `event.query`, and returns the results: a list,
+        or a sync/async generator that is only advanced as far as the user
+        scrolls. Results without an "id" are numbered.
+
+        Result sets are cached by normalized query, so handlers should only
+        depend on `event.query` (or set personal=True).
+
+        Options         Description
+        cache_size      Result sets kept, least recently used go first (1000)
+        cache_ttl       Seconds a result set is reused for (300)
+        page_size       Results per answer, at most 50 (50)
+        personal        Cache per user, and ask Telegram to do the same (False)
+        cache_time      Seconds Telegram may cache the answer for (300)
+        no_error        Don't log exceptions raised by the handler
+        """
+
+        from utilities.inline import InlineResultCache, MAX_PAGE_SIZE, normalize_query
+
+        def deco(f):
+            self.inline_handlers[normalize_query(prefix)] = {
+                "function": f,
+                "no_error": options.get("no_error", False),
+                "executor": "inline",
+                "callback": None,
+                "cache": InlineResultCache(max_entries=options.get("cache_size", 1000),
+                                           ttl=options.get("cache_ttl", 300)),
+                "page_size": min(options.get("page_size", MAX_PAGE_SIZE), MAX_PAGE_SIZE),
+                "personal": options.get("personal", False),
+                "cache_time": options.get("cache_time", 300)}
+
+            log.info("LOAD_OK: %s: on_inline @ %r", f.__name__, prefix)
+            return f
+
+        return deco
+
+
+    async def _call(self, endpoint, **args):
+        """Validates a call against its Endpoint and sends it, as a multipart
+        upload when one of its parameters is a file.
+        """
+
+        params, files = endpoint.prepare(args)
+        url = self.endpoint_urls[endpoint.method]
+
+        if self.rate_limit:
+            await self._pace()
+
+        if files:
+            return await self._api_post(url, params, files, endpoint.result_type)
+
+        return await self._api_send(url, params, endpoint.result_type)
+
+
+    async def _pace(self):
+        # calls get evenly spaced slots, however many are waiting
+        now = time.monotonic()
+        slot = max(now, self._next_call)
+        self._next_call = slot + 1 / self.rate_limit
+
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+    async def _api_send(self, url, apiq, result_type=None):
+        """Calls the API and returns its result, as a `result_type` (eg. Message)
+        when the result is an object or a list of them.
+        """
+
+        start = time.monotonic()
 
         async with self.session.get(url, params=apiq) as resp:
             content = await resp.json()
 
-            if not content["ok"]:
-                raise APIError(content)
+        return self._api_result(url, apiq, content, start, result_type)
+
+
+    async def _api_post(self, url, apiq, files, result_type=None):
+        """Multipart upload of `files` (field -> bytes, file object, path or AsyncFile),
+        otherwise like _api_send. Paths and AsyncFiles are read off the event loop,
+        only those from static_file() are kept in memory.
+        """
 
-            return content["result"]
+        form = aiohttp.FormData()
+
+        for field, value in files.items():
+            if isinstance(value, AsyncFile):
+                form.add_field(field, await value.read(), filename=value.filename)
+
+            elif isinstance(value, os.PathLike):
+                value = AsyncFile(value)
+                form.add_field(field, await value.read(), filename=value.filename)
+
+            else:
+                form.add_field(field, value, filename=field)
+
+        start = time.monotonic()
+
+        async with self.session.post(url, data=form, params=apiq) as resp:
+            content = await resp.json()
+
+        return self._api_result(url, apiq, content, start, result_type)
+
+
+    def _api_result(self, url, apiq, content, start, result_type=None):
+        method = url.rsplit("/", 1)[-1]
+        latency = time.monotonic() - start
+        metrics.API_DURATION.labels(method).observe(latency)
+        metrics.API_REQUESTS.labels(method, content.get("error_code", 200)).inc()
+        self.usage["api_calls"] += 1
+        self.usage["api_seconds"] += latency
+
+        if not content["ok"]:
+            log.warning("API call failed: %s", content.get("description"),
+                        extra={"method": method, "chat_id": apiq.get("chat_id"),
+                               "status": content.get("error_code"), "latency": latency})
+            self.usage["api_errors"] += 1
+            raise APIError(content)
+
+        log.debug("API call", extra={"sampled": True, "method": method,
+                                     "chat_id": apiq.get("chat_id"), "latency": latency})
+
+        result = content["result"]
+
+        # True (eg. an inline message was edited) and plain values are returned as they are
+        if result_type is None or not isinstance(result, (dict, list)):
+            return result
+
+        if isinstance(result, list):
+            return [result_type(self, x) for x in result]
+
+        return result_type(self, result)
 
 
     async def send_message(self, chat_id, message, **kwargs):
@@ -170,11 +1133,50 @@ class NatsukoClient():
                                                             reply from the user.
         """
 
-        endpoint = "sendMessage"
+        # immediate=True skips the coalescer for this call, which otherwise returns
+        # a Pending handle right away (await it for the Message)
+        if self.coalescer and not kwargs.pop("immediate", False):
+            return await self.coalescer.send_message(chat_id, message, **kwargs)
 
-        url = self.API_URL + endpoint
-        args = {"chat_id": chat_id, "text": message, **kwargs}
-        return await self._api_send(url, args)
+        kwargs.pop("immediate", None)
+
+        return await self._call(api.SEND_MESSAGE, chat_id=chat_id, text=message, **kwargs)
+
+
+    async def send_long_message(self, chat_id, message, **kwargs):
+        """Sends a text of any length, as many messages as it takes (4096 characters
+        each). Returns the sent Messages, in order.
+        (Optional parameters are keyword arguments, as for send_message)
+
+        The text is split on paragraph, line or word breaks, see utilities.text.split_text.
+        With a parse_mode, formatting that spans a split is closed and reopened, so
+        every message is valid markup; otherwise `entities` are cut to each message.
+        The reply goes on the first message, the reply_markup on the last. Messages
+        are sent one after another, as Telegram only keeps the order of sends it
+        has already answered.
+        """
+
+        from utilities.text import split_text, MAX_MESSAGE_LENGTH
+
+        chunks = split_text(message, limit=kwargs.pop("limit", MAX_MESSAGE_LENGTH),
+                            parse_mode=kwargs.get("parse_mode"), entities=kwargs.pop("entities", None))
+        reply_markup = kwargs.pop("reply_markup", None)
+        kwargs.pop("immediate", None)
+
+        sent = []
+        for i, (chunk, entities) in enumerate(chunks):
+            options = kwargs if i == 0 else {key: value for key, value in kwargs.items()
+                                             if key not in ("reply", "reply_to_message_id", "reply_parameters")}
+
+            if entities:
+                options = {**options, "entities": entities}
+
+            if reply_markup is not None and i == len(chunks) - 1:
+                options = {**options, "reply_markup": reply_markup}
+
+            sent.append(await self._call(api.SEND_MESSAGE, chat_id=chat_id, text=chunk, **options))
+
+        return sent
 
 
     async def forward_message(self, target_cid, source_cid,
@@ -194,12 +1196,8 @@ class NatsukoClient():
         message_id              Integer Yes         Message identifier in the chat specified in from_chat_id
         """
 
-        endpoint = "forwardMessage"
-
-        url = self.API_URL + endpoint
-        args = {'chat_id': target_cid, 'from_chat_id': source_cid, 'message_id': message_id, **kwargs}
-
-        return await self._api_send(url, args)
+        return await self._call(api.FORWARD_MESSAGE, chat_id=target_cid, from_chat_id=source_cid,
+                                message_id=message_id, **kwargs)
 
 
     async def send_photo(self, chat_id, photo, **kwargs):
@@ -221,20 +1219,7 @@ class NatsukoClient():
                                                         force a reply from the user.
         """
 
-        endpoint = 'sendPhoto'
-        url = self.API_URL + endpoint
-
-        if isinstance(photo, str):
-            if photo.startswith('http'):
-                photo = urllib.parse.quote(photo)
-
-            args = {"chat_id": chat_id, "photo": photo, **kwargs}
-            return await self._api_send(url, args)
-
-        else:
-            args = {"chat_id": chat_id, **kwargs}
-            response = await self.session.post(url, data=dict(photo=photo), params=args)
-            return response.json()
+        return await self._call(api.SEND_PHOTO, chat_id=chat_id, photo=photo, **kwargs)
 
 
     async def send_audio(self, chat_id, audio, **kwargs):
@@ -262,18 +1247,7 @@ class NatsukoClient():
                                                         force a reply from the user.
         """
 
-        endpoint = "sendAudio"
-
-        url = self.API_URL + endpoint
-
-        if isinstance(audio, str):
-            args = {'chat_id': chat_id, 'audio': audio, **kwargs}
-            return await self._api_send(url, args)
-
-        else:
-            args = {'chat_id': chat_id, **kwargs}
-            response = await self.session.post(url, data=dict(audio=audio), params=args)
-            return response.json()
+        return await self._call(api.SEND_AUDIO, chat_id=chat_id, audio=audio, **kwargs)
 
 
     async def send_document(self, chat_id, document, **kwargs):
@@ -296,16 +1270,7 @@ class NatsukoClient():
                                                         force a reply from the user.
         """
 
-        endpoint = "sendDocument"
-
-        if isinstance(document, str):
-            args = {'chat_id': chat_id, 'document': document, **kwargs}
-            return await self._api_send(url, args)
-
-        else:
-            args = {'chat_id': chat_id, **kwargs}
-            response = await self.session.post(url, data=dict(document=document), params=args)
-            return response.json()
+        return await self._call(api.SEND_DOCUMENT, chat_id=chat_id, document=document, **kwargs)
 
 
     async def send_video(self, chat_id, video, **kwargs):
@@ -333,18 +1298,7 @@ class NatsukoClient():
                                                         force a reply from the user.
         """
 
-        endpoint = "sendVideo"
-
-        url = self.API_URL + endpoint
-
-        if isinstance(video, str):
-            args = {"chat_id": chat_id, "video": video, **kwargs}
-            return await self._api_send(url, args)
-
-        else:
-            args = {"chat_id": chat_id, **kwargs}
-            response = await self.session.post(url, data=dict(video=video), params=args)
-            return response.json()
+        return await self._call(api.SEND_VIDEO, chat_id=chat_id, video=video, **kwargs)
 
 
     async def send_voice(self, chat_id, voice, **kwargs):
@@ -370,18 +1324,7 @@ class NatsukoClient():
                                                         force a reply from the user.
         """
 
-        endpoint = "sendVoice"
-
-        url = self.API_URL + endpoint
-
-        if isinstance(voice, str):
-            args = {"chat_id": chat_id, "voice": voice, **kwargs}
-            return await self._api_send(apiq)
-
-        else:
-            args = {"chat_id": chat_id, **kwargs}
-            response = await self.session.post(url, data=dict(voice=voice), params=args)
-            return response.json()
+        return await self._call(api.SEND_VOICE, chat_id=chat_id, voice=voice, **kwargs)
 
 
     async def send_video_note(self, chat_id, v_note, **kwargs):
@@ -405,17 +1348,31 @@ class NatsukoClient():
                                                         force a reply from the user.
         """
 
-        endpoint = "sendVideoNote"
-        url = self.API_URL + endpoint
+        return await self._call(api.SEND_VIDEO_NOTE, chat_id=chat_id, video_note=v_note, **kwargs)
 
-        if isinstance(v_note, str):
-            args = {"chat_id": chat_id, "video_note": v_note}
-            return await self._api_send(url, args)
 
-        else:
-            args = {"chat_id": chat_id}
-            response = await self.session.post(url, data=dict(video_note=v_note), params=args)
-            return response.json()
+    async def send_media_group(self, chat_id, media, **kwargs):
+        """Use this method to send a group of photos, videos, documents or audios as an album, in
+        a single request. On success, a list of the sent Messages is returned.
+        (Optional parameters are keyword arguments)
+
+        Parameters              Type        Required    Description
+        chat_id                 Int/Str     Yes         Unique identifier for the target chat or username of
+                                                        the target channel (in the format @channelusername)
+        media                   List        Yes         2-10 InputMedia dicts, eg. {"type": "photo",
+                                                        "media": file, "caption": "..."}. media can be a
+                                                        file_id, url, bytes, a path or an AsyncFile, every
+                                                        upload goes in the same multipart request.
+        disable_notification    Boolean     Optional    Sends the messages silently. Users will receive a
+                                                        notification with no sound.
+        reply                   Integer     Optional    If the messages are a reply, ID of the original message
+        """
+
+        low, high = api.MEDIA_GROUP_SIZE
+        if not low <= len(media) <= high:
+            raise RequestError(f"sendMediaGroup: an album has {low} to {high} items, not {len(media)}")
+
+        return await self._call(api.SEND_MEDIA_GROUP, chat_id=chat_id, media=media, **kwargs)
 
 
     async def send_location(self, chat_id, long, lat, **kwargs):
@@ -438,11 +1395,7 @@ class NatsukoClient():
                                                         force a reply from the user.
         """
 
-        endpoint = 'sendLocation'
-        url = self.API_URL + endpoint
-
-        args = {'chat_id': chat_id, "latitude": lat, "longitutde": long, **kwargs}
-        return await self._api_send(url, args)
+        return await self._call(api.SEND_LOCATION, chat_id=chat_id, latitude=lat, longitude=long, **kwargs)
 
 
     async def send_venue(self, chat_id, lat, long, title, addr, **kwargs):
@@ -466,11 +1419,8 @@ class NatsukoClient():
                                                         force a reply from the user.
         """
 
-        endpoint = "sendVenue"
-        url = self.API_URL + endpoint
-
-        args = {'chat_id': chat_id, 'latitude': lat, "longitude": long, 'title': title, 'address': addr}
-        return await self._api_send(url, args)
+        return await self._call(api.SEND_VENUE, chat_id=chat_id, latitude=lat, longitude=long,
+                                title=title, address=addr, **kwargs)
 
 
     async def send_contact(self, chat_id, phone_number, first_name, **kwargs):
@@ -492,11 +1442,8 @@ class NatsukoClient():
                                                         force a reply from the user.
         """
 
-        endpoint = 'sendContact'
-        url = self.API_URL + endpoint
-
-        args = {'chat_id': chat_id, 'phone_number': phone_number, 'first_name': first_name, **kwargs}
-        return await self._api_send(url, args)
+        return await self._call(api.SEND_CONTACT, chat_id=chat_id, phone_number=phone_number,
+                                first_name=first_name, **kwargs)
 
 
     async def send_chat_action(self, chat_id, action):
@@ -528,16 +1475,12 @@ class NatsukoClient():
                                                             for video notes.
         """
 
-        endpoint = "sendChatAction"
-        url = self.API_URL + endpoint
-
-        args = {'chat_id': str(chat_id), 'action': action}
-        return await self._api_send(url, args)
+        return await self._call(api.SEND_CHAT_ACTION, chat_id=chat_id, action=action)
 
 
     async def get_user_profile_photos(self, user_id, **kwargs):
         """Use this method to get a list of profile pictures for a user.
-        Returns a UserProfilePhotos Dictionary.
+        Returns UserProfilePhotos.
         (Optional parameters are keyword arguments)
 
         Parameters              Type        Required    Description
@@ -548,196 +1491,215 @@ class NatsukoClient():
                                                         Values between 1—100 are accepted. Defaults to 100
         """
 
-        endpoint = 'getUserProfilePhotos'
-        url = self.API_URL + endpoint
-
-        args = {'user_id': user_id, **kwargs}
-        return await self._api_send(url, args)
+        return await self._call(api.GET_USER_PROFILE_PHOTOS, user_id=user_id, **kwargs)
 
 
     async def get_file(self, file_id):
 
-        endpoint = 'getFile'
-        url = self.API_URL + endpoint
+        return await self._call(api.GET_FILE, file_id=file_id)
 
-        args = {'file_id': file_id}
-        return await self._api_send(url, args)
 
     async def get_file_url(self, file_obj):
 
-        return f"https://api.telegram.org/file/bot{self.token}/{file_obj.file_path}"
+        file_path = file_obj["file_path"] if isinstance(file_obj, dict) else file_obj.file_path
+        return f"{self.BASE_URL}/file/bot{self.token}/{file_path}"
 
 
-    async def ban_chat_memeber(self, chat_id, user_id, **kwargs):
+    def static_file(self, path, filename=None):
+        """Returns an AsyncFile for an asset that is sent often, eg. a banner image.
+        It is read from disk once and then served from memory until it changes.
+        Other uploads from paths are read on every send and never cached.
+        """
 
-        endpoint = "kickChatMember"
-        url = self.API_URL + endpoint
+        return AsyncFile(path, filename=filename, cache=self.static_files)
 
-        args = {'chat_id': chat_id, 'user_id': user_id, **kwargs}
-        return await self._api_send(url, args)
 
+    async def download_file(self, file, destination=None):
+        """Downloads a file in chunks, resuming interrupted transfers.
 
-    async def unban_chat_memeber(self, chat_id, user_id):
+        Parameters              Type        Required    Description
+        file                    Str/File    Yes         file_id, or the File returned by get_file
+        destination             Str/Coro    Optional    Path to write to, or an async callable
+                                                        receiving each chunk. Without it the
+                                                        file is only kept in the media cache.
 
-        endpoint = 'unbanChatMember'
-        url = self.API_URL + endpoint
+        Returns the written path, or the number of bytes streamed to a callable.
+        """
 
-        args = {'chat_id': chat_id, 'user_id': user_id}
-        return await self._api_send(url, args)
+        if self._downloader is None:
+            from utilities.downloads import Downloader
+            self._downloader = Downloader(self, concurrency=self.download_concurrency, cache=self.media_cache)
 
+        return await self._downloader.download(file, destination)
 
-    async def restrict_chat_memeber(self, chat_id, user_id, **kwargs):
 
-        endpoint = 'restrictChatMember'
-        url = self.API_URL + endpoint
+    async def ban_chat_member(self, chat_id, user_id, **kwargs):
 
-        args = {'chat_id': chat_id, 'user_id': user_id, **kwargs}
-        return await self._api_send(url, args)
+        return await self._call(api.BAN_CHAT_MEMBER, chat_id=chat_id, user_id=user_id, **kwargs)
 
 
-    async def promote_chat_memeber(self, chat_id, user_id, **kwargs):
+    async def unban_chat_member(self, chat_id, user_id, **kwargs):
 
-        endpoint = 'promoteChatMember'
-        url = self.API_URL + endpoint
+        return await self._call(api.UNBAN_CHAT_MEMBER, chat_id=chat_id, user_id=user_id, **kwargs)
 
-        args = {'chat_id': chat_id, 'user_id': user_id, **kwargs}
-        return await self._api_send(url, args)
 
+    async def restrict_chat_member(self, chat_id, user_id, **kwargs):
 
-    async def export_invite_link(self, chat_id):
+        return await self._call(api.RESTRICT_CHAT_MEMBER, chat_id=chat_id, user_id=user_id, **kwargs)
 
-        endpoint = 'exportChatInviteLink'
-        url = self.API_URL + endpoint
 
-        args = {'chat_id': chat_id}
-        return await self._api_send(url, args)
+    async def promote_chat_member(self, chat_id, user_id, **kwargs):
 
+        return await self._call(api.PROMOTE_CHAT_MEMBER, chat_id=chat_id, user_id=user_id, **kwargs)
 
-    async def set_chat_photo(self, chat_id, photo):
 
-        endpoint = 'sendChatPhoto'
-        url = self.API_URL + endpoint
+    # the misspelled names the methods above used to have
+    ban_chat_memeber = ban_chat_member
+    unban_chat_memeber = unban_chat_member
+    restrict_chat_memeber = restrict_chat_member
+    promote_chat_memeber = promote_chat_member
 
-        args = {'chat_id': chat_id}
-        response = await self.session.post(apiq, data=dict(photo=photo), params=args)
-        return response.json()
 
+    async def export_invite_link(self, chat_id):
 
-    async def delete_chat_photo(self, chat_id):
+        return await self._call(api.EXPORT_INVITE_LINK, chat_id=chat_id)
 
-        endpoint = 'deleteChatPhoto'
-        url = self.API_URL + endpoint
 
-        args = {'chat_id': chat_id}
-        return await self._api_send(url, args)
+    async def set_chat_photo(self, chat_id, photo):
 
+        return await self._call(api.SET_CHAT_PHOTO, chat_id=chat_id, photo=photo)
 
-    async def set_chat_title(self, chat_id, title):
 
-        endpoint = 'setChatTitle'
-        url = self.API_URL + endpoint
+    async def delete_chat_photo(self, chat_id):
 
-        args = {'chat_id': chat_id, 'title': title}
-        return await self._api_send(url, args)
+        return await self._call(api.DELETE_CHAT_PHOTO, chat_id=chat_id)
 
 
-    async def set_chat_description(self, chat_id, desc):
+    async def set_chat_title(self, chat_id, title):
 
-        endpoint = 'setChatDescription'
-        url = self.API_URL + endpoint
+        return await self._call(api.SET_CHAT_TITLE, chat_id=chat_id, title=title)
 
-        args = {'chat_id': chat_id, 'description': desc}
-        return await self._api_send(url, args)
 
+    async def set_chat_description(self, chat_id, desc):
 
-    async def pin_chat_message(self, chat_id, message_id, **kwargs):
+        return await self._call(api.SET_CHAT_DESCRIPTION, chat_id=chat_id, description=desc)
 
-        endpoint = 'pinChatMessage'
-        url = self.API_URL + endpoint
 
-        args = {'chat_id': chat_id, 'message_id': message_id, **kwargs}
-        return await self._api_send(url, args)
+    async def pin_chat_message(self, chat_id, message_id, **kwargs):
 
+        return await self._call(api.PIN_CHAT_MESSAGE, chat_id=chat_id, message_id=message_id, **kwargs)
 
-    async def unpin_chat_message(self, chat_id):
 
-        endpoint = 'unpinChatMessage'
-        url = self.API_URL + endpoint
+    async def unpin_chat_message(self, chat_id, **kwargs):
 
-        args = {'chat_id': chat_id}
-        return await self._api_send(url, args)
+        return await self._call(api.UNPIN_CHAT_MESSAGE, chat_id=chat_id, **kwargs)
 
 
     async def get_chat(self, chat_id):
 
-        endpoint = 'getChat'
-        url = self.API_URL + endpoint
-
-        args = {'chat_id': chat_id}
-        return await self._api_send(url, args)
+        return await self._call(api.GET_CHAT, chat_id=chat_id)
 
 
     async def get_chat_administrators(self, chat_id):
 
-        endpoint = 'getChatAdministrators'
+        return await self._call(api.GET_CHAT_ADMINISTRATORS, chat_id=chat_id)
 
-        url = self.API_URL + endpoint
 
-        args = {'chat_id': chat_id}
-        return await self._api_send(url, args)
+    async def get_chat_member_count(self, chat_id):
 
+        return await self._call(api.GET_CHAT_MEMBER_COUNT, chat_id=chat_id)
 
-    async def get_chat_member_count(self, chat_id):
 
-        endpoint = 'getChatMembersCount'
-        url = self.API_URL + endpoint
+    async def get_chat_member(self, chat_id, user_id):
 
-        args = {'chat_id': chat_id}
-        return await self._api_send(url, args)
+        return await self._call(api.GET_CHAT_MEMBER, chat_id=chat_id, user_id=user_id)
 
 
-    async def get_chat_member(self, chat_id, user_id):
+    # Inline mode
+
+    async def answer_inline_query(self, inline_query_id, results, **kwargs):
+        """Use this method to send answers to an inline query. On success, True is returned.
+        No more than 50 results per query are allowed.
+        (Optional parameters are keyword arguments)
+
+        Parameters              Type        Required    Description
+        inline_query_id         String      Yes         Unique identifier for the answered query
+        results                 Json        Yes         A list of InlineQueryResult dicts
+        cache_time              Integer     Optional    Seconds the result may be cached on the server.
+                                                        Defaults to 300.
+        is_personal             Boolean     Optional    Cache the results for the user that sent
+                                                        the query only
+        next_offset             String      Optional    Offset the client should send to receive more
+                                                        results, "" if there are no more
+        button                  Json        Optional    A button shown above the results
+        """
+
+        return await self._call(api.ANSWER_INLINE_QUERY, inline_query_id=inline_query_id,
+                                results=results, **kwargs)
+
+
+    async def answer_callback_query(self, callback_query_id, **kwargs):
+        """Use this method to send answers to callback queries sent from inline keyboards.
+        The answer will be displayed to the user as a notification at the top of the chat
+        screen or as an alert. On success, True is returned.
+        (Optional parameters are keyword arguments)
 
-        endpoint = 'getChatMember'
-        url = self.API_URL + endpoint
+        Parameters              Type        Required    Description
+        callback_query_id       String      Yes         Unique identifier for the query to be answered
+        text                    String      Optional    Text of the notification, 0-200 characters
+        show_alert              Boolean     Optional    Show an alert instead of a notification
+        url                     String      Optional    URL to be opened by the user's client
+        cache_time              Integer     Optional    Seconds the result may be cached client-side
+        """
 
-        args = {'chat_id': chat_id}
-        return await self._api_send(url, args)
+        return await self._call(api.ANSWER_CALLBACK_QUERY, callback_query_id=callback_query_id, **kwargs)
 
 
     # Updating Messages
 
     async def edit_message_text(self, chat_id, msg_id, text, **kwargs):
 
-        endpoint = 'editMessageText'
-        url = self.API_URL + endpoint
+        if self.coalescer and not kwargs.pop("immediate", False):
+            return await self.coalescer.edit_message_text(chat_id, msg_id, text, **kwargs)
+
+        kwargs.pop("immediate", None)
+        self._edited_directly(chat_id, msg_id)
+
+        return await self._call(api.EDIT_MESSAGE_TEXT, chat_id=chat_id, message_id=msg_id, text=text, **kwargs)
+
 
-        args = {'chat_id': chat_id, 'text': text, 'message_id': msg_id, **kwargs}
-        return await self._api_send(url, args)
+    def _edited_directly(self, chat_id, msg_id):
+        # what the coalescer remembers of the message is out of date
+        if self.coalescer:
+            self.coalescer.forget(chat_id, msg_id)
 
 
     async def edit_message_caption(self, chat_id, msg_id, caption, **kwargs):
 
-        endpoint = 'editMessageCaption'
-        url = self.API_URL + endpoint
+        self._edited_directly(chat_id, msg_id)
 
-        args = {'chat_id': chat_id, 'message_id': msg_id, 'caption': caption, **kwargs}
-        return await self._api_send(url, args)
+        return await self._call(api.EDIT_MESSAGE_CAPTION, chat_id=chat_id, message_id=msg_id,
+                                caption=caption, **kwargs)
 
 
     async def edit_message_reply_markup(self, chat_id, msg_id, markup, **kwargs):
 
-        endpoint = 'editMessageReplyMarkup'
-        url = self.API_URL + endpoint
+        self._edited_directly(chat_id, msg_id)
 
-        args = {'chat_id': chat_id, 'message_id': msg_id, 'markup': markup, **kwargs}
-        return await self._api_send(url, args)
+        return await self._call(api.EDIT_MESSAGE_REPLY_MARKUP, chat_id=chat_id, message_id=msg_id,
+                                reply_markup=markup, **kwargs)
 
 
     async def delete_message(self, chat_id, msg_id):
 
-        endpoint = 'deleteMessage'
-        url = self.API_URL + endpoint
+        self._edited_directly(chat_id, msg_id)
+
+        return await self._call(api.DELETE_MESSAGE, chat_id=chat_id, message_id=msg_id)
+
+
+    def delete_later(self, chat_id, msg_id, delay):
+        """Deletes a message in `delay` seconds, returns the job's id (see scheduler)."""
+
+        return self.scheduler.call_later(delay, "delete_message", chat_id, msg_id)
+
 
-        args = {'chat_id': chat_id, 'message_id': msg_id}
-        return await self._api_send(url, args)
@@ -0,0 +1,49 @@
+import asyncio
+
+from natsuko import NatsukoClient
+from utilities.admission import AdmissionController
+from utilities.fakeapi import FakeBotAPI
+
+
+USER = {"id": 7, "is_bot": False, "first_name": "A", "username": "a"}
+CHAT = {"id": 5, "type": "private"}
+
+
+def photo(update_id, album):
+    return {"update_id": update_id, "message": {"message_id": update_id, "date": 0, "chat": CHAT, "from": USER,
+                                                "media_group_id": album, "photo": [{"file_id": "x"}]}}
+
+
+def callback(update_id):
+    return {"update_id": update_id, "callback_query": {"id": str(update_id), "from": USER, "chat_instance": "1",
+                                                       "data": "vote:up"}}
+
+
+def test_album_is_admitted_as_one():
+    admission = AdmissionController(user_rate=0.001, user_burst=2, duplicate_window=0)
+
+    assert all(admission.admit(photo(i, "A")) for i in range(10))
+    assert admission.admit(photo(10, "B"))
+    # out of tokens, the whole album goes
+    assert not any(admission.admit(photo(i, "C")) for i in range(11, 21))
+    assert admission.shed == {"user_rate": 10}
+
+
+def test_shed_callback_query_is_answered():
+    async def main():
+        api = FakeBotAPI()
+        await api.start()
+        client = NatsukoClient("TEST", api_url=api.url,
+                               admission=AdmissionController(user_rate=0.001, user_burst=1))
+
+        try:
+            client.manager.command_queue.extend([callback(1), callback(2)])
+            await client.process()
+            await asyncio.gather(*client._tasks)
+        finally:
+            await client.shutdown()
+            await api.stop()
+
+        return [params["callback_query_id"] for method, params, _ in api.calls if method == "answerCallbackQuery"]
+
+    assert asyncio.run(main()) == ["2"]
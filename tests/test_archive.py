@@ -0,0 +1,35 @@
+import asyncio
+
+from utilities.archive import MessageArchive
+
+
+def message(message_id, text, **extra):
+    return {"message_id": message_id, "date": 1000 + message_id, "chat": {"id": 1, "type": "group"}, "text": text,
+            **extra}
+
+
+def test_search_follows_edits_and_vacuum(tmp_path):
+    async def main():
+        archive = MessageArchive(str(tmp_path / "archive.db"))
+
+        for i in range(1, 6):
+            archive.add({"update_id": i, "message": message(i, f"note number {i}")})
+        archive.add({"update_id": 6, "edited_message": message(2, "release notes", edit_date=2000)})
+        await archive.flush()
+
+        assert [hit["message_id"] for hit in await archive.search("release")] == [2]
+        assert await archive.search("number 2") == []
+
+        # deleting and vacuuming must not point the index at the wrong messages
+        with archive.lock, archive.db:
+            archive.db.execute("DELETE FROM messages WHERE message_id = 1")
+        archive.db.execute("VACUUM")
+
+        hits = await archive.search("release")
+        await archive.close()
+        return hits
+
+    hits = asyncio.run(main())
+
+    assert [(hit["message_id"], hit["text"]) for hit in hits] == [(2, "release notes")]
+    assert "id" not in hits[0]
@@ -0,0 +1,93 @@
+import asyncio
+
+import aiohttp
+
+from models.errors import APIError
+from natsuko import NatsukoClient
+from utilities.broadcast import Broadcast, BroadcastStore
+from utilities.fakeapi import FakeBotAPI
+
+
+def blocked():
+    return APIError({"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"})
+
+
+def test_failures_are_per_chat_and_transient_ones_resend(tmp_path):
+    store = BroadcastStore(str(tmp_path / "broadcasts.db"))
+    sent = []
+
+    async def flaky(chat_id):
+        if chat_id == 2:
+            raise aiohttp.ClientConnectionError("connection reset")
+        if chat_id == 3:
+            raise blocked()
+        sent.append(chat_id)
+
+    async def steady(chat_id):
+        sent.append(chat_id)
+
+    broadcast = Broadcast(None, "news", store, rate=1000, retries=0)
+    counts = asyncio.run(broadcast.run(range(1, 6), flaky))
+
+    assert counts == {"skipped": 0, "ok": 3, "retry": 1, "blocked": 1}
+    assert sorted(sent) == [1, 4, 5]
+
+    # a rerun only sends to the chat that failed on the network
+    sent.clear()
+    counts = asyncio.run(Broadcast(None, "news", store, rate=1000).run(range(1, 6), steady))
+
+    assert counts == {"skipped": 4, "ok": 1}
+    assert sent == [2]
+
+
+def test_outcomes_are_saved_when_cancelled(tmp_path):
+    store = BroadcastStore(str(tmp_path / "broadcasts.db"))
+
+    async def main():
+        async def send(chat_id):
+            if chat_id > 3:
+                await asyncio.sleep(60)
+
+        broadcast = Broadcast(None, "news", store, rate=1000, concurrency=5)
+        task = asyncio.ensure_future(broadcast.run(range(1, 6), send))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(main())
+
+    assert store.done("news", list(range(1, 6))) == {1, 2, 3}
+
+
+def test_interrupted_broadcast_resumes(tmp_path):
+    path = str(tmp_path / "broadcasts.db")
+
+    async def main():
+        api = FakeBotAPI()
+        api.on("sendMessage", lambda params: {"ok": False, "error_code": 403,
+                                              "description": "Forbidden: bot was blocked by the user"}
+               if params["chat_id"] == "3" else api.default_result("sendMessage", params))
+        await api.start()
+        client = NatsukoClient("TEST", api_url=api.url)
+
+        try:
+            # paced at 20/s, stopped part way through
+            task = asyncio.ensure_future(Broadcast(client, "news", path, rate=20).send_message(range(1, 11), "hi"))
+            await asyncio.sleep(0.225)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            first = len(api.calls)
+
+            counts = await Broadcast(client, "news", path, rate=100).send_message(range(1, 11), "hi")
+        finally:
+            await client.shutdown()
+            await api.stop()
+
+        return first, counts, [params["chat_id"] for _, params, _ in api.calls]
+
+    first, counts, sent = asyncio.run(main())
+
+    assert 0 < first < 10
+    assert counts["skipped"] == first
+    assert sorted(sent, key=int) == [str(chat_id) for chat_id in range(1, 11)]
+    assert BroadcastStore(path).summary("news") == {"ok": 9, "blocked": 1}
@@ -0,0 +1,38 @@
+import asyncio
+import multiprocessing
+
+from natsuko import NatsukoClient
+from utilities.cluster import _worker_main, update_shard_key
+from utilities.fakeapi import synthetic_update
+from utilities.state import StateStore
+
+
+seen = {}
+
+
+def make_client():
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    client = NatsukoClient("TEST", state_store=StateStore())
+
+    @client.command("ping")
+    async def ping(event):
+        seen["state_store"] = client.state_store._task is not None
+        seen["scheduler"] = client.scheduler._task is not None
+
+    return client
+
+
+def test_worker_starts_the_client_services():
+    ours, theirs = multiprocessing.Pipe()
+    ours.send([synthetic_update(1)])
+    ours.send(None)
+
+    _worker_main(make_client, theirs, 0)
+
+    assert seen == {"state_store": True, "scheduler": True}
+    # and acknowledged the update
+    assert ours.recv() == [1]
+
+
+def test_shard_key_is_the_chat():
+    assert update_shard_key(synthetic_update(1, chat_id=42)) == 42
@@ -0,0 +1,137 @@
+import asyncio
+import time
+
+from natsuko import NatsukoClient
+from utilities.coalesce import Pending
+from utilities.fakeapi import FakeBotAPI
+
+
+def run(test, coalesce_window=0.05):
+    async def main():
+        api = FakeBotAPI()
+        await api.start()
+        client = NatsukoClient("TEST", api_url=api.url, coalesce=True, coalesce_window=coalesce_window,
+                               edit_debounce=0.3)
+
+        try:
+            await test(api, client)
+        finally:
+            await client.shutdown()
+            await api.stop()
+
+    asyncio.run(main())
+
+
+def calls(api, method):
+    return [params for name, params, _ in api.calls if name == method]
+
+
+def test_sequential_sends_are_merged():
+    async def test(api, client):
+        start = time.monotonic()
+        handles = [await client.send_message(1, f"line {i}") for i in range(5)]
+
+        # queuing doesn't wait for the send
+        assert time.monotonic() - start < 0.05
+        assert all(isinstance(handle, Pending) for handle in handles)
+
+        messages = [await handle for handle in handles]
+
+        assert len(calls(api, "sendMessage")) == 1
+        assert calls(api, "sendMessage")[0]["text"] == "\n".join(f"line {i}" for i in range(5))
+        assert len({message.id for message in messages}) == 1
+
+    run(test)
+
+
+def test_unmergeable_send_flushes_first():
+    async def test(api, client):
+        await client.send_message(1, "queued")
+        message = await (await client.send_message(1, "reply", reply=5))
+
+        assert [params["text"] for params in calls(api, "sendMessage")] == ["queued", "reply"]
+        assert message.text == "reply"
+
+    run(test)
+
+
+def test_edits_leading_and_trailing():
+    async def test(api, client):
+        start = time.monotonic()
+        handles = [await client.edit_message_text(1, 2, f"progress {i}%") for i in range(0, 100, 25)]
+
+        # the first edit went out right away, the rest wait for the window
+        assert [params["text"] for params in calls(api, "editMessageText")] == ["progress 0%"]
+        assert time.monotonic() - start < 0.2
+
+        await asyncio.gather(*handles)
+        assert [params["text"] for params in calls(api, "editMessageText")] == ["progress 0%", "progress 75%"]
+
+    run(test)
+
+
+def test_same_text_is_not_edited_again():
+    async def test(api, client):
+        await (await client.edit_message_text(1, 2, "done"))
+        await asyncio.sleep(0.35)
+        await (await client.edit_message_text(1, 2, "done"))
+
+        assert len(calls(api, "editMessageText")) == 1
+
+    run(test)
+
+
+def test_concurrent_senders_keep_order_and_lose_nothing():
+    for window in (0.05, 0.5):
+        async def test(api, client):
+            send = client.coalescer._send
+
+            async def slow_send(*args):
+                await asyncio.sleep(0.1)
+                return await send(*args)
+
+            client.coalescer._send = slow_send
+
+            async def first():
+                handles = [await client.send_message(1, "a"),
+                           await client.send_message(1, "b", parse_mode="HTML")]
+                await asyncio.sleep(0.02)
+                handles.append(await client.send_message(1, "d", reply=5))
+                return [await handle for handle in handles]
+
+            async def second():
+                await asyncio.sleep(0.01)
+                return await (await client.send_message(1, "c"))
+
+            await asyncio.wait_for(asyncio.gather(first(), second()), 2)
+            await client.coalescer.flush()
+
+            # "c" was sent after "b" was queued, and "d" after "c"
+            assert [params["text"] for params in calls(api, "sendMessage")] == ["a", "b", "c", "d"]
+
+        run(test, coalesce_window=window)
+
+
+def test_edit_with_new_options_is_not_skipped():
+    async def test(api, client):
+        await (await client.edit_message_text(1, 2, "vote", reply_markup='{"inline_keyboard": []}'))
+        await asyncio.sleep(0.35)
+        await (await client.edit_message_text(1, 2, "vote", reply_markup='{"inline_keyboard": [[]]}'))
+        await asyncio.sleep(0.35)
+        await client.edit_message_text(1, 2, "direct", immediate=True)
+        await (await client.edit_message_text(1, 2, "vote", reply_markup='{"inline_keyboard": [[]]}'))
+
+        assert len(calls(api, "editMessageText")) == 4
+
+    run(test)
+
+
+def test_entities_are_never_merged():
+    async def test(api, client):
+        entities = [{"type": "bold", "offset": 0, "length": 1}]
+        await client.send_message(1, "a", entities=entities)
+        await client.send_message(1, "b", entities=entities)
+
+        assert len(calls(api, "sendMessage")) == 2
+
+    run(test)
@@ -0,0 +1,61 @@
+import asyncio
+
+from aiohttp import web
+
+from natsuko import NatsukoClient
+from utilities.fakeapi import FakeBotAPI
+
+
+CONTENT = bytes(range(256)) * 2048
+
+
+class DroppingAPI(FakeBotAPI):
+    """Cuts the first download off half way through."""
+
+    dropped = False
+
+    async def handle_file(self, request):
+        if self.dropped:
+            return await super().handle_file(request)
+
+        self.dropped = True
+        resp = web.StreamResponse(headers={"Content-Length": str(len(CONTENT))})
+        await resp.prepare(request)
+        await resp.write(CONTENT[:len(CONTENT) // 2])
+        request.transport.close()
+        return resp
+
+
+def download(api, destination, **kwargs):
+    async def main():
+        await api.start()
+        api.add_file("doc", CONTENT)
+        client = NatsukoClient("TEST", api_url=api.url, **kwargs)
+
+        try:
+            return await client.download_file("doc", destination)
+        finally:
+            await client.shutdown()
+            await api.stop()
+
+    return asyncio.run(main())
+
+
+def test_stream_to_a_sink_resumes():
+    chunks = []
+
+    async def sink(chunk):
+        chunks.append(chunk)
+
+    assert download(DroppingAPI(), sink) == len(CONTENT)
+    assert b"".join(chunks) == CONTENT
+
+
+def test_download_into_a_file_object(tmp_path):
+    path = tmp_path / "doc.bin"
+
+    with open(path, "wb") as f:
+        assert download(FakeBotAPI(), f) == len(CONTENT)
+
+    assert path.read_bytes() == CONTENT
+
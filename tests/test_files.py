@@ -0,0 +1,31 @@
+import asyncio
+
+from natsuko import NatsukoClient
+from utilities.fakeapi import FakeBotAPI
+
+
+def test_only_static_files_are_cached(tmp_path):
+    path = tmp_path / "report.txt"
+
+    async def main():
+        api = FakeBotAPI()
+        await api.start()
+        client = NatsukoClient("TEST", api_url=api.url)
+
+        try:
+            path.write_bytes(b"first")
+            await client.send_document(1, path)
+            # rewritten right away, within the cache's recheck window
+            path.write_bytes(b"second")
+            await client.send_document(1, path)
+            assert client.static_files.size == 0
+
+            await client.send_document(1, client.static_file(path))
+            assert client.static_files.size == len(b"second")
+        finally:
+            await client.shutdown()
+            await api.stop()
+
+        return [params["document"] for _, params, _ in api.calls]
+
+    assert asyncio.run(main()) == [b"first", b"second", b"second"]
@@ -0,0 +1,28 @@
+import asyncio
+
+from utilities.host import BotHost
+from utilities.polling import MAX_SLOT_TIMEOUT, PollController
+
+
+def test_poll_timeout_is_capped_with_poll_slots():
+    async def main():
+        host = BotHost(poll_slots=2, poll_timeout=100)
+        bots = [host.add("TEST1", name="one"),
+                host.add("TEST2", name="two", poll_timeout=50),
+                host.add("TEST3", name="three", poll_controller=PollController(max_timeout=100))]
+
+        timeouts = [(bot.manager.poll_timeout, bot.manager.controller.timeout) for bot in bots]
+        await host.shutdown()
+        return timeouts
+
+    assert asyncio.run(main()) == [(MAX_SLOT_TIMEOUT, MAX_SLOT_TIMEOUT)] * 3
+
+
+def test_poll_timeout_is_kept_without_poll_slots():
+    async def main():
+        host = BotHost()
+        bot = host.add("TEST", name="one")
+        await host.shutdown()
+        return bot.manager.poll_timeout
+
+    assert asyncio.run(main()) == 100
@@ -0,0 +1,98 @@
+import asyncio
+
+from natsuko import NatsukoClient
+from utilities.fakeapi import FakeBotAPI, synthetic_update
+from utilities.offsets import SQLiteOffsetStore
+
+
+async def wait_for(condition, timeout=5):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+
+    raise AssertionError("timed out")
+
+
+def test_unfinished_updates_are_replayed_after_a_restart(tmp_path):
+    path = str(tmp_path / "offsets.db")
+    started, finished = [], []
+
+    async def handler(event):
+        started.append(event.update_id)
+        if event.message.text == "/work slow":
+            await asyncio.sleep(60)
+        finished.append(event.update_id)
+
+    async def run(api, until):
+        client = NatsukoClient("TEST", api_url=api.url, poll_timeout=1, shutdown_timeout=0.1,
+                               offset_store=SQLiteOffsetStore(path))
+        client.command("work")(handler)
+
+        running = asyncio.ensure_future(client._run())
+        await wait_for(until)
+        client.stop()
+        await running
+        await client.shutdown()
+
+    async def main():
+        api = FakeBotAPI()
+        await api.start()
+
+        try:
+            api.push([synthetic_update(1, text="/work"), synthetic_update(2, text="/work slow"),
+                      synthetic_update(3, text="/work")])
+
+            # the slow handler is cut short by the shutdown
+            await run(api, lambda: len(started) == 3 and len(finished) == 2)
+            assert finished == [1, 3]
+
+            # only it runs again, from the journal, Telegram has forgotten it by now
+            started.clear()
+            await run(api, lambda: started)
+            await asyncio.sleep(0.1)
+            assert started == [2]
+        finally:
+            await api.stop()
+
+    asyncio.run(main())
+
+
+def test_failed_commit_is_retried_before_polling(tmp_path):
+    async def main():
+        api = FakeBotAPI()
+        await api.start()
+        store = SQLiteOffsetStore(str(tmp_path / "offsets.db"))
+        client = NatsukoClient("TEST", api_url=api.url, poll_timeout=1, offset_store=store)
+        client.manager.controller.base_backoff = 0.01
+
+        apply, failures = store.apply, []
+
+        def flaky_apply(*args):
+            if len(failures) < 2:
+                failures.append(args)
+                raise RuntimeError("database is locked")
+            return apply(*args)
+
+        store.apply = flaky_apply
+        handled = []
+        client.command("ping")(lambda event: handled.append(event.update_id))
+
+        try:
+            api.push([synthetic_update(1)])
+            running = asyncio.ensure_future(client._run())
+            await wait_for(lambda: handled and not client.tracker._dirty)
+            assert not running.done()
+            client.stop()
+            await running
+        finally:
+            await client.shutdown()
+            await api.stop()
+
+        return failures
+
+    failures = asyncio.run(main())
+    offset, pending = SQLiteOffsetStore(str(tmp_path / "offsets.db")).load()
+
+    assert len(failures) == 2
+    assert offset == 2 and pending == []
@@ -0,0 +1,102 @@
+import asyncio
+import time
+
+from natsuko import NatsukoClient
+from utilities.fakeapi import FakeBotAPI
+from utilities.scheduler import JobScheduler, SQLiteJobStore
+
+
+def test_slow_job_does_not_hold_back_later_ones():
+    finished = {}
+
+    async def main():
+        client = NatsukoClient("TEST")
+        start = time.monotonic()
+
+        async def job(name, seconds):
+            await asyncio.sleep(seconds)
+            finished[name] = time.monotonic() - start
+
+        client.job = job
+        scheduler = JobScheduler(client, concurrency=2)
+        scheduler.start()
+
+        scheduler.call_later(0, "job", "slow", 1)
+        scheduler.call_later(0.05, "job", "quick", 0)
+        scheduler.call_later(0.1, "job", "quicker", 0)
+
+        await asyncio.sleep(0.5)
+        assert set(finished) == {"quick", "quicker"}
+
+        await asyncio.sleep(0.7)
+        await scheduler.close()
+        await client.shutdown()
+
+    asyncio.run(main())
+
+    assert set(finished) == {"slow", "quick", "quicker"}
+
+
+def test_concurrency_is_a_limit():
+    running = []
+    most = 0
+
+    async def main():
+        client = NatsukoClient("TEST")
+
+        async def job():
+            nonlocal most
+            running.append(1)
+            most = max(most, len(running))
+            await asyncio.sleep(0.05)
+            running.pop()
+
+        client.job = job
+        scheduler = JobScheduler(client, concurrency=3)
+        scheduler.start()
+
+        for _ in range(10):
+            scheduler.call_later(0, "job")
+
+        await asyncio.sleep(0.4)
+        assert scheduler.ran == 10
+
+        await scheduler.close()
+        await client.shutdown()
+
+    asyncio.run(main())
+
+    assert most == 3
+
+
+def test_saved_jobs_run_after_a_restart(tmp_path):
+    path = str(tmp_path / "jobs.db")
+
+    async def main():
+        api = FakeBotAPI()
+        await api.start()
+
+        try:
+            client = NatsukoClient("TEST", api_url=api.url, job_store=SQLiteJobStore(path))
+            client.scheduler.start()
+            client.scheduler.call_later(0.3, "send_message", 1, "later")
+            client.scheduler.call_later(0.3, "send_message", 1, "cancelled")
+            client.scheduler.cancel(2)
+            client.scheduler.call_later(0.2, "send_message", 1, "every", every=60)
+            await client.shutdown()
+
+            assert api.calls == []
+
+            client = NatsukoClient("TEST", api_url=api.url, job_store=SQLiteJobStore(path))
+            client.scheduler.start()
+            await asyncio.sleep(0.6)
+            await client.shutdown()
+
+            # the recurring job is saved again for its next run
+            assert [job[2] for job in SQLiteJobStore(path).load(0, float("inf"))] == ["send_message"]
+        finally:
+            await api.stop()
+
+        return sorted(params["text"] for method, params, _ in api.calls if method == "sendMessage")
+
+    assert asyncio.run(main()) == ["every", "later"]
@@ -0,0 +1,27 @@
+from dotmap import DotMap
+
+from models.types import Event
+from utilities.state import StateStore
+
+
+def event(update):
+    return Event(None, DotMap({"update_id": 1, **update}))
+
+
+USER = {"id": 7, "is_bot": False, "first_name": "A", "username": "a"}
+MESSAGE = {"message_id": 1, "date": 0, "chat": {"id": 5, "type": "group"}, "from": USER, "text": "hi"}
+INLINE_CALLBACK = {"id": "1", "from": USER, "inline_message_id": "AAE", "chat_instance": "1", "data": "vote:up"}
+
+
+def test_keys_per_scope():
+    assert StateStore(scope="chat").key(event({"message": MESSAGE})) == "5"
+    assert StateStore(scope="user").key(event({"message": MESSAGE})) == "7"
+    assert StateStore(scope="chat_user").key(event({"message": MESSAGE})) == "5:7"
+
+
+def test_chatless_callbacks_have_no_chat_key():
+    callback = event({"callback_query": INLINE_CALLBACK})
+
+    assert StateStore(scope="chat").key(callback) is None
+    assert StateStore(scope="chat_user").key(callback) is None
+    assert StateStore(scope="user").key(callback) == "7"
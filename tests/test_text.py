@@ -0,0 +1,73 @@
+import re
+
+from utilities.text import split_text, utf16_len
+
+
+def html_balanced(chunk):
+    stack = []
+    for closing, name in re.findall(r"<(/?)([a-z]+)[^>]*>", chunk):
+        if closing:
+            assert stack and stack.pop() == name, chunk
+        else:
+            stack.append(name)
+
+    return not stack
+
+
+def test_plain_text_breaks_on_words():
+    text = " ".join(f"word{i}" for i in range(2000))
+    chunks = [chunk for chunk, _ in split_text(text, limit=100)]
+
+    assert all(utf16_len(chunk) <= 100 for chunk in chunks)
+    assert " ".join(chunks) == text
+
+
+def test_html_formatting_is_closed_and_reopened():
+    text = "<b>" + " ".join(f"bold <i>and {i}</i> &amp;" for i in range(300)) + "</b> <a href=\"x\">end</a>"
+    chunks = [chunk for chunk, _ in split_text(text, limit=200, parse_mode="HTML")]
+
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert utf16_len(chunk) <= 200
+        assert html_balanced(chunk)
+        # entities are never cut
+        assert not re.search(r"&\w*$|^\w*;", chunk)
+
+    assert all(chunk.startswith("<b>") for chunk in chunks[:-1])
+
+
+def test_markdown_v2_markers_are_balanced():
+    text = "*" + " ".join(f"bold \\_{i}\\_ _italic_" for i in range(300)) + "*"
+    chunks = [chunk for chunk, _ in split_text(text, limit=150, parse_mode="MarkdownV2")]
+
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert utf16_len(chunk) <= 150
+        unescaped = re.sub(r"\\.", "", chunk)
+        assert unescaped.count("*") % 2 == 0
+        assert unescaped.count("_") % 2 == 0
+        assert not chunk.endswith("\\")
+
+
+def test_pre_blocks_keep_their_fence():
+    text = "```python\n" + "\n".join(f"print({i})" for i in range(200)) + "\n```"
+    chunks = [chunk for chunk, _ in split_text(text, limit=300, parse_mode="MarkdownV2")]
+
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert chunk.startswith("```python\n")
+        assert chunk.endswith("```")
+
+
+def test_entities_move_with_their_chunk():
+    text = "x" * 50 + " " + "😀 bold"
+    entities = [{"type": "bold", "offset": 53, "length": 4}]
+
+    chunks = split_text(text, limit=40, entities=entities)
+    last, last_entities = chunks[-1]
+
+    # no break in the first 40 units, so a hard cut there
+    assert chunks[0] == ("x" * 40, None)
+    assert last == "x" * 10 + " 😀 bold"
+    # offsets count the emoji as two UTF-16 units
+    assert last_entities == [{"type": "bold", "offset": 13, "length": 4}]
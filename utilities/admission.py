@@ -0,0 +1,204 @@
+import asyncio
+import time
+from collections import Counter, OrderedDict
+
+from utilities.log import get_logger
+from utilities import metrics
+
+
+log = get_logger("admission")
+
+# what goes first when the bot is overloaded
+SHED_KINDS = ('edited_message', 'edited_channel_post', 'inline_query', 'chosen_inline_result',
+              'poll', 'poll_answer', 'message_reaction', 'message_reaction_count', 'chat_member',
+              'my_chat_member', 'chat_join_request')
+
+# albums whose decision is remembered, their items arrive within a second or so
+MAX_ALBUMS = 1000
+
+
+def _kind(update):
+    for key in update:
+        if key != "update_id":
+            return key
+
+    return None
+
+
+def _origin(item):
+    """Returns (user_id, chat_id) of an update's payload."""
+
+    user = item.get("from") or item.get("user") or {}
+    chat = item.get("chat") or (item.get("message") or {}).get("chat") or {}
+
+    return user.get("id"), chat.get("id")
+
+
+class TokenBuckets():
+    """One token bucket per key, refilling at `rate` tokens per second up to
+    `burst`. Buckets are created on demand and forgotten once full again.
+    """
+
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        # key -> [tokens, last refill]
+        self.buckets = {}
+
+    def take(self, key, now):
+        bucket = self.buckets.get(key)
+
+        if bucket is None:
+            if len(self.buckets) >= self.max_keys:
+                self.prune(now)
+
+            bucket = self.buckets[key] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        if bucket[0] < 1:
+            return False
+
+        bucket[0] -= 1
+        return True
+
+    def prune(self, now):
+        # a full bucket is the same as no bucket
+        full = [key for key, (tokens, last) in self.buckets.items()
+                if tokens + (now - last) * self.rate >= self.burst]
+
+        for key in full:
+            del self.buckets[key]
+
+
+class AdmissionController():
+    """Decides, before anything is parsed, whether an update is dispatched.
+
+        NatsukoClient(token, admission=AdmissionController(user_rate=1, user_burst=5))
+
+    In order, an update is dropped when:
+    - the bot is overloaded (more than `max_backlog` updates queued or handlers
+      running, or the event loop lagging over `max_lag` seconds) and its kind
+      is in `shed` (edits, inline queries, polls... see SHED_KINDS)
+    - it's a command the same user sent in the same chat within `duplicate_window`
+      seconds, which is collapsed into the first one
+    - its user, or else its chat, ran out of tokens: `user_rate`/`chat_rate`
+      updates per second with bursts of `user_burst`/`chat_burst`
+
+    A flood in one chat only empties that chat's buckets, so other chats keep
+    their latency. The items of an album (media_group_id) are admitted or
+    dropped together, on the decision taken for the first one, and take one
+    token. What was dropped is counted in `shed`, by reason; the client
+    answers dropped callback queries so their buttons stop loading.
+    """
+
+    def __init__(self, user_rate=1.0, user_burst=10, chat_rate=20.0, chat_burst=60, duplicate_window=2.0,
+                 max_backlog=1000, max_lag=0.5, shed=SHED_KINDS, lag_interval=0.1):
+        self.users = TokenBuckets(user_rate, user_burst) if user_rate else None
+        self.chats = TokenBuckets(chat_rate, chat_burst) if chat_rate else None
+        self.duplicate_window = duplicate_window
+        self.max_backlog = max_backlog
+        self.max_lag = max_lag
+        self.shed_kinds = frozenset(shed)
+        self.lag_interval = lag_interval
+
+        # (chat_id, user_id, text) -> when it was last seen
+        self.recent = {}
+        self._pruned = 0
+        # media_group_id -> why its album is dropped, None when admitted
+        self.albums = OrderedDict()
+
+        self.lag = 0
+        self.admitted = 0
+        self.shed = Counter()
+        self._task = None
+
+    def overloaded(self, backlog):
+        return backlog > self.max_backlog or self.lag > self.max_lag
+
+    def admit(self, update, backlog=0):
+        """Returns whether to dispatch a raw update, `backlog` being how many
+        updates are waiting or being handled.
+        """
+
+        kind = _kind(update)
+        item = update.get(kind)
+        album = item.get("media_group_id") if isinstance(item, dict) else None
+
+        if album is not None and album in self.albums:
+            reason = self.albums[album]
+        else:
+            reason = self._check(kind, item, backlog)
+
+            if album is not None:
+                self.albums[album] = reason
+                if len(self.albums) > MAX_ALBUMS:
+                    self.albums.popitem(last=False)
+
+        if reason:
+            self.shed[reason] += 1
+            metrics.UPDATES_SHED.labels(reason, kind).inc()
+            return False
+
+        self.admitted += 1
+        return True
+
+    def _check(self, kind, item, backlog):
+        """Returns why an update is dropped, or None."""
+
+        if kind in self.shed_kinds and self.overloaded(backlog):
+            return "overload"
+
+        if not isinstance(item, dict):
+            return None
+
+        user_id, chat_id = _origin(item)
+        now = time.monotonic()
+
+        text = item.get("text")
+        if self.duplicate_window and text and text.startswith("/"):
+            key = (chat_id, user_id, text)
+            seen = self.recent.get(key)
+            self.recent[key] = now
+
+            if seen is not None and now - seen < self.duplicate_window:
+                return "duplicate"
+
+            if now - self._pruned > self.duplicate_window:
+                self._prune(now)
+
+        # users first, so a flooding user doesn't also spend their chat's tokens
+        if self.users and user_id is not None and not self.users.take(user_id, now):
+            return "user_rate"
+
+        if self.chats and chat_id is not None and not self.chats.take(chat_id, now):
+            return "chat_rate"
+
+        return None
+
+    def _prune(self, now):
+        self._pruned = now
+        self.recent = {key: seen for key, seen in self.recent.items() if now - seen < self.duplicate_window}
+
+    # Loop lag
+
+    async def _measure_lag(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.lag_interval)
+            self.lag = max(0, time.monotonic() - start - self.lag_interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._measure_lag())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+        if self.shed:
+            log.info("Shed updates: %s", dict(self.shed))
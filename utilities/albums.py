@@ -0,0 +1,75 @@
+import asyncio
+
+from utilities.log import get_logger
+
+
+log = get_logger("albums")
+
+# Telegram albums have at most 10 items
+MAX_ITEMS = 10
+
+
+class _Group():
+
+    __slots__ = ['updates', 'timer']
+
+    def __init__(self):
+        self.updates = []
+        self.timer = None
+
+
+class MediaGroupCollector():
+    """Collects the updates of an album, which arrive as separate messages
+    sharing a media_group_id, and hands them to `dispatch(updates)` together
+    once no more items came in for `window` seconds (or all 10 arrived).
+    Updates are passed in message_id order.
+    """
+
+    def __init__(self, dispatch, window=0.5):
+        self.dispatch = dispatch
+        self.window = window
+        self.groups = {}
+
+    @staticmethod
+    def group_of(update):
+        """Returns the key of the album an update belongs to, or None."""
+
+        message = update.get("message")
+        if not message or not message.get("media_group_id"):
+            return None
+
+        return message["chat"]["id"], message["media_group_id"]
+
+    def add(self, key, update):
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = _Group()
+
+        group.updates.append(update)
+
+        if group.timer:
+            group.timer.cancel()
+
+        if len(group.updates) >= MAX_ITEMS:
+            self.release(key)
+        else:
+            group.timer = asyncio.get_event_loop().call_later(self.window, self.release, key)
+
+    def release(self, key):
+        group = self.groups.pop(key, None)
+        if group is None:
+            return
+
+        if group.timer:
+            group.timer.cancel()
+
+        group.updates.sort(key=lambda update: update["message"]["message_id"])
+
+        try:
+            self.dispatch(group.updates)
+        except Exception:
+            log.exception("Dispatching album %s failed", key)
+
+    def release_all(self):
+        for key in list(self.groups):
+            self.release(key)
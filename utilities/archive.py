@@ -0,0 +1,272 @@
+import asyncio
+import json
+import sqlite3
+import threading
+from collections import deque
+
+from utilities.log import get_logger
+
+
+log = get_logger("archive")
+
+# update kinds that carry a message worth keeping
+MESSAGE_KEYS = ('message', 'edited_message', 'channel_post', 'edited_channel_post')
+
+MEDIA_KEYS = ('photo', 'animation', 'audio', 'document', 'video', 'voice', 'video_note', 'sticker')
+
+COLUMNS = ('chat_id', 'message_id', 'date', 'edit_date', 'user_id', 'username', 'reply_to',
+           'text', 'entities', 'media_type', 'file_id')
+
+# what reads return, the table's own id is left out
+SELECTED = ", ".join(COLUMNS)
+
+
+def _media(message):
+    for key in MEDIA_KEYS:
+        media = message.get(key)
+        if isinstance(media, list) and media:
+            # photos come as a list of sizes, the last is the largest
+            return key, media[-1].get("file_id")
+
+        if isinstance(media, dict):
+            return key, media.get("file_id")
+
+    return None, None
+
+
+def _row(message):
+    author = message.get("from") or {}
+    reply_to = message.get("reply_to_message") or {}
+    media_type, file_id = _media(message)
+    entities = message.get("entities") or message.get("caption_entities")
+
+    return (message["chat"]["id"], message["message_id"], message.get("date"), message.get("edit_date"),
+            author.get("id"), author.get("username"), reply_to.get("message_id"),
+            message.get("text") or message.get("caption"), json.dumps(entities) if entities else None,
+            media_type, file_id)
+
+
+def _fts_query(query):
+    # every word is matched as a quoted string, so user input can't break the FTS syntax
+    return " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+
+
+class MessageArchive():
+    """Keeps every message the bot receives (text, entities, author, chat,
+    replies and media file_ids) in SQLite, with full-text search over the text.
+
+        archive = MessageArchive("archive.db")
+        client = NatsukoClient(token, archive=archive)
+
+        hits = await archive.search("release notes", chat_id=chat_id)
+        recent = await archive.history(chat_id, limit=20)
+
+    Dispatch only appends the raw message to a buffer. The buffer is written
+    in one transaction every `flush_interval` seconds (or once `batch_size`
+    messages are waiting), off the event loop. Edits replace the stored
+    message. Past `max_pending` unwritten messages the oldest are dropped
+    rather than letting memory grow.
+    """
+
+    def __init__(self, path, batch_size=1000, flush_interval=1.0, max_pending=100000):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self.pending = deque()
+        self.written = 0
+        self.dropped = 0
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self._create()
+
+        # searches get their own connection, so they don't wait behind a write
+        self.read_lock = threading.Lock()
+        self.reader = sqlite3.connect(path, check_same_thread=False)
+        self.reader.row_factory = sqlite3.Row
+
+        self._flush_lock = None
+        self._flushing = None
+        self._task = None
+
+    def _create(self):
+        with self.db:
+            # the FTS index points at `id`, an implicit rowid could be renumbered by a VACUUM
+            self.db.execute("CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, "
+                            "chat_id INTEGER, message_id INTEGER, date INTEGER, edit_date INTEGER, "
+                            "user_id INTEGER, username TEXT, reply_to INTEGER, text TEXT, entities TEXT, "
+                            "media_type TEXT, file_id TEXT, UNIQUE (chat_id, message_id))")
+            self.db.execute("CREATE INDEX IF NOT EXISTS messages_user ON messages (user_id, date)")
+
+            try:
+                self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts "
+                                "USING fts5(text, content='messages', content_rowid='id')")
+            except sqlite3.OperationalError:
+                # sqlite built without FTS5, search() falls back to LIKE
+                log.warning("SQLite has no FTS5, message search will be slow")
+                self.fts = False
+                return
+
+            self.db.executescript("""
+                CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+                    INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+                END;
+                CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+                    INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+                END;
+                CREATE TRIGGER IF NOT EXISTS messages_au AFTER UPDATE OF text ON messages BEGIN
+                    INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+                    INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+                END;
+            """)
+            self.fts = True
+
+    async def _run_io(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    # Writing
+
+    def add(self, update):
+        """Queues the message in an update (a raw update dict) to be archived."""
+
+        for key in MESSAGE_KEYS:
+            message = update.get(key)
+            if message:
+                break
+        else:
+            return
+
+        self.pending.append(message)
+
+        if len(self.pending) > self.max_pending:
+            self.pending.popleft()
+            self.dropped += 1
+
+        if len(self.pending) >= self.batch_size and self._flushing is None and self._task:
+            self._flushing = asyncio.ensure_future(self.flush())
+            self._flushing.add_done_callback(self._flushed)
+
+    def _flushed(self, task):
+        self._flushing = None
+        if not task.cancelled() and task.exception():
+            log.error("Archive flush failed: %r", task.exception())
+
+    def _write(self, messages):
+        rows = []
+        for message in messages:
+            try:
+                rows.append(_row(message))
+            except (KeyError, TypeError):
+                log.debug("Not archiving malformed message %r", message)
+
+        updates = ", ".join(f"{c} = excluded.{c}" for c in COLUMNS[2:])
+
+        with self.lock, self.db:
+            self.db.executemany(f"INSERT INTO messages ({', '.join(COLUMNS)}) "
+                                f"VALUES ({', '.join('?' * len(COLUMNS))}) "
+                                f"ON CONFLICT (chat_id, message_id) DO UPDATE SET {updates}", rows)
+
+        return len(rows)
+
+    async def flush(self):
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+
+        async with self._flush_lock:
+            while self.pending:
+                batch = [self.pending.popleft() for _ in range(min(self.batch_size, len(self.pending)))]
+
+                try:
+                    self.written += await self._run_io(self._write, batch)
+                except Exception:
+                    # put them back for the next flush
+                    self.pending.extendleft(reversed(batch))
+                    raise
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("Archive flush failed")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._flush_periodically())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+        await self.flush()
+
+        with self.lock:
+            self.db.close()
+        with self.read_lock:
+            self.reader.close()
+
+    # Reading
+
+    def _query(self, sql, args):
+        with self.read_lock:
+            rows = self.reader.execute(sql, args).fetchall()
+
+        results = [dict(row) for row in rows]
+        for row in results:
+            if row.get("entities"):
+                row["entities"] = json.loads(row["entities"])
+
+        return results
+
+    async def search(self, query, chat_id=None, user_id=None, limit=50, before=None):
+        """Returns the stored messages matching every word of `query`, newest first,
+        optionally only in one chat, from one user or older than `before` (a unix date).
+        """
+
+        conditions, args = [], []
+
+        if self.fts:
+            conditions.append("m.id IN (SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?)")
+            args.append(_fts_query(query))
+        else:
+            for word in query.split():
+                conditions.append("m.text LIKE ?")
+                args.append(f"%{word}%")
+
+        for column, value in (("m.chat_id = ?", chat_id), ("m.user_id = ?", user_id), ("m.date < ?", before)):
+            if value is not None:
+                conditions.append(column)
+                args.append(value)
+
+        where = " AND ".join(conditions) or "1"
+        return await self._run_io(self._query, f"SELECT {SELECTED} FROM messages m WHERE {where} "
+                                               f"ORDER BY m.date DESC, m.message_id DESC LIMIT ?", (*args, limit))
+
+    async def history(self, chat_id, limit=50, before=None, user_id=None):
+        """Returns a chat's messages, newest first, optionally before a message_id
+        (to page backwards) and from one user.
+        """
+
+        conditions, args = ["chat_id = ?"], [chat_id]
+
+        if before is not None:
+            conditions.append("message_id < ?")
+            args.append(before)
+
+        if user_id is not None:
+            conditions.append("user_id = ?")
+            args.append(user_id)
+
+        return await self._run_io(self._query, f"SELECT {SELECTED} FROM messages WHERE {' AND '.join(conditions)} "
+                                               f"ORDER BY message_id DESC LIMIT ?", (*args, limit))
+
+    async def get(self, chat_id, message_id):
+        rows = await self._run_io(self._query, f"SELECT {SELECTED} FROM messages WHERE chat_id = ? AND message_id = ?",
+                                  (chat_id, message_id))
+        return rows[0] if rows else None
@@ -0,0 +1,344 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+import aiohttp
+
+from models.errors import APIError
+from utilities.log import get_logger
+
+
+log = get_logger("broadcast")
+
+# outcomes that mean the chat will never accept messages from the bot again
+DEAD = ('blocked', 'deactivated', 'not_found', 'kicked')
+
+# failures worth another go (network errors, Telegram's 5xx, flood waits past
+# the retries), stored but not counted as done, so a rerun sends them again
+RETRY = "retry"
+
+NETWORK_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, OSError)
+
+# media keys of a sent Message, and where its file_id lives
+MEDIA_KEYS = ('photo', 'audio', 'document', 'video', 'voice', 'video_note', 'animation', 'sticker')
+
+
+def classify_error(error):
+    """Maps an APIError from a send to a broadcast outcome."""
+
+    content = error.expression if isinstance(error.expression, dict) else {}
+    description = (content.get("description") or "").lower()
+    code = content.get("error_code")
+
+    if code == 403:
+        if "blocked" in description:
+            return "blocked"
+        if "deactivated" in description:
+            return "deactivated"
+        if "kicked" in description or "not a member" in description:
+            return "kicked"
+
+    if code == 400 and "chat not found" in description:
+        return "not_found"
+
+    if code == 429:
+        return "flood"
+
+    if code is None or code >= 500:
+        return RETRY
+
+    if (content.get("parameters") or {}).get("migrate_to_chat_id"):
+        return "migrated"
+
+    return "error"
+
+
+def sent_file_id(message):
+    """Returns the file_id of the media in a sent Message, to reuse it."""
+
+    # a Message, or its raw dict
+    message = getattr(message, "data", message)
+    if not isinstance(message, dict):
+        return None
+
+    for key in MEDIA_KEYS:
+        media = message.get(key)
+        if isinstance(media, list) and media:
+            # photos come as a list of sizes, the last is the largest
+            return media[-1].get("file_id")
+
+        if isinstance(media, dict):
+            return media.get("file_id")
+
+    return None
+
+
+class BroadcastStore():
+    """SQLite record of each chat's outcome per broadcast, which is what lets an
+    interrupted broadcast resume where it stopped.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS broadcast_results ("
+                        "name TEXT, chat_id INTEGER, status TEXT, detail TEXT, updated REAL, "
+                        "PRIMARY KEY (name, chat_id))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS broadcast_media (name TEXT PRIMARY KEY, file_id TEXT)")
+        self.db.commit()
+
+    def done(self, name, chat_ids):
+        """Returns which of the chat_ids already have a final outcome."""
+        with self.lock:
+            marks = ",".join("?" * len(chat_ids))
+            rows = self.db.execute(f"SELECT chat_id FROM broadcast_results WHERE name = ? AND status != ? "
+                                   f"AND chat_id IN ({marks})", (name, RETRY, *chat_ids)).fetchall()
+
+        return {r[0] for r in rows}
+
+    def record(self, name, results):
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO broadcast_results VALUES (?, ?, ?, ?, ?)",
+                                [(name, chat_id, status, detail, now) for chat_id, status, detail, now in results])
+
+    def media(self, name):
+        with self.lock:
+            row = self.db.execute("SELECT file_id FROM broadcast_media WHERE name = ?", (name,)).fetchone()
+
+        return row[0] if row else None
+
+    def set_media(self, name, file_id):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO broadcast_media VALUES (?, ?)", (name, file_id))
+
+    def summary(self, name):
+        with self.lock:
+            rows = self.db.execute("SELECT status, COUNT(*) FROM broadcast_results WHERE name = ? GROUP BY status",
+                                   (name,)).fetchall()
+
+        return dict(rows)
+
+    def chats(self, name, statuses):
+        """Returns (chat_id, status, detail) for the given outcomes."""
+        with self.lock:
+            marks = ",".join("?" * len(statuses))
+            return self.db.execute(f"SELECT chat_id, status, detail FROM broadcast_results "
+                                   f"WHERE name = ? AND status IN ({marks})", (name, *statuses)).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class Broadcast():
+    """Sends one message to many chats.
+
+        broadcast = Broadcast(client, "release-2.0", "broadcasts.db", on_dead=unsubscribe)
+        summary = await broadcast.send_message(subscriber_ids(), "We just released 2.0!")
+
+    `chat_ids` can be any iterable or async iterable and is consumed in chunks,
+    never held in memory as a whole. Sends are paced to `rate` messages per second
+    and pause for the whole broadcast when Telegram answers with a flood wait.
+
+    Every chat's outcome (ok, blocked, deactivated, not_found, kicked, migrated,
+    error, retry) is stored under the broadcast's name as soon as it's known, in
+    batches of `flush_size`; running a broadcast with the same name again skips
+    the chats that are already done, which is all of them but those left at
+    retry (network errors, Telegram's 5xx, retries exhausted). Dead chats are passed to
+    `on_dead(chat_id, status)`, migrated groups are resent to their new id and
+    passed to `on_migrate(old_id, new_id)`.
+
+    When the message is media sent from bytes, the file_id Telegram returns for the
+    first send is reused for the rest.
+    """
+
+    def __init__(self, client, name, store, rate=25, concurrency=10, chunk_size=500, **kwargs):
+        self.client = client
+        self.name = name
+        self.store = BroadcastStore(store) if isinstance(store, str) else store
+
+        self.interval = 1 / rate
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        self.retries = kwargs.get("retries", 3)
+        self.flush_size = kwargs.get("flush_size", 50)
+
+        self.on_dead = kwargs.get("on_dead")
+        self.on_migrate = kwargs.get("on_migrate")
+
+        self.counts = Counter()
+        self._results = []
+        self._resume_at = 0
+        self._next_send = 0
+
+    async def _run_io(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    async def _chunks(self, chat_ids):
+        chunk = []
+
+        if hasattr(chat_ids, "__aiter__"):
+            async for chat_id in chat_ids:
+                chunk.append(chat_id)
+                if len(chunk) >= self.chunk_size:
+                    yield chunk
+                    chunk = []
+        else:
+            for chat_id in chat_ids:
+                chunk.append(chat_id)
+                if len(chunk) >= self.chunk_size:
+                    yield chunk
+                    chunk = []
+
+        if chunk:
+            yield chunk
+
+    async def _pace(self):
+        # slots are handed out in order, so the rate holds however many sends are in flight
+        now = time.monotonic()
+        slot = max(now, self._next_send, self._resume_at)
+        self._next_send = slot + self.interval
+
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _send_one(self, chat_id, send):
+        target = chat_id
+
+        for attempt in range(self.retries + 1):
+            await self._pace()
+
+            try:
+                result = await send(target)
+                return "ok", str(target) if target != chat_id else None, result
+
+            except APIError as ex:
+                status = classify_error(ex)
+                content = ex.expression if isinstance(ex.expression, dict) else {}
+                parameters = content.get("parameters") or {}
+
+                if status == "flood":
+                    retry_after = parameters.get("retry_after", 5)
+                    log.warning("Flood wait of %ss during broadcast %s", retry_after, self.name)
+                    self._resume_at = time.monotonic() + retry_after
+                    continue
+
+                if status == "migrated":
+                    target = parameters["migrate_to_chat_id"]
+                    if self.on_migrate:
+                        await self.on_migrate(chat_id, target)
+                    continue
+
+                if status == RETRY and attempt < self.retries:
+                    await asyncio.sleep(2 ** attempt)
+                    continue
+
+                return status, ex.expression.get("description") if isinstance(ex.expression, dict) else str(ex), None
+
+            except NETWORK_ERRORS as ex:
+                if attempt < self.retries:
+                    await asyncio.sleep(2 ** attempt)
+                    continue
+
+                return RETRY, repr(ex), None
+
+            except Exception as ex:
+                # a broken send() mustn't take the rest of the broadcast down
+                log.exception("Sending to %s failed during broadcast %s", chat_id, self.name)
+                return RETRY, repr(ex), None
+
+        return RETRY, "retries exhausted", None
+
+    async def _deliver(self, chat_id, send, semaphore):
+        async with semaphore:
+            status, detail, result = await self._send_one(chat_id, send)
+
+        if status == "ok" and detail:
+            status = "migrated"
+
+        self.counts[status] += 1
+        self._results.append((chat_id, status, detail, time.time()))
+
+        if len(self._results) >= self.flush_size:
+            await self._flush()
+
+        if status in DEAD and self.on_dead:
+            await self.on_dead(chat_id, status)
+
+        return result
+
+    async def _flush(self):
+        if self._results:
+            results, self._results = self._results, []
+            await self._run_io(self.store.record, self.name, results)
+
+    async def run(self, chat_ids, send):
+        """Calls `send(chat_id)` for every chat not done yet, returns the outcome counts."""
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        self.counts = Counter()
+
+        async for chunk in self._chunks(chat_ids):
+            done = await self._run_io(self.store.done, self.name, chunk)
+            self.counts["skipped"] += len(done)
+
+            todo = [chat_id for chat_id in chunk if chat_id not in done]
+            try:
+                results = await asyncio.gather(*(self._deliver(chat_id, send, semaphore) for chat_id in todo),
+                                               return_exceptions=True)
+            finally:
+                # what was sent is saved even if the broadcast is cancelled
+                await self._flush()
+
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+
+        log.info("Broadcast %s finished: %s", self.name, dict(self.counts))
+        return dict(self.counts)
+
+    async def send_message(self, chat_ids, text, **kwargs):
+        async def send(chat_id):
+            # the outcome is needed now, not a coalescer handle
+            return await self.client.send_message(chat_id, text, immediate=True, **kwargs)
+
+        return await self.run(chat_ids, send)
+
+    async def send_media(self, chat_ids, kind, media, **kwargs):
+        """Broadcasts media with one of the client's send_<kind> methods (photo,
+        audio, document, video, voice, video_note). Bytes are uploaded once.
+        """
+
+        method = getattr(self.client, f"send_{kind}")
+        file_id = await self._run_io(self.store.media, self.name)
+        lock = asyncio.Lock()
+
+        async def send(chat_id):
+            nonlocal file_id
+
+            if file_id or isinstance(media, str):
+                return await method(chat_id, file_id or media, **kwargs)
+
+            # the first upload goes alone, everyone after it reuses its file_id
+            async with lock:
+                if file_id:
+                    return await method(chat_id, file_id, **kwargs)
+
+                result = await method(chat_id, media, **kwargs)
+
+                file_id = sent_file_id(result)
+                if file_id:
+                    await self._run_io(self.store.set_media, self.name, file_id)
+
+                return result
+
+        return await self.run(chat_ids, send)
+
+    def dead_chats(self):
+        return self.store.chats(self.name, DEAD)
+
+    def summary(self):
+        return self.store.summary(self.name)
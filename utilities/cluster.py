@@ -0,0 +1,257 @@
+import asyncio
+import multiprocessing
+import threading
+
+from utilities.log import get_logger
+
+
+log = get_logger("cluster")
+
+# update kinds that carry a chat, in the order they're checked
+CHAT_UPDATES = ('message', 'edited_message', 'channel_post', 'edited_channel_post')
+
+# how often a worker reports the updates it finished
+ACK_INTERVAL = 0.1
+
+
+def update_shard_key(update):
+    """Returns the id used to shard an update, the chat id where there is one
+    and the sender's id otherwise, so one chat always lands on one worker.
+    """
+
+    for kind in CHAT_UPDATES:
+        if kind in update:
+            return update[kind]['chat']['id']
+
+    callback = update.get('callback_query')
+    if callback and callback.get('message'):
+        return callback['message']['chat']['id']
+
+    for value in update.values():
+        if isinstance(value, dict) and 'from' in value:
+            return value['from']['id']
+
+    return update['update_id']
+
+
+class _Acks():
+    """Takes the place of a worker client's OffsetTracker: the update_ids its
+    handlers finished are sent back to the poller, which owns the offsets.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.update_ids = []
+
+    def done(self, update_id):
+        self.update_ids.append(update_id)
+
+    async def flush(self):
+        if self.update_ids:
+            update_ids, self.update_ids = self.update_ids, []
+            await asyncio.get_event_loop().run_in_executor(None, self.conn.send, update_ids)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(ACK_INTERVAL)
+            await self.flush()
+
+    async def close(self):
+        try:
+            await self.flush()
+        except (BrokenPipeError, OSError):
+            pass
+
+
+def _worker_main(factory, conn, index):
+    """Entry point of a worker process: builds its own client (and with it its
+    own loop, session and handlers) and feeds it the batches sent by the poller.
+    """
+
+    client = factory()
+    client.tracker = _Acks(conn)
+    log.info("Worker %d started", index)
+
+    async def serve():
+        # everything but polling, which the poller process does
+        client._start_services()
+        acks = asyncio.ensure_future(client.tracker.run())
+
+        try:
+            while True:
+                batch = await client.loop.run_in_executor(None, conn.recv)
+                if batch is None:
+                    break
+
+                client.manager.command_queue.extend(batch)
+                await client.process()
+        finally:
+            acks.cancel()
+
+    try:
+        client.loop.run_until_complete(serve())
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        client.loop.run_until_complete(client.shutdown())
+
+
+class Worker():
+
+    def __init__(self, cluster, index):
+        self.cluster = cluster
+        self.index = index
+        self.process = None
+        self.conn = None
+        # update_id -> update, sent but not acknowledged yet
+        self.in_flight = {}
+        self.lock = asyncio.Lock()
+
+    def start(self):
+        ctx = self.cluster.mp_context
+        self.conn, remote = ctx.Pipe()
+
+        self.process = ctx.Process(target=_worker_main, name=f"natsuko-worker-{self.index}",
+                                   args=(self.cluster.factory, remote, self.index), daemon=True)
+        self.process.start()
+        remote.close()
+
+        threading.Thread(target=self._read_acks, args=(self.conn,), name=f"natsuko-acks-{self.index}",
+                         daemon=True).start()
+
+    def _read_acks(self, conn):
+        loop = self.cluster.client.loop
+
+        while True:
+            try:
+                update_ids = conn.recv()
+            except (EOFError, OSError):
+                return
+
+            loop.call_soon_threadsafe(self.cluster.acked, self, update_ids)
+
+    def send(self, batch):
+        # blocks while the pipe is full, only called off the event loop
+        self.conn.send(batch)
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def stop(self, timeout=5):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+
+        self.conn.close()
+
+
+class Cluster():
+    """Scale-out mode: this process owns the UpdateManager and its offsets, and
+    shards updates by chat id across `workers` processes, each one running a
+    client built by `factory`. A chat always maps to the same worker, so its
+    updates are dispatched in order. Dead workers are restarted.
+
+    An update is only marked done once the worker reports its handlers
+    finished; the updates a dead worker hadn't finished are sent again to
+    the one that replaces it.
+
+    `factory` is a module level function returning a NatsukoClient with its
+    handlers registered. With the default "spawn" start method the entry script
+    must be guarded by `if __name__ == "__main__":`.
+
+        def make_client():
+            client = NatsukoClient(settings.TOKEN)
+            client.command("hello")(hello_command)
+            return client
+
+        if __name__ == "__main__":
+            Cluster(make_client, workers=4).run()
+    """
+
+    def __init__(self, factory, workers=None, **kwargs):
+        self.factory = factory
+        self.mp_context = multiprocessing.get_context(kwargs.get("start_method", "spawn"))
+        self.size = workers or multiprocessing.cpu_count()
+        self.supervise_interval = kwargs.get("supervise_interval", 1)
+
+        self.workers = [Worker(self, i) for i in range(self.size)]
+
+        # the poller only uses the client for its UpdateManager
+        self.client = factory()
+        self.client.manager.callback = self.distribute
+
+    async def _send(self, worker, batch):
+        # pickling and writing a big batch would block the loop
+        await self.client.loop.run_in_executor(None, worker.send, batch)
+
+    async def _restart(self, worker):
+        log.warning("Worker %d died (exit code %s), restarting", worker.index, worker.process.exitcode)
+        worker.stop(timeout=0)
+        worker.start()
+
+        if worker.in_flight:
+            log.warning("Replaying %d unfinished updates on worker %d", len(worker.in_flight), worker.index)
+            await self._send(worker, sorted(worker.in_flight.values(), key=lambda update: update["update_id"]))
+
+    async def _deliver(self, worker, batch):
+        async with worker.lock:
+            if not worker.is_alive():
+                # the replay includes this batch
+                await self._restart(worker)
+                return
+
+            try:
+                await self._send(worker, batch)
+            except (BrokenPipeError, OSError):
+                await self._restart(worker)
+
+    def acked(self, worker, update_ids):
+        for update_id in update_ids:
+            worker.in_flight.pop(update_id, None)
+            if self.client.tracker:
+                self.client.tracker.done(update_id)
+
+    async def distribute(self):
+        queue = self.client.manager.command_queue
+        batches = [[] for _ in self.workers]
+
+        while queue:
+            update = queue.pop(0)
+            batches[update_shard_key(update) % self.size].append(update)
+
+        deliveries = []
+        for worker, batch in zip(self.workers, batches):
+            if batch:
+                worker.in_flight.update((update["update_id"], update) for update in batch)
+                deliveries.append(self._deliver(worker, batch))
+
+        await asyncio.gather(*deliveries)
+
+    async def supervise(self):
+        while True:
+            await asyncio.sleep(self.supervise_interval)
+
+            for worker in self.workers:
+                if not worker.is_alive():
+                    async with worker.lock:
+                        if not worker.is_alive():
+                            await self._restart(worker)
+
+    def run(self):
+        for worker in self.workers:
+            worker.start()
+
+        log.info("Started %d workers", self.size)
+        supervisor = asyncio.ensure_future(self.supervise(), loop=self.client.loop)
+
+        try:
+            self.client.run()
+        finally:
+            supervisor.cancel()
+            for worker in self.workers:
+                worker.stop()
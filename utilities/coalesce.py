@@ -0,0 +1,286 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from models import endpoints as api
+from models.errors import APIError
+from utilities.log import get_logger
+
+
+log = get_logger("coalesce")
+
+MAX_MESSAGE_LENGTH = 4096
+
+# sends with these options are about one specific message or carry offsets
+# into their own text, they're never merged
+UNMERGEABLE = ('reply_markup', 'reply_to_message_id', 'reply', 'reply_parameters', 'entities')
+
+
+def is_not_modified(error):
+    content = error.expression if isinstance(error.expression, dict) else {}
+    return "message is not modified" in (content.get("description") or "")
+
+
+class Pending():
+    """What a coalesced call returns right away, without waiting for the merged
+    call to go out. Await it for the result (the Message the text ended up in,
+    or the edit's result) when it's needed:
+
+        handle = await client.send_message(chat_id, "Working on it...")
+        message = await handle
+
+    Failures nobody awaits are logged.
+    """
+
+    __slots__ = ['future']
+
+    def __init__(self, future):
+        self.future = future
+        future.add_done_callback(self._log_failure)
+
+    @staticmethod
+    def _log_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            log.warning("Coalesced call failed: %r", future.exception())
+
+    def __await__(self):
+        return self.future.__await__()
+
+    def done(self):
+        return self.future.done()
+
+    def result(self):
+        return self.future.result()
+
+
+class _PendingSend():
+
+    __slots__ = ['options', 'parts', 'futures', 'length', 'timer']
+
+    def __init__(self, options):
+        self.options = options
+        self.parts = []
+        self.futures = []
+        self.length = 0
+        self.timer = None
+
+
+class _PendingEdit():
+
+    __slots__ = ['text', 'options', 'futures', 'timer']
+
+    def __init__(self):
+        self.text = None
+        self.options = None
+        self.futures = []
+        self.timer = None
+
+
+class OutboundCoalescer():
+    """Merges and debounces outgoing text.
+
+    Calls return a Pending handle as soon as they're queued, so a handler
+    awaiting one send after another still has them merged; await the handle
+    for the result.
+
+    Consecutive send_message calls to one chat within `send_window` seconds are
+    joined (with `separator`) into as few messages as the 4096 character limit
+    allows; each handle resolves to the Message its text ended up in. A chat's
+    messages go out one after another, in the order they were sent.
+
+    The first edit_message_text of a message goes out right away. Further edits
+    within `edit_window` seconds of it collapse into one trailing edit with the
+    latest text, so a message is edited at most once per window. Edits to the
+    text and options a message already has are skipped, and "message is not
+    modified" errors are swallowed.
+    """
+
+    def __init__(self, client, send_window=0.05, edit_window=0.5, separator="\n", remember=10000):
+        self.client = client
+        self.send_window = send_window
+        self.edit_window = edit_window
+        self.separator = separator
+
+        self.sends = {}
+        self.edits = {}
+        # the last send scheduled for each chat, the next one waits for it
+        self.tails = {}
+
+        # last (text, options) sent to each message, to skip no-op edits
+        self.texts = OrderedDict()
+        self.remember = remember
+
+        # when each message was last edited, for the leading edge of the debounce
+        self.edited_at = OrderedDict()
+
+    def _future(self):
+        return asyncio.get_event_loop().create_future()
+
+    def _done(self, result):
+        future = self._future()
+        future.set_result(result)
+        return Pending(future)
+
+    # Sends
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if any(option in kwargs for option in UNMERGEABLE) or len(text) > MAX_MESSAGE_LENGTH:
+            # after whatever is queued for the chat, and before anything sent later
+            self._dispatch(chat_id)
+            return self._done(await self._enqueue(chat_id, lambda: self._send(chat_id, text, kwargs)))
+
+        pending = self.sends.get(chat_id)
+        added = len(text) + (len(self.separator) if pending and pending.parts else 0)
+
+        if pending and (pending.options != kwargs or pending.length + added > MAX_MESSAGE_LENGTH):
+            self._dispatch(chat_id)
+            pending = None
+
+        if pending is None:
+            pending = self.sends[chat_id] = _PendingSend(kwargs)
+            pending.timer = asyncio.get_event_loop().call_later(
+                self.send_window, lambda: asyncio.ensure_future(self.flush_chat(chat_id)))
+            added = len(text)
+
+        future = self._future()
+        pending.parts.append(text)
+        pending.futures.append(future)
+        pending.length += added
+
+        return Pending(future)
+
+    def _enqueue(self, chat_id, send):
+        """Runs `send()` once the chat's earlier sends are done, returns its task."""
+
+        previous = self.tails.get(chat_id)
+
+        async def run():
+            if previous is not None:
+                await asyncio.wait([previous])
+            return await send()
+
+        task = self.tails[chat_id] = asyncio.ensure_future(run())
+        task.add_done_callback(lambda _: self.tails.get(chat_id) is task and self.tails.pop(chat_id))
+
+        return task
+
+    def _dispatch(self, chat_id):
+        # the chat's queued batch takes its place in line now, without waiting
+        pending = self.sends.pop(chat_id, None)
+        if pending is None:
+            return
+
+        pending.timer.cancel()
+        self._enqueue(chat_id, lambda: self._send_batch(chat_id, pending))
+
+    async def flush_chat(self, chat_id):
+        self._dispatch(chat_id)
+
+        task = self.tails.get(chat_id)
+        if task is not None:
+            await asyncio.wait([task])
+
+    async def _send_batch(self, chat_id, pending):
+        try:
+            result = await self._send(chat_id, self.separator.join(pending.parts), pending.options)
+        except Exception as ex:
+            for future in pending.futures:
+                if not future.done():
+                    future.set_exception(ex)
+            return
+
+        for future in pending.futures:
+            if not future.done():
+                future.set_result(result)
+
+    async def _send(self, chat_id, text, options):
+        return await self.client._call(api.SEND_MESSAGE, chat_id=chat_id, text=text, **options)
+
+    # Edits
+
+    async def edit_message_text(self, chat_id, msg_id, text, **kwargs):
+        key = (chat_id, msg_id)
+        pending = self.edits.get(key)
+
+        if pending is None:
+            last = self.edited_at.get(key)
+            now = time.monotonic()
+
+            # leading edge: not edited lately, so this one goes out now
+            if last is None or now - last >= self.edit_window:
+                self._edited(key)
+                return self._done(await self._edit(chat_id, msg_id, text, kwargs))
+
+            pending = self.edits[key] = _PendingEdit()
+            pending.timer = asyncio.get_event_loop().call_later(
+                last + self.edit_window - now, lambda: asyncio.ensure_future(self.flush_edit(key)))
+
+        pending.text = text
+        pending.options = kwargs
+
+        future = self._future()
+        pending.futures.append(future)
+
+        return Pending(future)
+
+    def _edited(self, key):
+        self.edited_at[key] = time.monotonic()
+        self.edited_at.move_to_end(key)
+
+        if len(self.edited_at) > self.remember:
+            self.edited_at.popitem(last=False)
+
+    async def flush_edit(self, key):
+        pending = self.edits.pop(key, None)
+        if pending is None:
+            return
+
+        pending.timer.cancel()
+        chat_id, msg_id = key
+        self._edited(key)
+
+        try:
+            result = await self._edit(chat_id, msg_id, pending.text, pending.options)
+        except Exception as ex:
+            for future in pending.futures:
+                if not future.done():
+                    future.set_exception(ex)
+            return
+
+        for future in pending.futures:
+            if not future.done():
+                future.set_result(result)
+
+    async def _edit(self, chat_id, msg_id, text, options):
+        key = (chat_id, msg_id)
+        if self.texts.get(key) == (text, options):
+            return True
+
+        try:
+            result = await self.client._call(api.EDIT_MESSAGE_TEXT, chat_id=chat_id, message_id=msg_id,
+                                             text=text, **options)
+        except APIError as ex:
+            if not is_not_modified(ex):
+                raise
+
+            result = True
+
+        self.texts[key] = (text, options)
+        self.texts.move_to_end(key)
+        if len(self.texts) > self.remember:
+            self.texts.popitem(last=False)
+
+        return result
+
+    def forget(self, chat_id, msg_id):
+        """Called when a message is edited (or deleted) without the coalescer,
+        so its next edit isn't skipped as a no-op.
+        """
+
+        self.texts.pop((chat_id, msg_id), None)
+
+    async def flush(self):
+        """Sends everything that's waiting, eg. on shutdown."""
+
+        await asyncio.gather(*[self.flush_chat(chat_id) for chat_id in {*self.sends, *self.tails}],
+                             *[self.flush_edit(key) for key in list(self.edits)])
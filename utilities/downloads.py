@@ -0,0 +1,262 @@
+import asyncio
+import inspect
+import os
+import shutil
+from collections import OrderedDict
+
+import aiohttp
+
+from utilities.log import get_logger
+
+
+log = get_logger("downloads")
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _field(obj, name):
+    if isinstance(obj, dict):
+        return obj.get(name)
+
+    return getattr(obj, name, None)
+
+
+class MediaCache():
+    """On-disk content cache for downloaded files, keyed by file_unique_id (or
+    file_id). The least recently used files are evicted once the cache grows
+    past `max_bytes`.
+    """
+
+    def __init__(self, directory, max_bytes=1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".part"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.size += size
+
+    def _key(self, key):
+        # file ids are url-safe base64, but don't trust them with the filesystem
+        return "".join(c for c in str(key) if c.isalnum() or c in "-_")
+
+    def path(self, key):
+        return os.path.join(self.directory, self._key(key))
+
+    def partial_path(self, key):
+        return self.path(key) + ".part"
+
+    def get(self, key):
+        """Returns the cached file's path, or None."""
+        key = self._key(key)
+        if key not in self.entries:
+            return None
+
+        self.entries.move_to_end(key)
+        return os.path.join(self.directory, key)
+
+    def put(self, key, source):
+        """Moves a finished download into the cache and evicts old entries."""
+        key = self._key(key)
+        path = os.path.join(self.directory, key)
+        os.replace(source, path)
+
+        self.size -= self.entries.pop(key, 0)
+        self.entries[key] = os.path.getsize(path)
+        self.size += self.entries[key]
+
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            old, size = self.entries.popitem(last=False)
+            self.size -= size
+
+            try:
+                os.remove(os.path.join(self.directory, old))
+            except FileNotFoundError:
+                pass
+
+        return path
+
+
+class Downloader():
+    """Streams Telegram files to disk or to an async sink.
+
+    Downloads go through a `.part` file and are resumed with an HTTP Range
+    request when the connection drops. At most `concurrency` downloads run at
+    once. With a MediaCache, each file is only fetched once.
+    """
+
+    def __init__(self, client, concurrency=4, cache=None, chunk_size=CHUNK_SIZE, retries=3):
+        self.client = client
+        self.cache = cache
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+        # one fetch per file, concurrent requests for it wait on the same task
+        self._fetching = {}
+
+    async def _resolve(self, file):
+        if isinstance(file, str):
+            file = await self.client.get_file(file)
+
+        if not _field(file, "file_path"):
+            file = await self.client.get_file(_field(file, "file_id"))
+
+        return file
+
+    async def _run_io(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    async def _fetch(self, url, path):
+        """Downloads url into path, resuming from what's already there."""
+
+        for attempt in range(self.retries + 1):
+            offset = os.path.getsize(path) if os.path.exists(path) else 0
+            headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+            try:
+                async with self.semaphore, self.client.session.get(url, headers=headers) as resp:
+                    if resp.status == 416:
+                        # range not satisfiable, the file is already complete
+                        return path
+
+                    resp.raise_for_status()
+                    mode = "ab" if resp.status == 206 else "wb"
+
+                    f = await self._run_io(open, path, mode)
+                    try:
+                        async for chunk in resp.content.iter_chunked(self.chunk_size):
+                            await self._run_io(f.write, chunk)
+                    finally:
+                        await self._run_io(f.close)
+
+                return path
+
+            except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == self.retries:
+                    raise
+
+                log.warning("Download interrupted, resuming (attempt %d)", attempt + 1)
+                await asyncio.sleep(2 ** attempt)
+
+    async def _stream(self, url, sink):
+        """Streams url to sink, resuming after what the sink already got."""
+
+        total = 0
+
+        for attempt in range(self.retries + 1):
+            headers = {"Range": f"bytes={total}-"} if total else {}
+
+            try:
+                async with self.semaphore, self.client.session.get(url, headers=headers) as resp:
+                    if resp.status == 416:
+                        return total
+
+                    resp.raise_for_status()
+                    # a server ignoring the range starts over, skip what was delivered
+                    skip = total if resp.status != 206 else 0
+
+                    async for chunk in resp.content.iter_chunked(self.chunk_size):
+                        if skip:
+                            cut = min(skip, len(chunk))
+                            chunk, skip = chunk[cut:], skip - cut
+                            if not chunk:
+                                continue
+
+                        await sink(chunk)
+                        total += len(chunk)
+
+                return total
+
+            except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == self.retries:
+                    raise
+
+                log.warning("Download interrupted after %d bytes, resuming (attempt %d)", total, attempt + 1)
+                await asyncio.sleep(2 ** attempt)
+
+    async def _stream_file(self, path, sink):
+        total = 0
+        f = await self._run_io(open, path, "rb")
+        try:
+            while True:
+                chunk = await self._run_io(f.read, self.chunk_size)
+                if not chunk:
+                    return total
+
+                await sink(chunk)
+                total += len(chunk)
+        finally:
+            await self._run_io(f.close)
+
+    async def _cached(self, key, url):
+        path = self.cache.get(key)
+        if path:
+            return path
+
+        task = self._fetching.get(key)
+        if task is None:
+            async def fetch():
+                try:
+                    partial = await self._fetch(url, self.cache.partial_path(key))
+                    return self.cache.put(key, partial)
+                finally:
+                    del self._fetching[key]
+
+            task = self._fetching[key] = asyncio.ensure_future(fetch())
+
+        return await asyncio.shield(task)
+
+    async def download(self, file, destination=None):
+        """Downloads a file (file_id, File dict/object) to `destination`.
+
+        destination is a path, an async callable that receives each chunk, or
+        a file-like object (its write() is run off the loop unless it's async).
+        Without one the file is kept in the cache (required in that case).
+        Returns the path written to, or the byte count when streaming to a sink.
+        """
+
+        file = await self._resolve(file)
+        url = await self.client.get_file_url(file)
+        key = _field(file, "file_unique_id") or _field(file, "file_id")
+
+        if hasattr(destination, "write") and not callable(destination):
+            write = destination.write
+            if inspect.iscoroutinefunction(write):
+                destination = write
+            else:
+                async def destination(chunk):
+                    await self._run_io(write, chunk)
+
+        if self.cache:
+            path = await self._cached(key, url)
+
+            if destination is None:
+                return path
+
+            if callable(destination):
+                return await self._stream_file(path, destination)
+
+            await self._run_io(shutil.copyfile, path, destination)
+            return destination
+
+        if destination is None:
+            raise ValueError("A destination is required when downloading without a cache")
+
+        if callable(destination):
+            return await self._stream(url, destination)
+
+        partial = await self._fetch(url, f"{destination}.part")
+        await self._run_io(os.replace, partial, destination)
+        return destination
@@ -0,0 +1,195 @@
+import asyncio
+import itertools
+import json
+import time
+
+from aiohttp import web
+
+from utilities.log import get_logger
+
+
+log = get_logger("fakeapi")
+
+
+def synthetic_update(update_id, chat_id=1, text="/ping", user_id=1):
+    """Builds a text message update, with a bot_command entity when the text is a command."""
+
+    command = text.split()[0]
+    entities = [{"type": "bot_command", "offset": 0, "length": len(command)}] if command.startswith("/") else []
+
+    return {"update_id": update_id,
+            "message": {"message_id": update_id, "date": int(time.time()), "text": text,
+                        "from": {"id": user_id, "is_bot": False, "first_name": "bench", "username": f"user{user_id}"},
+                        "chat": {"id": chat_id, "type": "private", "title": None},
+                        "entities": entities}}
+
+
+def load_updates(path):
+    """Reads recorded updates, one getUpdates batch (a JSON list) or update per line."""
+
+    updates = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+
+            data = json.loads(line)
+            updates.extend(data if isinstance(data, list) else [data])
+
+    return updates
+
+
+class FakeBotAPI():
+    """Local stand-in for the Bot API, for tests and benchmarks.
+
+    It serves queued updates through getUpdates (honouring offset, limit and the
+    long poll timeout) and answers every other method with a fake Message,
+    recording each call in `calls`. Point a client at it with
+    `NatsukoClient(token, api_url=fake.url)`.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.host = host
+        self.port = port
+
+        self.updates = []
+        self.calls = []
+        self.served_at = {}
+        self.polls = []
+        self.handlers = {}
+        self.files = {}
+
+        self._message_ids = itertools.count(1)
+        self._new_updates = asyncio.Event()
+        self._runner = None
+        self._closing = False
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def push(self, updates):
+        self.updates.extend(updates)
+        self._new_updates.set()
+
+    def add_file(self, file_id, content, file_unique_id=None):
+        """Makes a file available through getFile and the file download endpoint."""
+        self.files[file_id] = {"file_id": file_id, "file_unique_id": file_unique_id or file_id,
+                               "file_size": len(content), "file_path": f"documents/{file_id}",
+                               "content": content}
+
+    def on(self, method, handler):
+        """Overrides the response for a method, `handler(params)` returns the result."""
+        self.handlers[method] = handler
+
+    async def _params(self, request):
+        params = dict(request.query)
+
+        if request.method == "POST":
+            for key, value in (await request.post()).items():
+                params[key] = value if isinstance(value, str) else value.file.read()
+
+        return params
+
+    async def get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        deadline = time.monotonic() + float(params.get("timeout") or 0)
+
+        while True:
+            # updates below the offset are confirmed and can be forgotten
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+            if self.updates:
+                break
+
+            if self._closing:
+                return []
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return []
+
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), remaining)
+            except asyncio.TimeoutError:
+                return []
+
+        batch = self.updates[:limit]
+        now = time.perf_counter()
+        for update in batch:
+            self.served_at.setdefault(update["update_id"], now)
+
+        return batch
+
+    def default_result(self, method, params):
+        if method == "getFile":
+            stored = self.files.get(params.get("file_id"))
+            if stored is None:
+                return {"ok": False, "error_code": 400, "description": "Bad Request: invalid file_id"}
+
+            return {k: v for k, v in stored.items() if k != "content"}
+
+        if not method.startswith(("send", "forward", "edit")):
+            return True
+
+        if method == "sendMediaGroup":
+            return [{"message_id": next(self._message_ids), "date": int(time.time()),
+                     "chat": {"id": params.get("chat_id"), "type": "private"}}
+                    for _ in json.loads(params["media"])]
+
+        return {"message_id": next(self._message_ids), "date": int(time.time()),
+                "chat": {"id": params.get("chat_id"), "type": "private"},
+                "text": params.get("text")}
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        params = await self._params(request)
+
+        if method == "getUpdates":
+            self.polls.append(time.perf_counter())
+            result = await self.get_updates(params)
+        else:
+            self.calls.append((method, params, time.perf_counter()))
+            handler = self.handlers.get(method)
+            result = handler(params) if handler else self.default_result(method, params)
+
+        if isinstance(result, dict) and result.get("ok") is False:
+            return web.json_response(result)
+
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle_file(self, request):
+        file_id = request.match_info["path"].rsplit("/", 1)[-1]
+        stored = self.files.get(file_id)
+        if stored is None:
+            raise web.HTTPNotFound()
+
+        # aiohttp answers Range requests on its own
+        return web.Response(body=stored["content"], content_type="application/octet-stream")
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.handle_file)
+
+        self._runner = web.AppRunner(app, shutdown_timeout=1)
+        await self._runner.setup()
+
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+
+        if not self.port:
+            self.port = site._server.sockets[0].getsockname()[1]
+
+        log.info("Fake Bot API listening on %s", self.url)
+
+    async def stop(self):
+        # release the long polls still waiting
+        self._closing = True
+        self._new_updates.set()
+
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
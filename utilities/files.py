@@ -0,0 +1,104 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+
+from utilities.log import get_logger
+
+
+log = get_logger("files")
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class StaticFileCache():
+    """Keeps the contents of frequently sent files in memory, keyed by path and
+    validated against the file's mtime and size, so a static asset is read from
+    disk once rather than on every send. The file is stat'ed again at most every
+    `recheck` seconds. Files over `max_file_size` are read but never cached.
+
+    Only files sent through `NatsukoClient.static_file` use it, so one-off
+    uploads (reports, generated images) don't fill it up.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 ** 2, max_file_size=8 * 1024 ** 2, recheck=1.0):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.recheck = recheck
+
+        self.size = 0
+        self.entries = OrderedDict()
+        self._reading = {}
+
+    async def _run_io(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    async def read(self, path):
+        path = os.fspath(path)
+        entry = self.entries.get(path)
+        now = time.monotonic()
+
+        if entry and now - entry["checked"] < self.recheck:
+            self.entries.move_to_end(path)
+            return entry["data"]
+
+        # one disk read per path, however many sends are waiting for it
+        task = self._reading.get(path)
+        if task is None:
+            task = self._reading[path] = asyncio.ensure_future(self._load(path))
+            task.add_done_callback(lambda _: self._reading.pop(path, None))
+
+        return await asyncio.shield(task)
+
+    async def _load(self, path):
+        stat = await self._run_io(os.stat, path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        entry = self.entries.get(path)
+
+        if entry and entry["version"] == version:
+            entry["checked"] = time.monotonic()
+            self.entries.move_to_end(path)
+            return entry["data"]
+
+        data = await self._run_io(_read, path)
+
+        if entry:
+            self.size -= len(entry["data"])
+            del self.entries[path]
+
+        if len(data) <= self.max_file_size:
+            self.entries[path] = {"version": version, "data": data, "checked": time.monotonic()}
+            self.size += len(data)
+
+            while self.size > self.max_bytes:
+                _, old = self.entries.popitem(last=False)
+                self.size -= len(old["data"])
+
+        return data
+
+
+class AsyncFile():
+    """A file to upload, read off the event loop when the request is made.
+
+        await client.send_photo(chat_id, AsyncFile("banner.jpg"))
+
+    With a StaticFileCache (see `NatsukoClient.static_file`) the contents are
+    served from memory while the file on disk is unchanged.
+    """
+
+    def __init__(self, path, filename=None, cache=None):
+        self.path = os.fspath(path)
+        self.filename = filename or os.path.basename(self.path)
+        self.cache = cache
+
+    async def read(self):
+        if self.cache:
+            return await self.cache.read(self.path)
+
+        return await asyncio.get_event_loop().run_in_executor(None, _read, self.path)
+
+    def __repr__(self):
+        return f"<AsyncFile {self.path}>"
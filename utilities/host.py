@@ -0,0 +1,129 @@
+import asyncio
+import concurrent.futures
+import signal
+
+import aiohttp
+
+from utilities.log import get_logger
+from utilities.polling import MAX_SLOT_TIMEOUT
+
+
+log = get_logger("host")
+
+
+class BotHost():
+    """Runs many bots in one process, on one event loop.
+
+        host = BotHost(poll_slots=8)
+        weather = host.add(WEATHER_TOKEN, name="weather")
+        quotes = host.add(QUOTES_TOKEN, name="quotes", rate_limit=20)
+
+        @weather.command("forecast")
+        async def forecast(event):
+            ...
+
+        host.run()
+
+    The bots share one connection pool for API calls, another for long polls
+    and the handler thread/process pools. Each bot keeps its own handlers,
+    offset (and offset store), state, rate limit and usage counters.
+
+    With `poll_slots` set, at most that many long polls are open at once and
+    the bots take turns in the order they asked. A bot holds its slot for its
+    whole poll even when it has nothing to receive, so `poll_timeout` is then
+    capped at MAX_SLOT_TIMEOUT (10s) for every bot; with more bots than slots
+    an update still waits for the polls queued ahead of its bot. Without
+    poll_slots every bot keeps its own poll open.
+    """
+
+    def __init__(self, **kwargs):
+        self.loop = asyncio.get_event_loop()
+        self.bots = {}
+
+        self.poll_slots = None
+        if kwargs.get("poll_slots"):
+            self.poll_slots = asyncio.Semaphore(kwargs["poll_slots"])
+
+        self.poll_timeout = kwargs.get("poll_timeout", MAX_SLOT_TIMEOUT if self.poll_slots else 100)
+
+        # polls hold their connection for the whole timeout, so they get a pool of
+        # their own and can never starve the API calls
+        connector = aiohttp.TCPConnector(limit=kwargs.get("connections", 100), loop=self.loop)
+        self.session = aiohttp.ClientSession(loop=self.loop, connector=connector)
+
+        connector = aiohttp.TCPConnector(limit=kwargs.get("poll_slots") or 0, loop=self.loop)
+        self.poll_session = aiohttp.ClientSession(loop=self.loop, connector=connector)
+
+        self.thread_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=kwargs.get("thread_workers"), thread_name_prefix="natsuko-handler")
+        self.process_pool = None
+        self.process_workers = kwargs.get("process_workers")
+        self.mp_context = kwargs.get("mp_context")
+
+        self._tasks = {}
+
+    def add(self, token, **kwargs):
+        """Creates a NatsukoClient for `token` on the shared pools and returns it.
+        kwargs are passed to the client, `name` identifies it in logs and usage().
+        """
+
+        from natsuko import NatsukoClient
+
+        if self.process_workers:
+            if self.process_pool is None:
+                self.process_pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.process_workers, mp_context=self.mp_context)
+            kwargs.setdefault("process_pool", self.process_pool)
+
+        kwargs.setdefault("poll_timeout", self.poll_timeout)
+        client = NatsukoClient(token, session=self.session, poll_session=self.poll_session,
+                               poll_slots=self.poll_slots, thread_pool=self.thread_pool, **kwargs)
+
+        if client.name in self.bots:
+            raise ValueError(f"A bot named {client.name} is already hosted")
+
+        self.bots[client.name] = client
+        return client
+
+    def usage(self):
+        """Returns each bot's resource_usage(), by name."""
+        return {name: bot.resource_usage() for name, bot in self.bots.items()}
+
+    def run(self):
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+        try:
+            self.loop.run_until_complete(self._run())
+        finally:
+            self.loop.run_until_complete(self.shutdown())
+
+    async def _run(self):
+        self._tasks = {name: asyncio.ensure_future(bot._run()) for name, bot in self.bots.items()}
+        log.info("Hosting %d bots", len(self._tasks))
+
+        # a bot whose poller dies is logged and left stopped, the others keep going
+        for name, result in zip(self._tasks, await asyncio.gather(*self._tasks.values(), return_exceptions=True)):
+            if isinstance(result, Exception):
+                log.error("Bot %s stopped: %r", name, result)
+
+    def stop(self):
+        log.info("Stopping %d bots", len(self.bots))
+        for bot in self.bots.values():
+            bot.stop()
+
+    async def shutdown(self, timeout=None):
+        await asyncio.gather(*(bot.shutdown(timeout) for bot in self.bots.values()), return_exceptions=True)
+
+        for session in (self.session, self.poll_session):
+            if not session.closed:
+                await session.close()
+
+        for pool in (self.thread_pool, self.process_pool):
+            if pool is not None:
+                pool.shutdown()
+
+        log.info("Host shut down")
@@ -0,0 +1,137 @@
+import asyncio
+import inspect
+import itertools
+import time
+from collections import OrderedDict
+
+from utilities.log import get_logger
+
+
+log = get_logger("inline")
+
+# Telegram takes at most 50 results per answer
+MAX_PAGE_SIZE = 50
+
+
+def normalize_query(query):
+    """Case and whitespace don't make a different query."""
+    return " ".join((query or "").lower().split())
+
+
+def parse_offset(offset):
+    try:
+        return max(int(offset), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+class _CachedResults():
+
+    __slots__ = ['results', 'source', 'started', 'expires', 'lock']
+
+    def __init__(self, expires):
+        self.results = []
+        self.source = None
+        self.started = False
+        self.expires = expires
+        self.lock = asyncio.Lock()
+
+
+class InlineResultCache():
+    """Result sets of inline queries, by normalized query, kept for `ttl`
+    seconds and at most `max_entries` of them (least recently used go first).
+
+    Results are produced lazily: a handler can return a list, or a sync or
+    async generator that is only advanced as far as the pages asked for so far.
+    """
+
+    def __init__(self, max_entries=1000, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def _entry(self, key):
+        entry = self.entries.get(key)
+        now = time.monotonic()
+
+        if entry is not None and entry.expires > now:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        entry = self.entries[key] = _CachedResults(now + self.ttl)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+        return entry
+
+    async def _start(self, entry, produce):
+        source = produce()
+        if inspect.isawaitable(source):
+            source = await source
+
+        if source is None:
+            source = []
+
+        if isinstance(source, (list, tuple)):
+            entry.results.extend(source)
+        elif hasattr(source, "__aiter__"):
+            entry.source = source.__aiter__()
+        else:
+            entry.source = iter(source)
+
+        entry.started = True
+
+    async def _pull(self, entry, count):
+        source = entry.source
+
+        if hasattr(source, "__anext__"):
+            for _ in range(count):
+                try:
+                    entry.results.append(await source.__anext__())
+                except StopAsyncIteration:
+                    entry.source = None
+                    return
+            return
+
+        # sync generators may do real work, advance them off the event loop
+        chunk = await asyncio.get_event_loop().run_in_executor(None, list, itertools.islice(source, count))
+        entry.results.extend(chunk)
+
+        if len(chunk) < count:
+            entry.source = None
+
+    async def page(self, key, produce, offset=0, page_size=MAX_PAGE_SIZE):
+        """Returns (results, next_offset) for the page starting at `offset`, calling
+        `produce()` for the result source on a cache miss. next_offset is "" on
+        the last page.
+        """
+
+        entry = self._entry(key)
+        end = offset + page_size
+
+        try:
+            async with entry.lock:
+                if not entry.started:
+                    await self._start(entry, produce)
+
+                # one past the page, to know whether there's another one
+                if entry.source is not None and len(entry.results) <= end:
+                    await self._pull(entry, end + 1 - len(entry.results))
+        except BaseException:
+            # don't keep a half-built result set around
+            if self.entries.get(key) is entry:
+                del self.entries[key]
+            raise
+
+        results = [result if "id" in result else {**result, "id": str(i)}
+                   for i, result in enumerate(entry.results[offset:end], offset)]
+
+        next_offset = str(end) if len(entry.results) > end else ""
+        return results, next_offset
@@ -0,0 +1,100 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import random
+
+
+LOGGER_NAME = "natsuko"
+
+# extra fields that get appended to a log line as key=value pairs
+STRUCTURED_FIELDS = ('update_id', 'chat_id', 'method', 'status', 'latency')
+
+
+def get_logger(name=None):
+    """Returns the natsuko logger, or one of its children (natsuko.<name>)."""
+
+    if name:
+        return logging.getLogger(f"{LOGGER_NAME}.{name}")
+
+    return logging.getLogger(LOGGER_NAME)
+
+
+class StructuredFormatter(logging.Formatter):
+    """Formatter that appends the structured `extra` fields of a record,
+    eg. `log.debug("sent", extra={"method": "sendMessage", "latency": 0.12})`
+    """
+
+    def format(self, record):
+        line = super().format(record)
+        fields = []
+
+        for field in STRUCTURED_FIELDS:
+            value = record.__dict__.get(field)
+            if value is None:
+                continue
+
+            if isinstance(value, float):
+                value = f"{value:.4f}"
+
+            fields.append(f"{field}={value}")
+
+        if fields:
+            return f"{line} | {' '.join(fields)}"
+
+        return line
+
+
+class SampleFilter(logging.Filter):
+    """Only lets through a fraction of the records flagged as sampled
+    (`extra={"sampled": True}`). Warnings and errors are never dropped.
+    """
+
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if self.rate >= 1 or record.levelno >= logging.WARNING:
+            return True
+
+        if not record.__dict__.get("sampled"):
+            return True
+
+        return random.random() < self.rate
+
+
+def setup_logging(level=logging.INFO, sample_rate=1.0, handler=None,
+                  fmt="%(asctime)s %(levelname)s %(name)s: %(message)s"):
+    """Routes the natsuko logger through a queue so the event loop never
+    blocks on the console (or any other slow handler). The actual output
+    happens on the QueueListener's thread.
+
+    Parameters      Type        Description
+    level           Int         Log level of the natsuko logger
+    sample_rate     Float       Fraction (0-1) of per-request records to keep
+    handler         Handler     Destination handler, defaults to stderr
+    fmt             String      Format string for the destination handler
+
+    Returns the started QueueListener, which is also stopped at exit.
+    """
+
+    if handler is None:
+        handler = logging.StreamHandler()
+
+    handler.setFormatter(StructuredFormatter(fmt))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(SampleFilter(sample_rate))
+
+    logger = get_logger()
+    logger.setLevel(level)
+    logger.addHandler(queue_handler)
+    logger.propagate = False
+
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    return listener
@@ -0,0 +1,256 @@
+import bisect
+import threading
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+
+    if not pairs:
+        return ""
+
+    body = ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                    for k, v in pairs)
+    return f"{{{body}}}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+
+    return str(value)
+
+
+class Metric():
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+        self._lock = threading.Lock()
+        self._children = {}
+
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values, **kwargs):
+        """Returns the child metric for the given label values."""
+
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.labelnames)
+        else:
+            values = tuple(values)
+
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+
+        return child
+
+    def _default(self):
+        return self._children[()]
+
+    def samples(self):
+        """Yields (suffix, label string, value) for every child."""
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} {self.type}"]
+
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+
+        return "\n".join(lines)
+
+
+class _Value():
+
+    __slots__ = ['value']
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(Metric):
+
+    type = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            yield "", _format_labels(self.labelnames, values), child.value
+
+
+class Gauge(Metric):
+
+    type = "gauge"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+    def dec(self, amount=1):
+        self._default().dec(amount)
+
+    def set(self, value):
+        self._default().set(value)
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            yield "", _format_labels(self.labelnames, values), child.value
+
+
+class _HistogramValue():
+
+    __slots__ = ['buckets', 'counts', 'sum', 'count']
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        # counts are per bucket here, they're made cumulative when rendered
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(Metric):
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, child.counts):
+                cumulative += count
+                yield "_bucket", _format_labels(self.labelnames, values, ("le", _format_value(float(bound)))), cumulative
+
+            yield "_bucket", _format_labels(self.labelnames, values, ("le", "+Inf")), child.count
+            yield "_sum", _format_labels(self.labelnames, values), child.sum
+            yield "_count", _format_labels(self.labelnames, values), child.count
+
+
+class Registry():
+
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, cls, name, *args, **kwargs):
+        # registering the same name twice hands back the existing metric, so
+        # several clients in one process can share the instrumentation
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, *args, **kwargs)
+
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        return "\n".join(m.render() for m in self.metrics.values()) + "\n"
+
+
+REGISTRY = Registry()
+
+POLL_DURATION = REGISTRY.histogram("natsuko_poll_duration_seconds", "Duration of getUpdates long polls")
+POLL_BATCH_SIZE = REGISTRY.histogram("natsuko_poll_batch_size", "Number of updates returned per poll",
+                                     buckets=(0, 1, 5, 10, 25, 50, 100))
+POLL_ERRORS = REGISTRY.counter("natsuko_poll_errors_total", "Failed getUpdates polls")
+POLL_STALLS = REGISTRY.counter("natsuko_poll_stalls_total", "getUpdates polls abandoned past their deadline")
+POLL_BREAKER_OPEN = REGISTRY.gauge("natsuko_poll_breaker_open", "1 while polling is paused after repeated failures")
+QUEUE_DEPTH = REGISTRY.gauge("natsuko_update_queue_depth", "Updates waiting to be dispatched")
+UPDATES = REGISTRY.counter("natsuko_updates_total", "Updates dispatched")
+UPDATES_SHED = REGISTRY.counter("natsuko_updates_shed_total", "Updates dropped by admission control",
+                                ["reason", "kind"])
+HANDLER_DURATION = REGISTRY.histogram("natsuko_handler_duration_seconds", "Handler run time", ["command"])
+HANDLER_ERRORS = REGISTRY.counter("natsuko_handler_errors_total", "Handlers that raised", ["command"])
+HANDLERS_RUNNING = REGISTRY.gauge("natsuko_handlers_running", "Handlers currently running")
+API_DURATION = REGISTRY.histogram("natsuko_api_request_duration_seconds", "Bot API call latency", ["method"])
+API_REQUESTS = REGISTRY.counter("natsuko_api_requests_total", "Bot API calls by result code", ["method", "code"])
+
+
+class MetricsServer():
+    """Small aiohttp server exposing a registry at /metrics.
+    Meant to be bound locally and scraped by Prometheus.
+    """
+
+    def __init__(self, registry=REGISTRY, host="127.0.0.1", port=9464):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    async def handle_metrics(self, request):
+        from aiohttp import web
+
+        return web.Response(text=self.registry.render(), content_type="text/plain")
+
+    async def start(self):
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle_metrics)
+
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
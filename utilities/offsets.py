@@ -0,0 +1,232 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+from collections import deque
+
+from utilities.log import get_logger
+
+
+log = get_logger("offsets")
+
+
+class OffsetStore():
+    """Durable state of the update stream: the next getUpdates offset and the
+    updates that were accepted but whose handlers haven't finished yet.
+    Stores are synchronous, the tracker calls them off the event loop.
+    """
+
+    def load(self):
+        """Returns (offset, [pending updates])."""
+        raise NotImplementedError
+
+    def apply(self, offset, added, removed):
+        """Atomically sets the offset, adds pending updates and drops finished ones."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class FileOffsetStore(OffsetStore):
+    """Keeps the state in a JSON file which is rewritten atomically on every commit.
+    Good for small bots; use SQLiteOffsetStore when many updates are in flight.
+    """
+
+    def __init__(self, path, fsync=True):
+        self.path = path
+        self.fsync = fsync
+        self.offset = None
+        self.pending = {}
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None, []
+
+        self.offset = state.get("offset")
+        self.pending = {int(k): v for k, v in state.get("pending", {}).items()}
+
+        return self.offset, [self.pending[k] for k in sorted(self.pending)]
+
+    def apply(self, offset, added, removed):
+        self.offset = offset
+        for update in added:
+            self.pending[update["update_id"]] = update
+
+        for update_id in removed:
+            self.pending.pop(update_id, None)
+
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"offset": self.offset, "pending": self.pending}, f)
+
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+
+        os.replace(tmp, self.path)
+
+
+class SQLiteOffsetStore(OffsetStore):
+
+    def __init__(self, path, fsync=True):
+        self.path = path
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(f"PRAGMA synchronous={'FULL' if fsync else 'NORMAL'}")
+        self.db.execute("CREATE TABLE IF NOT EXISTS offsets (key TEXT PRIMARY KEY, value INTEGER)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS pending_updates (update_id INTEGER PRIMARY KEY, data TEXT)")
+        self.db.commit()
+
+    def load(self):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM offsets WHERE key = 'offset'").fetchone()
+            rows = self.db.execute("SELECT data FROM pending_updates ORDER BY update_id").fetchall()
+
+        return (row[0] if row else None), [json.loads(r[0]) for r in rows]
+
+    def apply(self, offset, added, removed):
+        with self.lock, self.db:
+            if offset is not None:
+                self.db.execute("INSERT OR REPLACE INTO offsets (key, value) VALUES ('offset', ?)", (offset,))
+
+            self.db.executemany("INSERT OR REPLACE INTO pending_updates (update_id, data) VALUES (?, ?)",
+                                [(u["update_id"], json.dumps(u)) for u in added])
+            self.db.executemany("DELETE FROM pending_updates WHERE update_id = ?",
+                                [(i,) for i in removed])
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class OffsetTracker():
+    """Gives the update stream at-least-once semantics on top of an OffsetStore.
+
+    Accepted updates are journaled as pending before the poller moves the
+    getUpdates offset past them (which is when Telegram forgets them), and are
+    only dropped from the journal once their handlers completed. After a crash
+    the pending updates are dispatched again. A window of recently seen
+    update_ids filters out anything delivered twice.
+
+    Changes are batched, one write before every poll and one every
+    `commit_interval` seconds while a long poll is waiting.
+    """
+
+    def __init__(self, store, commit_interval=1.0, dedupe_window=10000):
+        self.store = store
+        self.commit_interval = commit_interval
+
+        self.offset = None
+        self.in_flight = set()
+        self.seen = set()
+        self.seen_order = deque()
+        self.dedupe_window = dedupe_window
+
+        self._added = []
+        self._removed = []
+        self._dirty = False
+        self._lock = None
+        self._task = None
+
+    @property
+    def committed_offset(self):
+        """Every update below this id has been fully handled."""
+        if self.in_flight:
+            return min(self.in_flight)
+
+        return self.offset
+
+    def _remember(self, update_id):
+        self.seen.add(update_id)
+        self.seen_order.append(update_id)
+
+        while len(self.seen_order) > self.dedupe_window:
+            self.seen.discard(self.seen_order.popleft())
+
+    def load(self):
+        """Returns (offset, [pending updates]) from the store, to resume from."""
+        offset, pending = self.store.load()
+        self.offset = offset
+
+        for update in pending:
+            self.in_flight.add(update["update_id"])
+            self._remember(update["update_id"])
+
+        if pending:
+            log.info("Resuming with %d unfinished updates", len(pending))
+
+        return offset, pending
+
+    def accept(self, updates, offset):
+        """Filters out duplicates and journals the rest, returns the new updates."""
+        fresh = []
+
+        for update in updates:
+            update_id = update["update_id"]
+            if update_id in self.seen:
+                continue
+
+            self._remember(update_id)
+            self.in_flight.add(update_id)
+            fresh.append(update)
+
+        self._added.extend(fresh)
+        self.offset = offset
+        self._dirty = True
+
+        return fresh
+
+    def done(self, update_id):
+        if update_id in self.in_flight:
+            self.in_flight.discard(update_id)
+            self._removed.append(update_id)
+            self._dirty = True
+
+    async def flush(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            if not self._dirty:
+                return
+
+            added, self._added = self._added, []
+            removed, self._removed = self._removed, []
+            self._dirty = False
+
+            loop = asyncio.get_event_loop()
+            try:
+                await loop.run_in_executor(None, self.store.apply, self.offset, added, removed)
+            except Exception:
+                # keep the batch around for the next attempt
+                self._added = added + self._added
+                self._removed = removed + self._removed
+                self._dirty = True
+                raise
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.commit_interval)
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("Offset commit failed")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._flush_periodically())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+        await self.flush()
+        self.store.close()
@@ -0,0 +1,116 @@
+import random
+import time
+
+from models.errors import APIError
+from utilities.log import get_logger
+from utilities import metrics
+
+
+log = get_logger("polling")
+
+# getUpdates returns at most 100 updates per call
+MAX_LIMIT = 100
+
+# longest poll a bot sharing poll slots may hold one for, see utilities/host.py
+MAX_SLOT_TIMEOUT = 10
+
+# errors retrying won't fix, eg. a revoked token
+FATAL_CODES = (401, 404)
+
+
+class PollStalled(Exception):
+    """A long poll wasn't answered by its deadline, its connection is assumed dead."""
+
+
+class PollController():
+    """Tunes the getUpdates long polls and decides what happens when they fail.
+
+    timeout:    polls wait up to `max_timeout` seconds while things are healthy.
+                A failure drops it to `min_timeout`, so a bad connection is
+                noticed quickly, and every successful poll doubles it back.
+    limit:      grows while polls come back full, shrinks back towards
+                `min_limit` as traffic drops.
+    deadline:   a poll not answered within `timeout + grace` seconds has
+                stalled (eg. on a half-open connection) and is abandoned.
+    backoff:    failures in a row wait exponentially longer, with jitter, up to
+                `max_backoff` seconds or the retry_after the API asked for.
+    breaker:    after `failure_threshold` failures in a row polling pauses for
+                `cooldown` seconds, then a single trial poll decides whether
+                it resumes or pauses again.
+    """
+
+    def __init__(self, max_timeout=100, min_timeout=5, grace=5, min_limit=10, max_limit=MAX_LIMIT,
+                 base_backoff=0.5, max_backoff=30, failure_threshold=5, cooldown=60):
+        self.max_timeout = max_timeout
+        self.min_timeout = min(min_timeout, max_timeout)
+        self.grace = grace
+        self.min_limit = min(min_limit, max_limit)
+        self.max_limit = min(max_limit, MAX_LIMIT)
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+        self.timeout = max_timeout
+        # start wide open, to drain whatever piled up while we were away
+        self.limit = self.max_limit
+
+        self.failures = 0
+        self.stalls = 0
+        self.state = "closed"
+        self.last_success = None
+
+    @property
+    def deadline(self):
+        return self.timeout + self.grace
+
+    def succeeded(self, count):
+        if self.state != "closed":
+            log.info("Polling recovered after %d failures", self.failures)
+            metrics.POLL_BREAKER_OPEN.set(0)
+
+        self.state = "closed"
+        self.failures = 0
+        self.last_success = time.monotonic()
+        self.timeout = min(self.max_timeout, max(self.timeout * 2, self.min_timeout))
+
+        if count >= self.limit:
+            self.limit = min(self.max_limit, self.limit * 2)
+        elif count < self.limit // 4:
+            self.limit = max(self.min_limit, self.limit // 2)
+
+    def failed(self, exc):
+        """Records a failed poll and returns how many seconds to wait before the
+        next one. Re-raises errors retrying won't fix.
+        """
+
+        if isinstance(exc, APIError) and isinstance(exc.expression, dict):
+            if exc.expression.get("error_code") in FATAL_CODES:
+                raise exc
+
+            retry_after = (exc.expression.get("parameters") or {}).get("retry_after") or 0
+        else:
+            retry_after = 0
+
+        if isinstance(exc, PollStalled):
+            self.stalls += 1
+            metrics.POLL_STALLS.inc()
+
+        self.failures += 1
+        self.timeout = self.min_timeout
+
+        if self.failures >= self.failure_threshold:
+            if self.state != "open":
+                log.error("Polling failed %d times in a row, pausing for %ss", self.failures, self.cooldown)
+                metrics.POLL_BREAKER_OPEN.set(1)
+
+            self.state = "open"
+            return max(self.cooldown, retry_after)
+
+        delay = min(self.max_backoff, self.base_backoff * 2 ** (self.failures - 1))
+        return max(delay * random.uniform(0.5, 1), retry_after)
+
+    def trial(self):
+        # the pause is over, the next poll decides whether the breaker closes
+        if self.state == "open":
+            self.state = "half-open"
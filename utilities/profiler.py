@@ -0,0 +1,190 @@
+import cProfile
+import io
+import pstats
+import random
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+from utilities.log import get_logger
+
+
+log = get_logger("profiler")
+
+
+class _ProfiledCoroutine():
+    """Drives a handler coroutine one step at a time, timing each step.
+    A step is the synchronous stretch between two awaits, which is exactly
+    the time the handler keeps the event loop to itself.
+    """
+
+    def __init__(self, profiler, name, coro, cprofile=None):
+        self.profiler = profiler
+        self.name = name
+        self.coro = coro
+        self.cprofile = cprofile
+
+    def __await__(self):
+        try:
+            return (yield from self._drive())
+        finally:
+            if self.cprofile:
+                self.profiler._record_profile(self.name, self.cprofile)
+
+    def _drive(self):
+        send_value, error = None, None
+
+        while True:
+            self.profiler.current = self.name
+            self.profiler._stack = None
+            start = time.perf_counter()
+
+            if self.cprofile:
+                self.cprofile.enable()
+
+            try:
+                if error is not None:
+                    yielded = self.coro.throw(error)
+                else:
+                    yielded = self.coro.send(send_value)
+
+            except StopIteration as ex:
+                return ex.value
+
+            finally:
+                if self.cprofile:
+                    self.cprofile.disable()
+
+                self.profiler.current = None
+                self.profiler._record_step(self.name, time.perf_counter() - start)
+
+            try:
+                send_value, error = (yield yielded), None
+            except BaseException as ex:
+                send_value, error = None, ex
+
+
+class HandlerProfiler():
+    """Opt-in profiling for handlers.
+
+    - A watchdog thread notices when the event loop stops ticking for longer than
+      `block_threshold` seconds and snapshots the loop thread's stack.
+    - Every handler step that holds the loop longer than the threshold is recorded
+      as an offender, together with that stack.
+    - A `sample_rate` fraction of handler runs are run under cProfile.
+
+    `report()` dumps the worst offenders and the merged cProfile stats.
+    """
+
+    def __init__(self, sample_rate=0.01, block_threshold=0.1, interval=0.05, history=50):
+        self.sample_rate = sample_rate
+        self.block_threshold = block_threshold
+        self.interval = interval
+
+        self.current = None
+        self.handlers = {}
+        self.offenders = deque(maxlen=history)
+        self.profiles = {}
+
+        self.loop = None
+        self._beat = time.monotonic()
+        self._stack = None
+        self._thread = None
+        self._loop_thread_id = None
+        self._stopped = threading.Event()
+
+    def wrap(self, name, coro):
+        cprofile = cProfile.Profile() if random.random() < self.sample_rate else None
+        return _ProfiledCoroutine(self, name, coro, cprofile)
+
+    def _record_profile(self, name, cprofile):
+        if name in self.profiles:
+            self.profiles[name].add(cprofile)
+        else:
+            self.profiles[name] = pstats.Stats(cprofile)
+
+    def _record_step(self, name, duration):
+        stats = self.handlers.setdefault(name, {"steps": 0, "total": 0.0, "max": 0.0, "blocked": 0})
+        stats["steps"] += 1
+        stats["total"] += duration
+        stats["max"] = max(stats["max"], duration)
+
+        if duration < self.block_threshold:
+            return
+
+        stats["blocked"] += 1
+        stack, self._stack = self._stack, None
+        self.offenders.append({"handler": name, "duration": duration, "time": time.time(), "stack": stack})
+        log.warning("Handler %s blocked the event loop for %.3fs", name, duration)
+
+    # Loop lag monitor
+
+    def start(self, loop):
+        self.loop = loop
+        self._loop_thread_id = threading.get_ident()
+        self._stopped.clear()
+        self._heartbeat()
+
+        self._thread = threading.Thread(target=self._watch, name="natsuko-lag-monitor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _heartbeat(self):
+        self._beat = time.monotonic()
+        if not self._stopped.is_set():
+            self.loop.call_later(self.interval, self._heartbeat)
+
+    def _watch(self):
+        captured_for = None
+
+        while not self._stopped.wait(self.interval):
+            beat = self._beat
+            lag = time.monotonic() - beat - self.interval
+
+            if lag < self.block_threshold or captured_for == beat:
+                continue
+
+            # loop is stuck, grab its stack once per stall
+            captured_for = beat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+
+            self._stack = "".join(traceback.format_stack(frame))
+            log.warning("Event loop lagging %.3fs, currently in handler: %s", lag, self.current)
+
+    # Reports
+
+    def top(self, limit=10):
+        """Returns the handlers with the longest blocking step, worst first."""
+        ranked = sorted(self.handlers.items(), key=lambda x: x[1]["max"], reverse=True)
+        return ranked[:limit]
+
+    def report(self, limit=10):
+        out = io.StringIO()
+        out.write("Handlers by longest blocking step\n")
+
+        for name, stats in self.top(limit):
+            mean = stats["total"] / stats["steps"] if stats["steps"] else 0
+            out.write(f"  {name}: max {stats['max']:.4f}s, mean {mean:.4f}s, "
+                      f"steps {stats['steps']}, blocked {stats['blocked']}\n")
+
+        worst = sorted(self.offenders, key=lambda x: x["duration"], reverse=True)[:limit]
+        if worst:
+            out.write("\nWorst blocking steps\n")
+
+        for offender in worst:
+            out.write(f"  {offender['handler']}: {offender['duration']:.4f}s\n")
+            if offender["stack"]:
+                out.write(offender["stack"])
+
+        for name, stats in self.profiles.items():
+            out.write(f"\nSampled profile: {name}\n")
+            stats.stream = out
+            stats.sort_stats("cumulative").print_stats(limit)
+
+        return out.getvalue()
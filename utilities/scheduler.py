@@ -0,0 +1,302 @@
+import asyncio
+import heapq
+import inspect
+import itertools
+import json
+import math
+import sqlite3
+import threading
+import time
+
+from utilities.log import get_logger
+
+
+log = get_logger("scheduler")
+
+# entry fields, entries are lists so a cancelled one can be blanked in place
+DUE, ID, METHOD, PAYLOAD, EVERY = range(5)
+
+
+def _plain(value):
+    # frozen keyboards and Telegram types are stored as their JSON data
+    data = getattr(value, "data", None)
+    if data is None:
+        raise TypeError(f"{type(value).__name__} can't be stored in a job")
+
+    return data.toDict() if hasattr(data, "toDict") else data
+
+
+_encode = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False, default=_plain).encode
+
+
+class SQLiteJobStore():
+    """Keeps scheduled jobs in SQLite so they survive restarts. Only the jobs
+    due soon are held in memory, the rest are read as their time comes.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS jobs "
+                        "(id INTEGER PRIMARY KEY, due REAL, method TEXT, payload TEXT, every REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_due ON jobs (due)")
+        self.db.commit()
+
+    def last_id(self):
+        with self.lock:
+            return self.db.execute("SELECT MAX(id) FROM jobs").fetchone()[0] or 0
+
+    def apply(self, added, removed):
+        """Saves (or replaces) `added` entries and deletes `removed` ids, in one transaction."""
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO jobs (due, id, method, payload, every) "
+                                "VALUES (?, ?, ?, ?, ?)", added)
+            self.db.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in removed])
+
+    def load(self, after, until):
+        """Returns the entries due in (after, until]."""
+        with self.lock:
+            rows = self.db.execute("SELECT due, id, method, payload, every FROM jobs "
+                                   "WHERE due > ? AND due <= ?", (after, until)).fetchall()
+
+        return [list(row) for row in rows]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class JobScheduler():
+    """Runs client API calls later, once or every so often:
+
+        job = client.scheduler.call_later(30, "delete_message", chat_id, message_id)
+        client.scheduler.call_later(3600, "send_message", chat_id, "Hourly report", every=3600)
+        client.scheduler.cancel(job)
+
+    Jobs wait in a heap ordered by due time, and each due job is started as
+    its own task calling the client like any other API call (rate limits,
+    coalescing and metrics apply), at most `concurrency` running at once, so
+    a slow job doesn't hold back the ones after it. Arguments are kept as JSON.
+
+    With a `store` (eg. SQLiteJobStore) jobs are saved in batches every
+    `flush_interval` seconds and picked up again after a restart; only those
+    due within `horizon` seconds are held in memory. A job running when the
+    bot stops runs again on the next start.
+    """
+
+    def __init__(self, client, store=None, concurrency=32, flush_interval=1.0, horizon=300):
+        self.client = client
+        self.store = store
+        self.concurrency = concurrency
+        self.flush_interval = flush_interval
+        self.horizon = horizon if store else math.inf
+
+        self.heap = []
+        # id -> entry, for the jobs in the heap
+        self.entries = {}
+        self._ids = None
+        # method names already checked by call_at()
+        self._methods = set()
+
+        # changes not saved to the store yet
+        self._added = []
+        self._removed = []
+        # jobs due up to this time are in the heap, later ones only in the store
+        self.loaded_until = -math.inf if store else math.inf
+
+        self.ran = 0
+        self.failed = 0
+
+        self._wake = None
+        self._io_lock = None
+        self._task = None
+        self._running = set()
+
+    def _next_id(self):
+        if self._ids is None:
+            self._ids = itertools.count((self.store.last_id() if self.store else 0) + 1)
+
+        return next(self._ids)
+
+    async def _run_io(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    # Scheduling
+
+    def call_at(self, when, method, *args, every=None, **kwargs):
+        """Calls client.<method>(*args, **kwargs) at the unix time `when`, then
+        every `every` seconds if it's set. Returns the job's id.
+        """
+
+        if method not in self._methods:
+            if method.startswith("_") or not inspect.iscoroutinefunction(getattr(self.client, method, None)):
+                raise ValueError(f"{method!r} isn't an API method of the client")
+
+            self._methods.add(method)
+
+        payload = _encode([args, kwargs])
+        entry = [when, self._next_id(), method, payload, every]
+        self._push(entry)
+
+        if self.store:
+            self._added.append(tuple(entry))
+
+        return entry[ID]
+
+    def call_later(self, delay, method, *args, every=None, **kwargs):
+        return self.call_at(time.time() + delay, method, *args, every=every, **kwargs)
+
+    def cancel(self, job_id):
+        entry = self.entries.pop(job_id, None)
+        if entry is not None:
+            # skipped when it comes up
+            entry[METHOD] = None
+
+        if self.store:
+            self._removed.append(job_id)
+
+    def _push(self, entry):
+        # jobs past the loaded window stay in the store until their time comes
+        if entry[DUE] > self.loaded_until:
+            return
+
+        if self._wake and (not self.heap or entry[DUE] < self.heap[0][DUE]):
+            self._wake.set()
+
+        heapq.heappush(self.heap, entry)
+        self.entries[entry[ID]] = entry
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Running
+
+    async def _sync(self, load=False):
+        if self._io_lock is None:
+            self._io_lock = asyncio.Lock()
+
+        async with self._io_lock:
+            added, self._added = self._added, []
+            removed, self._removed = self._removed, []
+
+            try:
+                if added or removed:
+                    await self._run_io(self.store.apply, added, removed)
+            except Exception:
+                # keep them for the next try
+                self._added[:0] = added
+                self._removed[:0] = removed
+                raise
+
+            if load:
+                until = time.time() + self.horizon
+                entries = await self._run_io(self.store.load, self.loaded_until, until)
+                self.loaded_until = until
+
+                for entry in entries:
+                    if entry[ID] not in self.entries:
+                        self._push(entry)
+
+    async def _execute(self, entry):
+        method = getattr(self.client, entry[METHOD])
+        args, kwargs = json.loads(entry[PAYLOAD])
+
+        try:
+            await method(*args, **kwargs)
+            self.ran += 1
+        except Exception as e:
+            self.failed += 1
+            log.warning("Job %s (%s) failed: %r", entry[ID], entry[METHOD], e)
+
+        if entry[METHOD] is None:
+            # cancelled while it ran
+            return
+
+        if entry[EVERY]:
+            # the next run after now, skipping those missed while the bot was down
+            now = time.time()
+            due = entry[DUE] + entry[EVERY]
+            if due <= now:
+                due += math.ceil((now - due) / entry[EVERY]) * entry[EVERY]
+
+            entry = [due, entry[ID], entry[METHOD], entry[PAYLOAD], entry[EVERY]]
+            self.entries.pop(entry[ID], None)
+            self._push(entry)
+
+            if self.store:
+                self._added.append(tuple(entry))
+            return
+
+        self.entries.pop(entry[ID], None)
+        if self.store:
+            self._removed.append(entry[ID])
+
+    def _finished(self, semaphore, task):
+        self._running.discard(task)
+        semaphore.release()
+
+    async def _loop(self):
+        last_sync = time.monotonic()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        while True:
+            now = time.time()
+
+            try:
+                if self.store and now + self.horizon / 2 >= self.loaded_until:
+                    await self._sync(load=True)
+                    last_sync = time.monotonic()
+                elif (self._added or self._removed) and time.monotonic() - last_sync >= self.flush_interval:
+                    await self._sync()
+                    last_sync = time.monotonic()
+            except Exception:
+                log.exception("Saving jobs failed")
+
+            while self.heap and self.heap[0][DUE] <= now:
+                entry = heapq.heappop(self.heap)
+                if entry[METHOD] is None:
+                    continue
+
+                # waits only while `concurrency` jobs are running
+                await semaphore.acquire()
+                if entry[METHOD] is None:
+                    semaphore.release()
+                    continue
+
+                task = asyncio.ensure_future(self._execute(entry))
+                self._running.add(task)
+                task.add_done_callback(lambda task: self._finished(semaphore, task))
+
+            now = time.time()
+
+            wait = self.heap[0][DUE] - now if self.heap else math.inf
+            if self.store:
+                wait = min(wait, self.flush_interval, self.loaded_until - self.horizon / 2 - now)
+
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), None if wait == math.inf else max(wait, 0))
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._task = asyncio.ensure_future(self._loop())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+        # jobs cut short stay in the store and run again on the next start
+        for task in self._running:
+            task.cancel()
+        await asyncio.gather(*self._running, return_exceptions=True)
+
+        if self.store:
+            await self._sync()
+            await self._run_io(self.store.close)
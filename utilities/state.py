@@ -0,0 +1,286 @@
+import asyncio
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from utilities.log import get_logger
+
+
+log = get_logger("state")
+
+STEP_KEY = "__step__"
+
+
+class MemoryStateBackend():
+    """Keeps state in process memory only, dropping the least recently used
+    entries past `max_size`.
+    """
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.data = OrderedDict()
+
+    def load(self, key):
+        value = self.data.get(key)
+        if value is not None:
+            self.data.move_to_end(key)
+
+        return value
+
+    def save(self, items):
+        for key, value in items:
+            self.data[key] = value
+            self.data.move_to_end(key)
+
+        while len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+
+    def delete(self, keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def close(self):
+        pass
+
+
+class SQLiteStateBackend():
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS chat_state (key TEXT PRIMARY KEY, data TEXT)")
+        self.db.commit()
+
+    def load(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT data FROM chat_state WHERE key = ?", (key,)).fetchone()
+
+        return json.loads(row[0]) if row else None
+
+    def save(self, items):
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO chat_state (key, data) VALUES (?, ?)",
+                                [(key, json.dumps(value)) for key, value in items])
+
+    def delete(self, keys):
+        with self.lock, self.db:
+            self.db.executemany("DELETE FROM chat_state WHERE key = ?", [(key,) for key in keys])
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class ChatState():
+    """The state of one chat (or user), available to handlers as `event.state`.
+    Behaves like a dict of JSON-serializable values; `step` holds the current
+    step of a multi-step conversation.
+    """
+
+    def __init__(self, store, key, data):
+        self.store = store
+        self.key = key
+        self.data = data
+
+    def __getitem__(self, item):
+        return self.data[item]
+
+    def __setitem__(self, item, value):
+        self.data[item] = value
+        self.store.mark_dirty(self.key)
+
+    def __delitem__(self, item):
+        del self.data[item]
+        self.store.mark_dirty(self.key)
+
+    def __contains__(self, item):
+        return item in self.data
+
+    def get(self, item, default=None):
+        return self.data.get(item, default)
+
+    def update(self, *args, **kwargs):
+        self.data.update(*args, **kwargs)
+        self.store.mark_dirty(self.key)
+
+    def clear(self):
+        self.data.clear()
+        self.store.mark_dirty(self.key)
+
+    @property
+    def step(self):
+        return self.data.get(STEP_KEY)
+
+    @step.setter
+    def step(self, value):
+        if value is None:
+            self.data.pop(STEP_KEY, None)
+        else:
+            self.data[STEP_KEY] = value
+
+        self.store.mark_dirty(self.key)
+
+    def finish(self):
+        """Ends the conversation, clearing the step but keeping the data."""
+        self.step = None
+
+
+class StateStore():
+    """Per-chat state with an in-memory LRU in front of a backend.
+
+    Reads are served from memory when possible, changes are written behind in
+    batches every `flush_interval` seconds, off the event loop. Each key has
+    a lock, held while a handler runs with its state, so handlers for the same
+    chat run one at a time and in the order their updates arrived.
+
+    scope is "chat" (default), "user", or "chat_user" for per-user state
+    inside each chat.
+    """
+
+    def __init__(self, backend=None, cache_size=10000, flush_interval=1.0, scope="chat"):
+        self.backend = backend or MemoryStateBackend()
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.scope = scope
+
+        self.cache = OrderedDict()
+        self.dirty = set()
+        self.locks = {}
+
+        self._flush_lock = None
+        self._task = None
+
+    def key(self, event):
+        """The state key of an event, None when it lacks the chat or user its
+        scope needs (eg. a callback from an inline-mode message has no chat),
+        as those would otherwise all share one state and one lock.
+        """
+
+        chat_id = event.chat.id if event.chat else None
+        user_id = event.author.id if event.author else None
+
+        if self.scope == "user":
+            return None if user_id is None else str(user_id)
+
+        if self.scope == "chat_user":
+            return None if chat_id is None or user_id is None else f"{chat_id}:{user_id}"
+
+        return None if chat_id is None else str(chat_id)
+
+    def mark_dirty(self, key):
+        self.dirty.add(key)
+
+    async def _run_io(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    async def get(self, key):
+        state = self.cache.get(key)
+        if state is not None:
+            self.cache.move_to_end(key)
+            return state
+
+        data = await self._run_io(self.backend.load, key)
+        state = self.cache.get(key)
+
+        # another task may have loaded it while we were waiting
+        if state is None:
+            state = self.cache[key] = ChatState(self, key, data or {})
+
+        await self._evict()
+        return state
+
+    async def _evict(self):
+        if len(self.cache) <= self.cache_size:
+            return
+
+        if self.dirty:
+            await self.flush()
+
+        while len(self.cache) > self.cache_size:
+            key = next(iter(self.cache))
+            if key in self.locks or key in self.dirty:
+                # in use, try again on the next load
+                self.cache.move_to_end(key)
+                break
+
+            del self.cache[key]
+
+    def session(self, event):
+        """Async context manager that locks the event's chat and yields its state."""
+        return _StateSession(self, self.key(event))
+
+    async def flush(self):
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+
+        async with self._flush_lock:
+            if not self.dirty:
+                return
+
+            keys, self.dirty = self.dirty, set()
+            save = [(k, dict(self.cache[k].data)) for k in keys if k in self.cache and self.cache[k].data]
+            delete = [k for k in keys if k in self.cache and not self.cache[k].data]
+
+            try:
+                if save:
+                    await self._run_io(self.backend.save, save)
+                if delete:
+                    await self._run_io(self.backend.delete, delete)
+            except Exception:
+                self.dirty |= keys
+                raise
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("State flush failed")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._flush_periodically())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+        await self.flush()
+        self.backend.close()
+
+
+class _StateSession():
+
+    def __init__(self, store, key):
+        self.store = store
+        self.key = key
+        self.lock = None
+
+    async def __aenter__(self):
+        entry = self.store.locks.get(self.key)
+        if entry is None:
+            entry = self.store.locks[self.key] = [asyncio.Lock(), 0]
+
+        # the counter lets the lock be dropped once nobody waits on it
+        entry[1] += 1
+        self.lock = entry
+        await entry[0].acquire()
+
+        try:
+            return await self.store.get(self.key)
+        except BaseException:
+            await self.__aexit__()
+            raise
+
+    async def __aexit__(self, *exc):
+        entry = self.lock
+        entry[0].release()
+        entry[1] -= 1
+
+        if entry[1] == 0:
+            del self.store.locks[self.key]
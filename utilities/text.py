@@ -0,0 +1,298 @@
+import bisect
+import re
+from itertools import accumulate
+
+
+# Telegram's limits, in UTF-16 code units like entity offsets
+MAX_MESSAGE_LENGTH = 4096
+MAX_CAPTION_LENGTH = 1024
+
+HTML_ESCAPES = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;"})
+MARKDOWN_ESCAPES = str.maketrans({c: "\\" + c for c in "_*`["})
+MARKDOWN_V2_ESCAPES = str.maketrans({c: "\\" + c for c in "\\_*[]()~`>#+-=|{}.!"})
+# inside `code` and ```pre``` MarkdownV2 only needs these escaped
+MARKDOWN_V2_CODE_ESCAPES = str.maketrans({"\\": "\\\\", "`": "\\`"})
+
+
+def escape_html(text):
+    return text.translate(HTML_ESCAPES)
+
+
+def escape_markdown(text, version=2, code=False):
+    if version == 1:
+        return text.translate(MARKDOWN_ESCAPES)
+
+    return text.translate(MARKDOWN_V2_CODE_ESCAPES if code else MARKDOWN_V2_ESCAPES)
+
+
+def escape(text, parse_mode):
+    """Escapes user content for a parse_mode, so it shows up as it is."""
+
+    mode = (parse_mode or "").lower()
+
+    if mode == "html":
+        return escape_html(text)
+    if mode == "markdown":
+        return escape_markdown(text, version=1)
+    if mode == "markdownv2":
+        return escape_markdown(text)
+
+    return text
+
+
+def utf16_len(text):
+    return len(text.encode("utf-16-le")) // 2
+
+
+class _Units():
+    """Converts between str indices and UTF-16 offsets, which only differ
+    when the text has characters outside the BMP (eg. most emoji).
+    """
+
+    def __init__(self, text):
+        self.prefix = None
+        if utf16_len(text) != len(text):
+            self.prefix = [0, *accumulate(2 if ord(c) > 0xFFFF else 1 for c in text)]
+
+    def offset(self, index):
+        return self.prefix[index] if self.prefix else index
+
+    def index(self, offset):
+        """The last index at or before a UTF-16 offset."""
+        if self.prefix is None:
+            return offset
+
+        return bisect.bisect_right(self.prefix, offset) - 1
+
+
+# Markup scanners. Each returns the text's markup tokens, in order, as
+# (start, end, action, open, close): PUSH and POP open and close a formatting
+# (`open`/`close` is how to reopen/close it in another chunk), ATOM is markup
+# that can't be cut, like an escape or a link.
+
+PUSH, POP, ATOM = range(3)
+
+HTML_TOKEN = re.compile(r"<(/?)([a-zA-Z][\w-]*)[^>]*>|&#?\w+;")
+
+
+def _scan_html(text):
+    tokens = []
+
+    for match in HTML_TOKEN.finditer(text):
+        if match.group(2) is None:
+            tokens.append((match.start(), match.end(), ATOM, None, None))
+        elif match.group(1):
+            tokens.append((match.start(), match.end(), POP, None, None))
+        else:
+            tokens.append((match.start(), match.end(), PUSH, match.group(), f"</{match.group(2).lower()}>"))
+
+    return tokens
+
+
+MARKDOWN_TOKEN = re.compile(r"""
+    (?P<escape>\\.)
+  | (?P<pre>```[^\n`]*\n?)
+  | (?P<link>!?\[(?:[^\]\\]|\\.)*\]\((?:[^)\\]|\\.)*\))
+  | (?P<marker>`|\|\||__|[*_~])
+""", re.VERBOSE | re.DOTALL)
+
+# markers that legacy Markdown knows
+MARKDOWN_V1_MARKERS = frozenset(["`", "*", "_"])
+
+
+def _scan_markdown(text, version=2):
+    tokens = []
+    stack = []
+    code = None
+
+    for match in MARKDOWN_TOKEN.finditer(text):
+        kind = match.lastgroup
+        value = match.group()
+        start, end = match.span()
+
+        if kind == "escape":
+            # legacy Markdown has no escapes in code
+            if code is None or version == 2:
+                tokens.append((start, end, ATOM, None, None))
+            continue
+
+        if kind == "pre":
+            if code == "```":
+                code = None
+                stack.pop()
+                # a closing fence has no language, give back what was matched past it
+                tokens.append((start, start + 3, POP, None, None))
+            elif code is None:
+                code = "```"
+                stack.append(value)
+                tokens.append((start, end, PUSH, value if value.endswith("\n") else value + "\n", "```"))
+            continue
+
+        if code == "```" or (code == "`" and value != "`"):
+            continue
+
+        if kind == "link":
+            tokens.append((start, end, ATOM, None, None))
+            continue
+
+        if version == 1 and value not in MARKDOWN_V1_MARKERS:
+            continue
+
+        if value in stack:
+            stack.pop(len(stack) - 1 - stack[::-1].index(value))
+            code = None if value == "`" else code
+            tokens.append((start, end, POP, None, None))
+        else:
+            stack.append(value)
+            code = "`" if value == "`" else code
+            tokens.append((start, end, PUSH, value, value))
+
+    return tokens
+
+
+SEPARATORS = ("\n\n", "\n", " ")
+
+
+def _best_cut(text, start, end, allowed):
+    """Where to end a chunk of text[start:end]: the last paragraph, line or word
+    break in its second half where `allowed(cut)`. Returns (cut, skip), skip
+    being the length of the separator dropped, or (None, 0).
+    """
+
+    lowest = start + (end - start) // 2
+
+    for separator in SEPARATORS:
+        cut = text.rfind(separator, lowest, end)
+        while cut > start:
+            if allowed(cut):
+                return cut, len(separator)
+            cut = text.rfind(separator, lowest, cut)
+
+    return None, 0
+
+
+def _split_markup(text, limit, tokens):
+    units = _Units(text)
+    starts = [token[0] for token in tokens]
+
+    def inside(cut):
+        # the token starting last before the cut, if the cut falls in it
+        i = bisect.bisect_right(starts, cut - 1) - 1
+        return tokens[i] if i >= 0 and tokens[i][1] > cut else None
+
+    chunks = []
+    stack = []
+    start = 0
+    next_token = 0
+
+    while start < len(text):
+        reopen = "".join(token[3] for token in stack)
+        budget = limit - utf16_len(reopen)
+
+        while True:
+            end = min(len(text), units.index(units.offset(start) + budget))
+
+            if end >= len(text):
+                cut, skip = len(text), 0
+            else:
+                cut, skip = _best_cut(text, start, end, lambda c: inside(c) is None)
+                if cut is None:
+                    # no break to use, cut before whatever markup is in the way
+                    token = inside(end)
+                    cut, skip = (token[0] if token and token[0] > start else end), 0
+
+            # formatting still open at the cut is closed, and reopened in the next chunk
+            open_at_cut = list(stack)
+            i = next_token
+            while i < len(tokens) and tokens[i][0] < cut:
+                if tokens[i][2] == PUSH:
+                    open_at_cut.append(tokens[i])
+                elif tokens[i][2] == POP and open_at_cut:
+                    open_at_cut.pop()
+                i += 1
+
+            closing = "".join(token[4] for token in reversed(open_at_cut))
+            chunk = reopen + text[start:cut] + closing
+
+            over = utf16_len(chunk) - limit
+            if over <= 0 or budget <= over:
+                break
+            budget -= over
+
+        if text[start:cut].strip():
+            chunks.append(chunk)
+
+        stack, next_token = open_at_cut, i
+        start = max(cut + skip, start + 1)
+
+    return chunks
+
+
+def _entity(entity):
+    return dict(getattr(entity, "data", entity))
+
+
+def _split_entities(text, limit, entities):
+    units = _Units(text)
+    entities = sorted((_entity(e) for e in entities), key=lambda e: e["offset"])
+    spans = [(units.index(e["offset"]), units.index(e["offset"] + e["length"])) for e in entities]
+
+    def outside(cut):
+        return not any(first < cut < last for first, last in spans)
+
+    chunks = []
+    start = 0
+
+    while start < len(text):
+        end = min(len(text), units.index(units.offset(start) + limit))
+
+        if end >= len(text):
+            cut, skip = len(text), 0
+        else:
+            # rather not inside an entity, but a huge one (eg. a log in a pre) has to be split
+            cut, skip = _best_cut(text, start, end, outside)
+            if cut is None:
+                cut, skip = _best_cut(text, start, end, lambda c: True)
+            if cut is None:
+                cut, skip = end, 0
+
+        first, last = units.offset(start), units.offset(cut)
+        chunk_entities = []
+
+        for entity in entities:
+            offset, length = entity["offset"], entity["length"]
+            overlap = min(offset + length, last) - max(offset, first)
+
+            if overlap > 0:
+                chunk_entities.append({**entity, "offset": max(offset, first) - first, "length": overlap})
+
+        if text[start:cut].strip():
+            chunks.append((text[start:cut], chunk_entities or None))
+
+        start = max(cut + skip, start + 1)
+
+    return chunks
+
+
+def split_text(text, limit=MAX_MESSAGE_LENGTH, parse_mode=None, entities=None):
+    """Splits a text into chunks of at most `limit` UTF-16 code units, ending
+    them on paragraph, line or word breaks where possible. Returns a list of
+    (text, entities) pairs.
+
+    With a parse_mode, chunks never end inside a tag, escape or link, and
+    formatting open at the end of one chunk is closed there and reopened in
+    the next, so every chunk is valid markup; the limit counts the markup too,
+    which keeps chunks on the safe side. Without one, `entities` (dicts
+    or MessageEntity) are cut to each chunk and their offsets moved, entities
+    being None for chunks without any.
+    """
+
+    mode = (parse_mode or "").lower()
+
+    if mode == "html":
+        return [(chunk, None) for chunk in _split_markup(text, limit, _scan_html(text))]
+    if mode in ("markdown", "markdownv2"):
+        tokens = _scan_markdown(text, version=2 if mode == "markdownv2" else 1)
+        return [(chunk, None) for chunk in _split_markup(text, limit, tokens)]
+
+    return _split_entities(text, limit, entities or [])